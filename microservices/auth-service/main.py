@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
 import sys
 import os
@@ -7,12 +7,16 @@ import uuid
 
 # Import shared utilities
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from shared_utils import db, hash_password, verify_password, create_access_token, verify_token, ACCESS_TOKEN_EXPIRE_MINUTES
+from user_search import username_index
+from key_directory import stored_key_directory, etag_matches, bundle_response
+from shared_utils import adb, principal_cache, cache_principal, invalidate_user, hash_password_async, verify_password_async, create_access_token, verify_token, ACCESS_TOKEN_EXPIRE_MINUTES
 from datetime import timedelta
 import uuid
 
 app = FastAPI(title="LockBox Auth Service", version="1.0.0")
 
+MAX_KEY_BATCH = 200
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -38,19 +42,20 @@ async def register_user(user_data: dict):
             raise HTTPException(status_code=400, detail="Username and password required")
         
         # Check if user exists
-        existing_user = db.fetchone("users", {"username": username})
+        existing_user = await adb.fetchone("users", {"username": username})
         if existing_user:
             raise HTTPException(status_code=400, detail="Username already exists")
         
         # Hash password and create user
-        hashed_password = hash_password(password)
+        hashed_password = await hash_password_async(password)
         user_id = str(uuid.uuid4())
         
-        user = db.insert("users", {
+        user = await adb.insert("users", {
             "id": user_id,
             "username": username,
             "password_hash": hashed_password
         })
+        username_index.add(user or {"id": user_id, "username": username})
         
         # Create access token
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -80,8 +85,8 @@ async def login_user(user_data: dict):
             raise HTTPException(status_code=400, detail="Username and password required")
         
         # Get user from database
-        user = db.fetchone("users", {"username": username})
-        if not user or not verify_password(password, user["password_hash"]):
+        user = await adb.fetchone("users", {"username": username})
+        if not user or not await verify_password_async(password, user["password_hash"]):
             raise HTTPException(status_code=401, detail="Invalid credentials")
         
         # Create access token
@@ -109,9 +114,12 @@ async def verify_user_token(token: str):
         if not username:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        user = db.fetchone("users", {"username": username})
+        user = principal_cache.get(("username", username))
         if not user:
-            raise HTTPException(status_code=401, detail="User not found")
+            user = await adb.fetchone("users", {"username": username})
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            cache_principal(user)
         
         return {"id": user["id"], "username": user["username"]}
         
@@ -124,9 +132,12 @@ async def verify_user_token(token: str):
 async def get_user_by_id(user_id: str):
     """Get user by ID (for other services)"""
     try:
-        user = db.fetchone("users", {"id": user_id})
+        user = principal_cache.get(("id", user_id))
         if not user:
-            raise HTTPException(status_code=404, detail="User not found")
+            user = await adb.fetchone("users", {"id": user_id})
+            if not user:
+                raise HTTPException(status_code=404, detail="User not found")
+            cache_principal(user)
         
         return {"id": user["id"], "username": user["username"]}
         
@@ -147,12 +158,25 @@ async def store_user_keys(key_data: dict, authorization: str = Header(None)):
         if not username:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        # Store keys in database
-        db.insert("user_keys", {
+        user = principal_cache.get(("username", username))
+        if not user:
+            user = await adb.fetchone("users", {"username": username})
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            cache_principal(user)
+        
+        # Only the key owner may publish or replace their keys
+        if str(key_data.get("user_id")) != str(user["id"]):
+            raise HTTPException(status_code=403, detail="Cannot store keys for another user")
+        
+        # Store (or replace) keys in database
+        await adb.upsert("user_keys", {
             "user_id": key_data["user_id"],
             "kyber_public_key": key_data["kyber_public_key"],
             "mldsa_public_key": key_data["mldsa_public_key"]
-        })
+        }, on_conflict="user_id")
+        invalidate_user(user_id=key_data["user_id"])
+        stored_key_directory.invalidate(key_data["user_id"])
         
         return {"message": "Keys stored successfully"}
         
@@ -161,17 +185,42 @@ async def store_user_keys(key_data: dict, authorization: str = Header(None)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/keys/batch")
+async def get_user_keys_batch(request_data: dict):
+    """Get many users' public keys in one query: {"user_ids": [...], "known_etags": {user_id: etag}}"""
+    user_ids = list(dict.fromkeys(request_data.get("user_ids") or []))
+    if len(user_ids) > MAX_KEY_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_KEY_BATCH} user_ids per call")
+    try:
+        user_ids = [str(uuid.UUID(str(user_id))) for user_id in user_ids]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid user_id")
+    
+    try:
+        known_etags = request_data.get("known_etags") or {}
+        entries = await stored_key_directory.get_many(user_ids, known_etags)
+        return bundle_response(entries, known_etags)
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/keys/{user_id}")
-async def get_user_keys(user_id: str):
-    """Get user's public keys"""
+async def get_user_keys(user_id: str, response: Response, if_none_match: str = Header(None)):
+    """Get user's public keys (honours If-None-Match)"""
     try:
-        keys = db.fetchone("user_keys", {"user_id": user_id})
+        keys = await stored_key_directory.get(user_id, if_none_match)
         if not keys:
             raise HTTPException(status_code=404, detail="Keys not found")
         
+        headers = {"ETag": keys["etag"], "Cache-Control": "private, no-cache"}
+        if etag_matches(if_none_match, keys["etag"]):
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+        
         return {
             "kyber_public_key": keys["kyber_public_key"],
-            "mldsa_public_key": keys["mldsa_public_key"]
+            "mldsa_public_key": keys["mldsa_public_key"],
+            "etag": keys["etag"]
         }
         
     except HTTPException:
@@ -203,26 +252,29 @@ async def get_pending_contacts(authorization: str = Header(None)):
     return []
 
 @app.get("/users/search")
-async def search_users(q: str, authorization: str = Header(None)):
-    """Search users"""
+async def search_users(q: str, response: Response, limit: int = 10, cursor: str = None, authorization: str = Header(None)):
+    """Search users; the next page cursor is returned in the X-Next-Cursor header"""
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing token")
     
     if not q:
         return []
     
-    # Search users by username
-    all_users = db.fetchall("users", {})
-    matching_users = []
+    try:
+        offset = max(int(cursor), 0) if cursor else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     
-    for user in all_users:
-        if q.lower() in user['username'].lower():
-            matching_users.append({
-                "id": user['id'],
-                "username": user['username']
-            })
+    # Ranked prefix/trigram match from the in-memory index
+    matching_users, next_offset = await username_index.search(q, limit=min(max(limit, 1), 50), offset=offset)
+    if next_offset is not None:
+        response.headers["X-Next-Cursor"] = str(next_offset)
     
-    return matching_users[:10]  # Limit to 10 results
+    return [{"id": user['id'], "username": user['username']} for user in matching_users]
+
+@app.on_event("shutdown")
+async def close_database_pool():
+    await adb.close()
 
 if __name__ == "__main__":
     import uvicorn
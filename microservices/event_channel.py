@@ -0,0 +1,144 @@
+"""
+Persistent event channel from message-service to websocket-service
+
+Events are queued locally and streamed over one long-lived WebSocket in
+numbered batches. Several batches may be in flight; websocket-service acks
+them cumulatively. Unacked batches are resent after a reconnect and the
+server drops any sequence number it has already applied.
+"""
+import asyncio
+import json
+import os
+import uuid
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+import websockets
+
+from service_client import WEBSOCKET_SERVICE_URL
+
+EVENT_CHANNEL_URL = os.getenv(
+    "EVENT_CHANNEL_URL",
+    WEBSOCKET_SERVICE_URL.replace("http://", "ws://").replace("https://", "wss://") + "/events"
+)
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "64"))
+EVENT_BATCH_DELAY = float(os.getenv("EVENT_BATCH_DELAY", "0.005"))
+EVENT_MAX_IN_FLIGHT = int(os.getenv("EVENT_MAX_IN_FLIGHT", "8"))
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", "10000"))
+EVENT_RECONNECT_MAX = float(os.getenv("EVENT_RECONNECT_MAX", "5.0"))
+
+class EventChannel:
+    """Client side of the channel; publish() never waits on the network"""
+
+    def __init__(self, url: str = EVENT_CHANNEL_URL, buffer_size: int = EVENT_BUFFER_SIZE):
+        self.url = url
+        self.channel_id = uuid.uuid4().hex
+        self.pending: Deque[dict] = deque()
+        self.buffer_size = buffer_size
+        self.in_flight: Deque[Tuple[int, List[dict]]] = deque()
+        self.next_seq = 1
+        self.dropped = 0
+        self.sent = 0
+        self.reconnects = 0
+        self.connected = False
+        self._wakeup = asyncio.Event()
+        self._acked = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def publish(self, kind: str, recipient_id: str, data: dict):
+        """Queue an event; once the buffer is full the oldest unsent event is dropped"""
+        if len(self.pending) + self._in_flight_events() >= self.buffer_size:
+            if not self.pending:
+                self.dropped += 1
+                return
+            self.pending.popleft()
+            self.dropped += 1
+        self.pending.append({"kind": kind, "recipient_id": recipient_id, "data": data})
+        self._wakeup.set()
+
+    def _in_flight_events(self) -> int:
+        return sum(len(events) for _, events in self.in_flight)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.connected,
+            "pending": len(self.pending),
+            "in_flight": self._in_flight_events(),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "reconnects": self.reconnects
+        }
+
+    async def _run(self):
+        delay = 0.1
+        while True:
+            try:
+                async with websockets.connect(self.url) as ws:
+                    await ws.send(json.dumps({"channel": self.channel_id}))
+                    self.connected = True
+                    delay = 0.1
+                    # Unacked batches are resent with their original numbers
+                    for seq, events in list(self.in_flight):
+                        await ws.send(json.dumps({"seq": seq, "events": events}))
+                    reader = asyncio.create_task(self._read_acks(ws))
+                    try:
+                        await self._write_batches(ws, reader)
+                    finally:
+                        reader.cancel()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Event channel to {self.url} lost: {e}")
+
+            self.connected = False
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, EVENT_RECONNECT_MAX)
+
+    async def _write_batches(self, ws, reader: asyncio.Task):
+        while not reader.done():
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wait_for(self._wakeup, reader)
+                # Let a burst accumulate into one batch
+                await asyncio.sleep(EVENT_BATCH_DELAY)
+                continue
+            if len(self.in_flight) >= EVENT_MAX_IN_FLIGHT:
+                self._acked.clear()
+                await self._wait_for(self._acked, reader)
+                continue
+
+            events = [self.pending.popleft() for _ in range(min(EVENT_BATCH_SIZE, len(self.pending)))]
+            seq = self.next_seq
+            self.next_seq += 1
+            self.in_flight.append((seq, events))
+            await ws.send(json.dumps({"seq": seq, "events": events}))
+        # Surface the reader's error (or the close) to _run
+        reader.result()
+
+    async def _wait_for(self, event: asyncio.Event, reader: asyncio.Task):
+        waiter = asyncio.create_task(event.wait())
+        await asyncio.wait({waiter, reader}, return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+
+    async def _read_acks(self, ws):
+        async for raw in ws:
+            ack = json.loads(raw).get("ack", 0)
+            while self.in_flight and self.in_flight[0][0] <= ack:
+                _, events = self.in_flight.popleft()
+                self.sent += len(events)
+            self._acked.set()
+        raise ConnectionError("websocket-service closed the event channel")
@@ -0,0 +1,94 @@
+"""
+Versioned public key directory shared by services
+"""
+from shared_utils import adb, TTLCache
+from typing import Dict, Iterable, Optional
+import hashlib
+import os
+
+KEY_CACHE_TTL = float(os.getenv("KEY_CACHE_TTL", "300"))
+KEY_CACHE_SIZE = int(os.getenv("KEY_CACHE_SIZE", "10000"))
+
+def key_etag(kyber_public_key: Optional[str], mldsa_public_key: Optional[str]) -> str:
+    """Content hash of a user's public keys, quoted for use as an HTTP ETag"""
+    digest = hashlib.sha256(f"{kyber_public_key or ''}|{mldsa_public_key or ''}".encode('utf-8')).hexdigest()
+    return f'"{digest[:32]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """True if an If-None-Match header covers etag"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+def bundle_response(entries: Dict[str, Optional[dict]], known_etags: dict) -> dict:
+    """Batch key response; bundles whose etag the client already has are sent without keys"""
+    keys = []
+    for user_id, entry in entries.items():
+        if not entry:
+            continue
+        if known_etags.get(user_id) == entry["etag"]:
+            keys.append({"user_id": user_id, "etag": entry["etag"], "unchanged": True})
+        else:
+            keys.append(entry)
+    return {
+        "keys": keys,
+        "not_found": [user_id for user_id, entry in entries.items() if not entry]
+    }
+
+class KeyDirectory:
+    """Cache of public key bundles, each carrying a content-hash version (etag)
+    
+    Bundles are read from `table` where `column` equals the user id. Call
+    invalidate() whenever a user's keys are written; the TTL bounds how long
+    other workers can serve a replaced key. A cached bundle is never used to
+    tell a client its keys are unchanged: when its etag matches the client's,
+    it is re-read from the database first, since the keys may have been
+    rotated through another worker.
+    """
+    
+    def __init__(self, table: str, column: str):
+        self.table = table
+        self.column = column
+        self._entries = TTLCache(maxsize=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL)
+    
+    def _entry(self, row: dict) -> dict:
+        entry = {
+            "user_id": str(row[self.column]),
+            "kyber_public_key": row.get("kyber_public_key"),
+            "mldsa_public_key": row.get("mldsa_public_key"),
+            "etag": key_etag(row.get("kyber_public_key"), row.get("mldsa_public_key"))
+        }
+        if "username" in row:
+            entry["username"] = row["username"]
+        self._entries.set(entry["user_id"], entry)
+        return entry
+    
+    async def get(self, user_id: str, if_none_match: Optional[str] = None) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None or etag_matches(if_none_match, entry["etag"]):
+            row = await adb.fetchone(self.table, {self.column: user_id})
+            entry = self._entry(row) if row else None
+        return entry
+    
+    async def get_many(self, user_ids: Iterable[str], known_etags: Optional[dict] = None) -> Dict[str, Optional[dict]]:
+        """Bundles for many users; misses, and hits matching known_etags, are fetched with one query"""
+        user_ids = list(dict.fromkeys(user_ids))
+        known_etags = known_etags or {}
+        found = {user_id: self._entries.get(user_id) for user_id in user_ids}
+        missing = [
+            user_id for user_id, entry in found.items()
+            if entry is None or known_etags.get(user_id) == entry["etag"]
+        ]
+        if missing:
+            for row in await adb.fetch_in(self.table, self.column, missing):
+                entry = self._entry(row)
+                found[entry["user_id"]] = entry
+        return found
+    
+    def invalidate(self, user_id: str):
+        self._entries.pop(str(user_id))
+
+# Keys stored on users rows (key-exchange routes) and in user_keys (auth routes)
+user_key_directory = KeyDirectory("users", "id")
+stored_key_directory = KeyDirectory("user_keys", "user_id")
@@ -1,13 +1,18 @@
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
 import sys
 import os
-import requests
 import uuid
+import asyncio
+from typing import Dict, List, Optional
 
 # Import shared utilities
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from shared_utils import db, verify_token
+from service_client import (
+    AUTH_SERVICE_URL, ServiceUnavailable, get_service_client, close_service_clients
+)
+from event_channel import EventChannel
+from shared_utils import adb, message_writer, next_created_at, record_message, record_messages, record_contact, mark_read, verify_token, principal_cache, cache_principal, IdentityLoader, get_loader, encode_cursor, decode_cursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
 
 app = FastAPI(title="LockBox Message Service", version="1.0.0")
 
@@ -25,41 +30,59 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-AUTH_SERVICE_URL = "http://localhost:8001"
-WEBSOCKET_SERVICE_URL = "http://localhost:8003"
+auth_service = get_service_client(AUTH_SERVICE_URL)
+# Real-time events for websocket-service, streamed over one persistent connection
+events = EventChannel()
+
+def parse_page_bounds(before: Optional[str], after: Optional[str]):
+    """Resolve before/after cursors into keyset positions"""
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    try:
+        return decode_cursor(before), decode_cursor(after)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 async def get_current_user(authorization: str = Header(None)):
-    """Get current user by calling auth service"""
+    """Get current user, asking the auth service only on a principal cache miss"""
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing token")
     
     token = authorization.split(" ")[1]
     
+    # The token signature is checked locally, so a cached principal needs no network hop
+    username = verify_token(token)
+    if not username:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    cached = principal_cache.get(("username", username))
+    if cached:
+        return dict(cached)
+    
     try:
-        # Call auth service to verify token
-        response = requests.get(f"{AUTH_SERVICE_URL}/verify/{token}", timeout=5)
+        # Call auth service to resolve the user
+        response = await auth_service.get(f"/verify/{token}", timeout=5)
         if response.status_code != 200:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        return response.json()
-    except requests.RequestException:
-        # Fallback to local verification if auth service is down
-        username = verify_token(token)
-        if not username:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        user = db.fetchone("users", {"username": username})
+        user = response.json()
+    except ServiceUnavailable:
+        # Fallback to the database if auth service is down
+        user = await adb.fetchone("users", {"username": username})
         if not user:
             raise HTTPException(status_code=401, detail="User not found")
         
-        return {"id": user["id"], "username": user["username"]}
+        user = {"id": user["id"], "username": user["username"]}
+    
+    cache_principal(user)
+    return dict(user)
 
 @app.post("/send")
 async def send_message(message_data: dict, current_user = Depends(get_current_user)):
     """Store encrypted message"""
     try:
         # Verify recipient exists
-        recipient = db.fetchone("users", {"id": message_data["recipient_id"]})
+        recipient = await adb.fetchone("users", {"id": message_data["recipient_id"]})
         if not recipient:
             raise HTTPException(status_code=404, detail="Recipient not found")
         
@@ -70,7 +93,8 @@ async def send_message(message_data: dict, current_user = Depends(get_current_us
         message_id = str(uuid.uuid4())
         print(f"Attempting to store message: {message_id} from {current_user['id']} to {message_data['recipient_id']}")
         
-        result = db.insert("messages", {
+        # Group-committed with concurrent sends into one multi-row insert
+        result = await message_writer.insert({
             "id": message_id,
             "conversation_id": conversation_id,
             "sender_id": current_user['id'],
@@ -86,27 +110,33 @@ async def send_message(message_data: dict, current_user = Depends(get_current_us
         
         print(f"Message stored successfully: {result}")
         
+        # Keep both participants' contacts lists ordered by recency and count it as unread
+        unread_count = None
+        try:
+            unread_count = await record_message(current_user['id'], message_data["recipient_id"], message_id, result.get('created_at'))
+        except Exception as summary_error:
+            print(f"Conversation summary update failed: {summary_error}")
+        
         # Notify WebSocket service to broadcast message
         try:
             clean_content = message_data["encrypted_blob"].replace('encrypted_', '')
-            broadcast_data = {
-                "recipient_id": message_data["recipient_id"],
-                "message_data": {
-                    "id": message_id,
-                    "sender_id": current_user['id'],
-                    "content": clean_content,
-                    "sender": current_user['username'],
-                    "timestamp": "now",
-                    "isOwn": False,
-                    "isEncrypted": True,
-                    "status": "delivered"
-                }
-            }
-            
-            requests.post(f"{WEBSOCKET_SERVICE_URL}/broadcast", 
-                         json=broadcast_data, timeout=2)
-        except requests.RequestException:
-            print("WebSocket service unavailable - message stored but not broadcast")
+            events.publish("message", message_data["recipient_id"], {
+                "id": message_id,
+                "sender_id": current_user['id'],
+                "content": clean_content,
+                "sender": current_user['username'],
+                "timestamp": "now",
+                "isOwn": False,
+                "isEncrypted": True,
+                "status": "delivered"
+            })
+            if unread_count is not None:
+                events.publish("unread_count", message_data["recipient_id"], {
+                    "contact_id": current_user['id'],
+                    "unread_count": unread_count
+                })
+        except Exception as broadcast_error:
+            print(f"Broadcast failed - message stored but not broadcast: {broadcast_error}")
         
         return {
             "message": "Encrypted message stored successfully",
@@ -120,21 +150,180 @@ async def send_message(message_data: dict, current_user = Depends(get_current_us
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+MAX_SEND_BATCH = 100
+MESSAGE_FIELDS = ("recipient_id", "encrypted_blob", "signature", "sender_public_key")
+
+@app.post("/send-batch")
+async def send_messages(batch_data: dict, current_user = Depends(get_current_user), loader: IdentityLoader = Depends(get_loader)):
+    """Store many encrypted messages at once: {"messages": [...]}; results are per item, in order"""
+    items = batch_data.get("messages") or []
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="messages must be a list")
+    if len(items) > MAX_SEND_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SEND_BATCH} messages per batch")
+    
+    try:
+        results: List[dict] = [{} for _ in items]
+        recipient_of: Dict[int, str] = {}
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[index] = {"status": "error", "detail": "Each message must be an object"}
+                continue
+            missing = [field for field in MESSAGE_FIELDS if not item.get(field) or not isinstance(item[field], str)]
+            if missing:
+                results[index] = {"status": "error", "detail": f"Missing {', '.join(missing)}"}
+                continue
+            try:
+                recipient_of[index] = str(uuid.UUID(item["recipient_id"]))
+                if item.get("conversation_id"):
+                    uuid.UUID(str(item["conversation_id"]))
+            except ValueError:
+                results[index] = {"status": "error", "detail": "Invalid recipient_id or conversation_id"}
+        
+        # One query for every recipient
+        try:
+            recipients = await loader.users(set(recipient_of.values()))
+        except Exception as lookup_error:
+            # Not "Recipient not found": nothing was stored, so the whole batch can be resent
+            print(f"Recipient lookup failed: {lookup_error}")
+            raise HTTPException(
+                status_code=503,
+                detail="Could not check recipients, please retry",
+                headers={"Retry-After": "1"}
+            )
+        
+        rows = []
+        for index, item in enumerate(items):
+            if results[index]:
+                continue
+            if not recipients.get(recipient_of[index]):
+                results[index] = {"status": "error", "detail": "Recipient not found"}
+                continue
+            row = {
+                "id": str(uuid.uuid4()),
+                "conversation_id": str(item.get("conversation_id") or uuid.uuid4()),
+                "sender_id": current_user['id'],
+                "recipient_id": recipient_of[index],
+                "encrypted_blob": item["encrypted_blob"],
+                "signature": item["signature"],
+                "sender_public_key": item["sender_public_key"],
+                # One insert means one NOW() for every row, so stamp each in request order
+                "created_at": next_created_at()
+            }
+            rows.append(row)
+            results[index] = {"status": "stored", "message_id": row["id"], "conversation_id": row["conversation_id"]}
+        
+        if not rows:
+            return {"results": results}
+        
+        stored = {row["id"]: row for row in await adb.insert_many("messages", rows)}
+        
+        by_recipient: Dict[str, List[dict]] = {}
+        for row in rows:
+            by_recipient.setdefault(row["recipient_id"], []).append(row)
+        
+        unread_counts = {}
+        try:
+            unread_counts = await record_messages(current_user['id'], [
+                {
+                    "recipient_id": recipient_id,
+                    "message_id": sent[-1]["id"],
+                    "created_at": stored.get(sent[-1]["id"], {}).get("created_at"),
+                    "count": len(sent)
+                }
+                for recipient_id, sent in by_recipient.items()
+            ])
+        except Exception as summary_error:
+            print(f"Conversation summary update failed: {summary_error}")
+        
+        for recipient_id, sent in by_recipient.items():
+            for row in sent:
+                events.publish("message", recipient_id, {
+                    "id": row["id"],
+                    "sender_id": current_user['id'],
+                    "content": row["encrypted_blob"].replace('encrypted_', ''),
+                    "sender": current_user['username'],
+                    "timestamp": "now",
+                    "isOwn": False,
+                    "isEncrypted": True,
+                    "status": "delivered"
+                })
+            # One counter update per conversation, not per message
+            if recipient_id in unread_counts:
+                events.publish("unread_count", recipient_id, {
+                    "contact_id": current_user['id'],
+                    "unread_count": unread_counts[recipient_id]
+                })
+        
+        return {"results": results}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/read")
+async def mark_messages_read(read_data: dict, current_user = Depends(get_current_user)):
+    """Mark conversations read up to a message cursor: {"reads": [{"contact_id", "cursor"?}]}"""
+    try:
+        reads = read_data.get("reads") or []
+        if not isinstance(reads, list):
+            raise HTTPException(status_code=400, detail="reads must be a list")
+        if len(reads) > MAX_PAGE_SIZE:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_PAGE_SIZE} reads per call")
+        
+        watermarks = []
+        for item in reads:
+            if not isinstance(item, dict):
+                raise HTTPException(status_code=400, detail="Each read must be an object")
+            try:
+                watermark = {"contact_id": str(uuid.UUID(item.get("contact_id") or ""))}
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid contact_id")
+            if item.get("cursor"):
+                watermark["read_at"], _ = parse_page_bounds(item["cursor"], None)[0]
+            watermarks.append(watermark)
+        
+        counts = await mark_read(current_user['id'], watermarks) if watermarks else []
+        
+        # Keep the user's other devices in sync
+        for count in counts:
+            events.publish("unread_count", current_user['id'], count)
+        
+        return {"unread": counts}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/")
-async def get_messages(current_user = Depends(get_current_user)):
-    """Get user's messages (both sent and received)"""
+async def get_messages(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    current_user = Depends(get_current_user),
+    loader: IdentityLoader = Depends(get_loader)
+):
+    """Get a page of user's messages (both sent and received)"""
     try:
-        # Get all messages where user is sender OR recipient
-        all_messages = db.fetchall("messages", {})
-        user_messages = [
-            msg for msg in all_messages 
-            if msg.get('sender_id') == current_user['id'] or msg.get('recipient_id') == current_user['id']
-        ]
+        cursor_before, cursor_after = parse_page_bounds(before, after)
+        
+        # Messages where user is sender OR recipient, filtered by the database
+        user_messages = await adb.fetch_page(
+            "messages",
+            any_of=f"sender_id.eq.{current_user['id']},recipient_id.eq.{current_user['id']}",
+            before=cursor_before,
+            after=cursor_after,
+            limit=limit
+        )
+        
+        # Get sender info for the whole page in one query
+        senders = await loader.users(msg['sender_id'] for msg in user_messages)
         
         result = []
         for msg in user_messages:
-            # Get sender info
-            sender = db.fetchone("users", {"id": msg['sender_id']})
+            sender = senders.get(msg['sender_id'])
             sender_username = sender['username'] if sender else 'Unknown'
             
             result.append({
@@ -146,58 +335,84 @@ async def get_messages(current_user = Depends(get_current_user)):
                 "encrypted_blob": msg['encrypted_blob'],
                 "signature": msg['signature'],
                 "sender_public_key": msg['sender_public_key'],
-                "created_at": str(msg.get('created_at', ''))
+                "created_at": str(msg.get('created_at', '')),
+                "cursor": encode_cursor(msg)
             })
         
         return result
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/conversation/{contact_id}")
-async def get_conversation(contact_id: str, current_user = Depends(get_current_user)):
-    """Get conversation with specific contact"""
+async def get_conversation(
+    contact_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    current_user = Depends(get_current_user),
+    loader: IdentityLoader = Depends(get_loader)
+):
+    """Get a page of the conversation with specific contact"""
     try:
-        all_messages = db.fetchall("messages", {})
-        conversation_messages = [
-            msg for msg in all_messages 
-            if ((msg.get('sender_id') == current_user['id'] and msg.get('recipient_id') == contact_id) or
-                (msg.get('sender_id') == contact_id and msg.get('recipient_id') == current_user['id']))
-        ]
-        
-        conversation_messages.sort(key=lambda x: x.get('created_at', ''), reverse=False)
+        try:
+            contact_id = str(uuid.UUID(contact_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid contact_id")
+        cursor_before, cursor_after = parse_page_bounds(before, after)
+        
+        conversation_messages = await adb.fetch_page(
+            "messages",
+            any_of=(
+                f"and(sender_id.eq.{current_user['id']},recipient_id.eq.{contact_id}),"
+                f"and(sender_id.eq.{contact_id},recipient_id.eq.{current_user['id']})"
+            ),
+            before=cursor_before,
+            after=cursor_after,
+            limit=limit
+        )
+        
+        senders = await loader.users(msg['sender_id'] for msg in conversation_messages)
         
         result = []
         for msg in conversation_messages:
-            sender = db.fetchone("users", {"id": msg['sender_id']})
+            sender = senders.get(msg['sender_id'])
             sender_username = sender['username'] if sender else 'Unknown'
             
             result.append({
                 "id": msg['id'],
+                "conversation_id": msg['conversation_id'],
                 "sender_id": msg['sender_id'],
                 "sender_username": sender_username,
                 "recipient_id": msg['recipient_id'],
                 "encrypted_blob": msg['encrypted_blob'],
                 "signature": msg['signature'],
                 "sender_public_key": msg['sender_public_key'],
-                "created_at": str(msg.get('created_at', ''))
+                "created_at": str(msg.get('created_at', '')),
+                "cursor": encode_cursor(msg)
             })
         
         return result
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/chat-requests/incoming")
-async def get_incoming_chat_requests(current_user = Depends(get_current_user)):
+async def get_incoming_chat_requests(current_user = Depends(get_current_user), loader: IdentityLoader = Depends(get_loader)):
     """Get incoming chat requests from Supabase"""
     try:
-        requests = db.fetchall("chat_requests", {"to_user_id": current_user['id'], "status": "pending"})
+        requests = await adb.fetchall("chat_requests", {"to_user_id": current_user['id'], "status": "pending"})
+        
+        # Get sender info for all requests in one query
+        senders = await loader.users(req['from_user_id'] for req in requests)
         
         result = []
         for req in requests:
-            # Get sender info
-            sender = db.fetchone("users", {"id": req['from_user_id']})
+            sender = senders.get(req['from_user_id'])
             if sender:
                 result.append({
                     "id": req['id'],
@@ -215,33 +430,37 @@ async def get_incoming_chat_requests(current_user = Depends(get_current_user)):
 async def send_chat_request(request_data: dict, current_user = Depends(get_current_user)):
     """Send chat request to Supabase"""
     try:
-        # Verify recipient exists
-        recipient = db.fetchone("users", {"id": request_data["recipient_id"]})
+        # Verify recipient exists and check for existing requests/conversations
+        # in both directions; the lookups are independent so run them together
+        (
+            recipient,
+            existing_sent,
+            existing_received,
+            existing_conv1,
+            existing_conv2
+        ) = await asyncio.gather(
+            adb.fetchone("users", {"id": request_data["recipient_id"]}),
+            adb.fetchone("chat_requests", {
+                "from_user_id": current_user['id'],
+                "to_user_id": request_data["recipient_id"]
+            }),
+            adb.fetchone("chat_requests", {
+                "from_user_id": request_data["recipient_id"],
+                "to_user_id": current_user['id']
+            }),
+            adb.fetchone("conversations", {
+                "participant1_id": current_user['id'],
+                "participant2_id": request_data["recipient_id"]
+            }),
+            adb.fetchone("conversations", {
+                "participant1_id": request_data["recipient_id"],
+                "participant2_id": current_user['id']
+            })
+        )
+        
         if not recipient:
             raise HTTPException(status_code=404, detail="Recipient not found")
         
-        # Check if request already exists (check both directions and all statuses)
-        existing_sent = db.fetchone("chat_requests", {
-            "from_user_id": current_user['id'],
-            "to_user_id": request_data["recipient_id"]
-        })
-        
-        existing_received = db.fetchone("chat_requests", {
-            "from_user_id": request_data["recipient_id"],
-            "to_user_id": current_user['id']
-        })
-        
-        # Check if there's already an active conversation
-        existing_conv1 = db.fetchone("conversations", {
-            "participant1_id": current_user['id'],
-            "participant2_id": request_data["recipient_id"]
-        })
-        
-        existing_conv2 = db.fetchone("conversations", {
-            "participant1_id": request_data["recipient_id"],
-            "participant2_id": current_user['id']
-        })
-        
         if existing_sent and existing_sent.get('status') == 'pending':
             raise HTTPException(status_code=400, detail="Chat request already sent")
         
@@ -261,7 +480,7 @@ async def send_chat_request(request_data: dict, current_user = Depends(get_curre
             "status": "pending"
         }
         
-        chat_request = db.insert("chat_requests", chat_request_data)
+        chat_request = await adb.insert("chat_requests", chat_request_data)
         
         if not chat_request:
             print("ERROR: Chat request insert failed")
@@ -270,20 +489,12 @@ async def send_chat_request(request_data: dict, current_user = Depends(get_curre
         print(f"Chat request created successfully: {chat_request}")
         
         # Notify recipient via WebSocket
-        try:
-            notification_data = {
-                "recipient_id": request_data["recipient_id"],
-                "notification_data": {
-                    "type": "chat_request",
-                    "from_user_id": current_user['id'],
-                    "from_username": current_user['username'],
-                    "message": request_data.get("message", "Hi! I'd like to start a secure conversation with you.")
-                }
-            }
-            requests.post(f"{WEBSOCKET_SERVICE_URL}/notify", 
-                         json=notification_data, timeout=2)
-        except requests.RequestException:
-            print("WebSocket notification failed - request stored but not notified")
+        events.publish("notification", request_data["recipient_id"], {
+            "type": "chat_request",
+            "from_user_id": current_user['id'],
+            "from_username": current_user['username'],
+            "message": request_data.get("message", "Hi! I'd like to start a secure conversation with you.")
+        })
         
         return {"message": "Chat request sent successfully", "request_id": chat_request.get('id', 'unknown')}
         
@@ -300,7 +511,7 @@ async def respond_to_chat_request(response_data: dict, current_user = Depends(ge
         action = response_data["action"]  # "accept" or "decline"
         
         # Get the chat request
-        chat_request = db.fetchone("chat_requests", {"id": request_id})
+        chat_request = await adb.fetchone("chat_requests", {"id": request_id})
         if not chat_request:
             raise HTTPException(status_code=404, detail="Chat request not found")
         
@@ -310,14 +521,18 @@ async def respond_to_chat_request(response_data: dict, current_user = Depends(ge
         
         # Update request status in Supabase
         status = "accepted" if action == "accept" else "declined"
-        db.update("chat_requests", {"status": status}, {"id": request_id})
+        await adb.update("chat_requests", {"status": status}, {"id": request_id})
         
         # If accepted, create conversation
         if action == "accept":
-            conversation = db.insert("conversations", {
+            conversation = await adb.insert("conversations", {
                 "participant1_id": chat_request['from_user_id'],
                 "participant2_id": current_user['id']
             })
+            try:
+                await record_contact(current_user['id'], chat_request['from_user_id'])
+            except Exception as summary_error:
+                print(f"Conversation summary update failed: {summary_error}")
             return {"message": "Chat request accepted", "conversation_id": conversation['id']}
         
         return {"message": f"Chat request {status}"}
@@ -327,6 +542,26 @@ async def respond_to_chat_request(response_data: dict, current_user = Depends(ge
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.on_event("startup")
+async def open_event_channel():
+    events.start()
+
+@app.get("/write-stats")
+async def get_write_stats():
+    """Group-commit batch sizes and flush latency of message inserts"""
+    return message_writer.stats()
+
+@app.get("/events/stats")
+async def event_channel_stats():
+    """Event channel health: connection state, backlog, drops and reconnects"""
+    return events.stats()
+
+@app.on_event("shutdown")
+async def close_pools():
+    await events.close()
+    await adb.close()
+    await close_service_clients()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8002)
\ No newline at end of file
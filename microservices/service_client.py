@@ -0,0 +1,77 @@
+"""
+Async HTTP client for calls between microservices
+"""
+import asyncio
+import os
+from typing import Dict, Optional
+
+import httpx
+
+AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://localhost:8001")
+WEBSOCKET_SERVICE_URL = os.getenv("WEBSOCKET_SERVICE_URL", "http://localhost:8003")
+
+SERVICE_POOL_SIZE = int(os.getenv("SERVICE_POOL_SIZE", "20"))
+SERVICE_MAX_CONCURRENCY = int(os.getenv("SERVICE_MAX_CONCURRENCY", "100"))
+SERVICE_TIMEOUT = float(os.getenv("SERVICE_TIMEOUT", "2.0"))
+
+class ServiceUnavailable(Exception):
+    """Upstream service timed out, refused the connection or is saturated"""
+
+class ServiceClient:
+    """Keep-alive connection pool to one upstream service
+    
+    At most max_concurrency calls are in flight at once. Waiting for a slot
+    counts against the call's timeout, so a slow upstream fails fast instead
+    of piling up requests.
+    """
+    
+    def __init__(self, base_url: str, pool_size: int = SERVICE_POOL_SIZE,
+                 max_concurrency: int = SERVICE_MAX_CONCURRENCY, timeout: float = SERVICE_TIMEOUT):
+        self.base_url = base_url
+        self.timeout = timeout
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=60
+            )
+        )
+        self._slots = asyncio.Semaphore(max_concurrency)
+    
+    async def request(self, method: str, path: str, timeout: Optional[float] = None, **kwargs) -> httpx.Response:
+        timeout = timeout or self.timeout
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise ServiceUnavailable(f"{self.base_url} is saturated")
+        
+        try:
+            return await self._client.request(method, path, timeout=timeout, **kwargs)
+        except httpx.HTTPError as e:
+            raise ServiceUnavailable(f"{method} {self.base_url}{path} failed: {e}") from e
+        finally:
+            self._slots.release()
+    
+    async def get(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", path, **kwargs)
+    
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", path, **kwargs)
+    
+    async def close(self):
+        await self._client.aclose()
+
+_clients: Dict[str, ServiceClient] = {}
+
+def get_service_client(base_url: str) -> ServiceClient:
+    """Return the shared client (and pool) for an upstream base URL"""
+    if base_url not in _clients:
+        _clients[base_url] = ServiceClient(base_url)
+    return _clients[base_url]
+
+async def close_service_clients():
+    for client in list(_clients.values()):
+        await client.close()
+    _clients.clear()
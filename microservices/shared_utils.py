@@ -1,13 +1,25 @@
 """
 Shared utilities for microservices
 """
+import asyncio
 import bcrypt
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
 from jose import JWTError, jwt
-from datetime import datetime, timedelta
-from typing import Optional
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+from collections import OrderedDict
+import base64
+import hashlib
+import threading
+import time
 import os
+import re
+import uuid
 from dotenv import load_dotenv
 from supabase import create_client, Client
+from postgrest import AsyncPostgrestClient
+import httpx
 
 # Load environment variables
 load_dotenv()
@@ -27,6 +39,34 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
+# bcrypt releases the GIL, so a small thread pool runs hashes in parallel off the event loop.
+# Jobs beyond the queue limit are rejected with 503 instead of waiting behind a login burst.
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", "32"))
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+_password_jobs = 0  # queued + running, only touched from the event loop
+
+async def _run_password_job(func, *args):
+    global _password_jobs
+    if _password_jobs >= PASSWORD_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=503,
+            detail="Server busy, please retry",
+            headers={"Retry-After": "1"}
+        )
+    _password_jobs += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_executor, func, *args)
+    finally:
+        _password_jobs -= 1
+
+async def hash_password_async(password: str) -> str:
+    return await _run_password_job(hash_password, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await _run_password_job(verify_password, plain_password, hashed_password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -37,13 +77,130 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# Caching utilities
+class TTLCache:
+    """Bounded LRU mapping whose entries expire after a TTL (or a shorter per-entry one)"""
+    
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[1]
+    
+    def invalidate_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        with self._lock:
+            doomed = [key for key, (_, value) in self._data.items() if predicate(key, value)]
+            for key in doomed:
+                del self._data[key]
+            return len(doomed)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+# Resolved principals ({"id", "username", ...}) under ("username", ...) and ("id", ...) keys.
+# Per process, so other services/workers may see a changed row until the TTL runs out.
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+principal_cache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+
+def cache_principal(user: dict):
+    principal_cache.set(("username", user["username"]), user)
+    principal_cache.set(("id", str(user["id"])), user)
+
+def invalidate_user(user_id: Optional[str] = None, username: Optional[str] = None):
+    """Drop a cached principal; call whenever a user row or its keys change"""
+    principal_cache.invalidate_where(
+        lambda key, user: (user_id is not None and str(user["id"]) == str(user_id)) or
+                          (username is not None and user["username"] == username)
+    )
+
+# Already-verified tokens, keyed by SHA-256 of the token; entries never outlive the token's exp
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
 def verify_token(token: str) -> Optional[str]:
+    digest = hashlib.sha256(token.encode('utf-8')).digest()
+    username = token_cache.get(digest)
+    if username is not None:
+        return username
+    
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
-        return username
     except JWTError:
         return None
+    
+    if username:
+        exp = payload.get("exp")
+        token_cache.set(digest, username, ttl=exp - time.time() if exp is not None else None)
+    return username
+
+def token_cache_stats() -> dict:
+    return token_cache.stats()
+
+# Keyset pagination utilities
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# created_at is interpolated into a PostgREST filter, so only allow timestamp characters
+_TIMESTAMP_RE = re.compile(r"^[0-9T:.+\- ]+$")
+
+def encode_cursor(row: dict) -> str:
+    raw = f"{row.get('created_at', '')}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8')
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[str, str]]:
+    """Decode a cursor into (created_at, id), raising ValueError if malformed"""
+    if not cursor:
+        return None
+    created_at, row_id = base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8').split("|", 1)
+    if not _TIMESTAMP_RE.match(created_at):
+        raise ValueError("Invalid cursor timestamp")
+    return created_at, str(uuid.UUID(row_id))
 
 # Database connection
 class Database:
@@ -83,6 +240,19 @@ class Database:
             print(f"Database fetchall error: {e}")
             return []
     
+    def fetch_in(self, table: str, column: str, values, chunk_size: int = 150):
+        values = list(dict.fromkeys(v for v in values if v is not None))
+        rows = []
+        try:
+            # Chunk so the in.(...) filter stays well under URL length limits
+            for i in range(0, len(values), chunk_size):
+                result = self.client.table(table).select("*").in_(column, values[i:i + chunk_size]).execute()
+                rows.extend(result.data or [])
+            return rows
+        except Exception as e:
+            print(f"Database fetch_in error for {table}: {e}")
+            return rows
+    
     def insert(self, table: str, data: dict):
         try:
             print(f"Inserting into {table}: {data}")
@@ -108,6 +278,38 @@ class Database:
             print(f"Database update error: {e}")
             raise
     
+    def fetch_page(self, table: str, filters: dict = None, any_of: str = None,
+                   before: tuple = None, after: tuple = None, limit: int = 50):
+        """Fetch one page ordered by (created_at, id), oldest first"""
+        try:
+            query = self.client.table(table).select("*")
+            if filters:
+                for key, value in filters.items():
+                    query = query.eq(key, value)
+            if any_of:
+                query = query.or_(any_of)
+            
+            cursor = after or before
+            if cursor:
+                op = "gt" if after else "lt"
+                created_at, row_id = cursor
+                query = query.or_(
+                    f'created_at.{op}."{created_at}",'
+                    f'and(created_at.eq."{created_at}",id.{op}.{row_id})'
+                )
+            
+            # Walk backwards from the newest row unless paging forwards
+            descending = after is None
+            query = query.order("created_at", desc=descending).order("id", desc=descending)
+            result = query.limit(limit).execute()
+            rows = result.data or []
+            if descending:
+                rows.reverse()
+            return rows
+        except Exception as e:
+            print(f"Database fetch_page error: {e}")
+            return []
+    
     def delete(self, table: str, filters: dict):
         try:
             query = self.client.table(table).delete()
@@ -119,4 +321,375 @@ class Database:
             print(f"Database delete error: {e}")
             raise
 
-db = Database()
\ No newline at end of file
+# Keep-alive connections shared by all async queries in this service
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+
+class _PooledPostgrestClient(AsyncPostgrestClient):
+    def create_session(self, base_url, headers, timeout, *args, **kwargs):
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=DB_POOL_SIZE,
+                max_keepalive_connections=DB_POOL_SIZE,
+                keepalive_expiry=60
+            )
+        )
+
+class AsyncDatabase:
+    """Non-blocking Database over a pooled PostgREST client; safe to asyncio.gather"""
+    
+    def __init__(self):
+        self.supabase_url = os.getenv("SUPABASE_URL")
+        self.supabase_key = os.getenv("SUPABASE_KEY")
+        
+        if not self.supabase_url or not self.supabase_key:
+            raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY environment variables")
+        
+        self.client = _PooledPostgrestClient(
+            f"{self.supabase_url}/rest/v1",
+            headers={
+                "apikey": self.supabase_key,
+                "Authorization": f"Bearer {self.supabase_key}"
+            }
+        )
+    
+    async def fetchone(self, table: str, filters: dict = None):
+        try:
+            query = self.client.from_(table).select("*")
+            if filters:
+                for key, value in filters.items():
+                    query = query.eq(key, value)
+            result = await query.limit(1).execute()
+            return result.data[0] if result.data else None
+        except Exception as e:
+            print(f"Database fetchone error for {table}: {e}")
+            return None
+    
+    async def fetchall(self, table: str, filters: dict = None, order: str = None, desc: bool = False):
+        try:
+            query = self.client.from_(table).select("*")
+            if filters:
+                for key, value in filters.items():
+                    query = query.eq(key, value)
+            if order:
+                query = query.order(order, desc=desc)
+            result = await query.execute()
+            return result.data
+        except Exception as e:
+            print(f"Database fetchall error: {e}")
+            return []
+    
+    async def fetch_in(self, table: str, column: str, values, chunk_size: int = 150,
+                       raise_errors: bool = False):
+        values = list(dict.fromkeys(v for v in values if v is not None))
+        rows = []
+        try:
+            for i in range(0, len(values), chunk_size):
+                result = await self.client.from_(table).select("*").in_(column, values[i:i + chunk_size]).execute()
+                rows.extend(result.data or [])
+            return rows
+        except Exception as e:
+            print(f"Database fetch_in error for {table}: {e}")
+            if raise_errors:
+                raise
+            return rows
+    
+    async def fetch_page(self, table: str, filters: dict = None, any_of: str = None,
+                         before: tuple = None, after: tuple = None, limit: int = 50,
+                         raise_errors: bool = False):
+        try:
+            query = self.client.from_(table).select("*")
+            if filters:
+                for key, value in filters.items():
+                    query = query.eq(key, value)
+            if any_of:
+                query = query.or_(any_of)
+            
+            cursor = after or before
+            if cursor:
+                op = "gt" if after else "lt"
+                created_at, row_id = cursor
+                query = query.or_(
+                    f'created_at.{op}."{created_at}",'
+                    f'and(created_at.eq."{created_at}",id.{op}.{row_id})'
+                )
+            
+            descending = after is None
+            query = query.order("created_at", desc=descending).order("id", desc=descending)
+            result = await query.limit(limit).execute()
+            rows = result.data or []
+            if descending:
+                rows.reverse()
+            return rows
+        except Exception as e:
+            print(f"Database fetch_page error: {e}")
+            if raise_errors:
+                raise
+            return []
+    
+    async def insert(self, table: str, data: dict):
+        try:
+            result = await self.client.from_(table).insert(data).execute()
+            if not result.data:
+                print(f"WARNING: No data returned from insert to {table}")
+                return None
+            return result.data[0]
+        except Exception as e:
+            print(f"Database insert error for {table}: {e}")
+            raise
+    
+    async def insert_many(self, table: str, rows: list) -> list:
+        """Insert several rows in one statement; all or none are stored"""
+        try:
+            result = await self.client.from_(table).insert(rows).execute()
+            return result.data or []
+        except Exception as e:
+            print(f"Database insert error for {table}: {e}")
+            raise
+    
+    async def upsert(self, table: str, data, on_conflict: str):
+        try:
+            result = await self.client.from_(table).upsert(data, on_conflict=on_conflict).execute()
+            return result.data
+        except Exception as e:
+            print(f"Database upsert error for {table}: {e}")
+            raise
+    
+    async def rpc(self, function: str, params: dict):
+        try:
+            result = await self.client.rpc(function, params).execute()
+            return result.data
+        except Exception as e:
+            print(f"Database rpc error for {function}: {e}")
+            raise
+    
+    async def update(self, table: str, data: dict, filters: dict):
+        try:
+            query = self.client.from_(table).update(data)
+            for key, value in filters.items():
+                query = query.eq(key, value)
+            result = await query.execute()
+            return result.data[0] if result.data else None
+        except Exception as e:
+            print(f"Database update error: {e}")
+            raise
+    
+    async def delete(self, table: str, filters: dict):
+        try:
+            query = self.client.from_(table).delete()
+            for key, value in filters.items():
+                query = query.eq(key, value)
+            result = await query.execute()
+            return result.data
+        except Exception as e:
+            print(f"Database delete error: {e}")
+            raise
+    
+    async def close(self):
+        await self.client.aclose()
+
+db = Database()
+adb = AsyncDatabase()
+
+# Group-committed inserts: a batch is written when it reaches MESSAGE_BATCH_SIZE
+# rows or its first row has waited MESSAGE_BATCH_DELAY_MS, whichever comes first
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "100"))
+MESSAGE_BATCH_DELAY_MS = float(os.getenv("MESSAGE_BATCH_DELAY_MS", "5"))
+
+_last_created_us = 0
+
+def next_created_at() -> str:
+    """created_at for a new message, strictly increasing within this process
+    
+    Rows stored by one multi-row insert would otherwise all get the same
+    transaction NOW(), leaving their history order to the random id.
+    """
+    global _last_created_us
+    _last_created_us = max(time.time_ns() // 1000, _last_created_us + 1)
+    seconds, micros = divmod(_last_created_us, 1_000_000)
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(microsecond=micros).isoformat()
+
+def _is_duplicate_key(error: Exception) -> bool:
+    """True for a unique-violation error from PostgREST"""
+    return getattr(error, "code", None) == "23505" or "duplicate key" in str(error)
+
+class GroupCommitWriter:
+    """Coalesces concurrent single-row inserts into multi-row inserts
+    
+    insert() returns only once the caller's own row is stored, and raises if
+    storing that row failed, just like adb.insert. If a batch is rejected the
+    rows are retried one by one, so one bad row cannot fail its neighbours; a
+    retried row that turns out to be stored already counts as stored.
+    """
+    
+    def __init__(self, table: str, max_batch: int = MESSAGE_BATCH_SIZE,
+                 max_delay_ms: float = MESSAGE_BATCH_DELAY_MS, key: str = "id"):
+        self.table = table
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.key = key
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Running flushes; the loop only holds weak references to tasks
+        self._flushes: Set[asyncio.Task] = set()
+        # Stats for tuning the window
+        self.batches = 0
+        self.rows = 0
+        self.max_batch_seen = 0
+        self.fallbacks = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+    
+    async def insert(self, row: dict) -> dict:
+        # Stamped on arrival so rows sharing a batch keep their send order
+        if not row.get("created_at"):
+            row["created_at"] = next_created_at()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future))
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._start_flush)
+        return await future
+    
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+    
+    async def _flush(self, batch: List[Tuple[dict, asyncio.Future]]):
+        started = time.perf_counter()
+        try:
+            stored = await adb.insert_many(self.table, [row for row, _ in batch])
+            by_key = {row.get(self.key): row for row in stored}
+            for row, future in batch:
+                if not future.done():
+                    future.set_result(by_key.get(row.get(self.key)))
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+            else:
+                self.fallbacks += 1
+                await asyncio.gather(*(self._insert_one(row, future) for row, future in batch))
+        finally:
+            elapsed = time.perf_counter() - started
+            self.batches += 1
+            self.rows += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            self.flush_seconds += elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+    
+    async def _insert_one(self, row: dict, future: asyncio.Future):
+        try:
+            result = await adb.insert(self.table, row)
+        except Exception as e:
+            # The failed batch may have committed after all (e.g. a timeout on the
+            # response); our ids are freshly generated, so a clash means it did
+            result = await adb.fetchone(self.table, {self.key: row.get(self.key)}) if _is_duplicate_key(e) else None
+            if result is None:
+                if not future.done():
+                    future.set_exception(e)
+                return
+        if not future.done():
+            future.set_result(result)
+    
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "rows": self.rows,
+            "avg_batch_size": round(self.rows / self.batches, 2) if self.batches else 0,
+            "max_batch_size": self.max_batch_seen,
+            "fallbacks": self.fallbacks,
+            "avg_flush_ms": round(self.flush_seconds / self.batches * 1000, 2) if self.batches else 0,
+            "max_flush_ms": round(self.max_flush_seconds * 1000, 2),
+            "pending": len(self._pending),
+            "max_batch": self.max_batch,
+            "max_delay_ms": self.max_delay * 1000
+        }
+
+message_writer = GroupCommitWriter("messages")
+
+# Conversation summaries (see securechat-app-backend/create_conversation_summaries.sql)
+def _utcnow() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+async def record_message(sender_id: str, recipient_id: str, message_id: str, created_at: Optional[str] = None) -> Optional[int]:
+    """Move a conversation to the top of both contacts lists; returns the recipient's unread count
+    
+    Only accepted contacts have summaries, so this returns None for anyone else.
+    """
+    return await adb.rpc("record_message_summary", {
+        "p_sender_id": sender_id,
+        "p_recipient_id": recipient_id,
+        "p_message_id": message_id,
+        "p_created_at": created_at or _utcnow()
+    })
+
+async def record_messages(sender_id: str, items: list) -> Dict[str, int]:
+    """record_message for a batch: one item per recipient with its latest message and a count"""
+    rows = await adb.rpc("record_message_summaries", {"p_sender_id": sender_id, "p_items": items}) or []
+    return {row["recipient_id"]: row["unread_count"] for row in rows}
+
+async def record_contact(user_id: str, contact_id: str):
+    """Add an accepted contact to both users' summaries"""
+    now = _utcnow()
+    await adb.upsert("conversation_summaries", [
+        {"user_id": user_id, "contact_id": contact_id, "last_activity_at": now},
+        {"user_id": contact_id, "contact_id": user_id, "last_activity_at": now}
+    ], on_conflict="user_id,contact_id")
+
+async def mark_read(user_id: str, reads: list) -> list:
+    """Advance read watermarks ({"contact_id", "read_at"?}); returns [{"contact_id", "unread_count"}]"""
+    return await adb.rpc("mark_conversations_read", {"p_user_id": user_id, "p_reads": reads}) or []
+
+class IdentityLoader:
+    """Request-scoped batch loader: one in_-filtered query per table, with an identity map"""
+    
+    def __init__(self, database=None):
+        self.db = database or adb
+        self._rows: Dict[Tuple[str, str], Dict[str, Optional[dict]]] = {}
+        self._pending: Dict[Tuple[str, str], Set[str]] = {}
+    
+    def queue(self, table: str, ids: Iterable[str], column: str = "id"):
+        known = self._rows.setdefault((table, column), {})
+        pending = self._pending.setdefault((table, column), set())
+        pending.update(i for i in ids if i is not None and i not in known)
+    
+    async def resolve(self, table: str, column: str = "id"):
+        pending = self._pending.pop((table, column), set())
+        if not pending:
+            return
+        known = self._rows.setdefault((table, column), {})
+        # A failed query must not be remembered as "no such row"
+        for row in await self.db.fetch_in(table, column, pending, raise_errors=True):
+            known[str(row[column])] = row
+        for missing in pending - known.keys():
+            known[missing] = None
+    
+    async def load_many(self, table: str, ids: Iterable[str], column: str = "id") -> Dict[str, Optional[dict]]:
+        ids = list(ids)
+        self.queue(table, ids, column)
+        await self.resolve(table, column)
+        known = self._rows[(table, column)]
+        return {i: known.get(i) for i in ids if i is not None}
+    
+    async def get(self, table: str, id_value: str, column: str = "id") -> Optional[dict]:
+        return (await self.load_many(table, [id_value], column)).get(id_value)
+    
+    async def users(self, ids: Iterable[str]) -> Dict[str, Optional[dict]]:
+        return await self.load_many("users", ids)
+    
+    async def user_keys(self, user_ids: Iterable[str]) -> Dict[str, Optional[dict]]:
+        return await self.load_many("user_keys", user_ids, column="user_id")
+
+def get_loader() -> IdentityLoader:
+    """FastAPI dependency providing a fresh loader per request"""
+    return IdentityLoader()
\ No newline at end of file
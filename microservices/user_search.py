@@ -0,0 +1,148 @@
+"""
+In-memory username search index shared by services
+"""
+from shared_utils import adb, TTLCache
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+import bisect
+import os
+import time
+
+SEARCH_REFRESH_SECONDS = float(os.getenv("SEARCH_REFRESH_SECONDS", "30"))
+SEARCH_MAX_CANDIDATES = 1000
+SEARCH_LOAD_BATCH = 1000
+
+# Keyset position before any user, so loading pages forwards from the oldest row
+_EPOCH = ("1970-01-01T00:00:00+00:00", "00000000-0000-0000-0000-000000000000")
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class UsernameIndex:
+    """In-memory username index: a sorted list for prefixes plus trigram postings for substrings
+    
+    Loaded from the users table on first search and then topped up incrementally
+    (users created after the newest loaded row), so registrations handled by other
+    workers appear within SEARCH_REFRESH_SECONDS. Users registered by this worker
+    are added immediately via add().
+    """
+    
+    def __init__(self):
+        self._names: List[Tuple[str, str]] = []  # sorted (lowercase username, user id)
+        self._users: Dict[str, dict] = {}
+        self._postings: Dict[str, Set[str]] = defaultdict(set)
+        self._results = TTLCache(maxsize=1024, ttl=SEARCH_REFRESH_SECONDS)  # hot queries
+        self._watermark: tuple = _EPOCH  # (created_at, id) of the newest loaded row
+        self._refreshed_at = 0.0
+        self._loaded = False
+        self._lock = asyncio.Lock()
+    
+    def _index(self, user: dict) -> Optional[Tuple[str, str]]:
+        """Record user's postings; returns its (name, id) entry, or None if already indexed"""
+        user_id = str(user["id"])
+        if user_id in self._users:
+            return None
+        name = user["username"].lower()
+        for trigram in _trigrams(name):
+            self._postings[trigram].add(user_id)
+        self._users[user_id] = {
+            "id": user_id,
+            "username": user["username"],
+            "created_at": user.get("created_at")
+        }
+        return (name, user_id)
+    
+    def add(self, user: dict):
+        entry = self._index(user)
+        if entry:
+            bisect.insort(self._names, entry)
+            self._results.clear()
+    
+    def add_many(self, users: List[dict]):
+        """Index a page of users, re-sorting once rather than inserting each"""
+        entries = [entry for entry in map(self._index, users) if entry]
+        if entries:
+            self._names.extend(entries)
+            self._names.sort()
+            self._results.clear()
+    
+    async def refresh(self, force: bool = False):
+        """Load users created since the last refresh"""
+        if not force and self._loaded and time.monotonic() - self._refreshed_at < SEARCH_REFRESH_SECONDS:
+            return
+        async with self._lock:
+            if not force and self._loaded and time.monotonic() - self._refreshed_at < SEARCH_REFRESH_SECONDS:
+                return
+            try:
+                while True:
+                    rows = await adb.fetch_page("users", after=self._watermark, limit=SEARCH_LOAD_BATCH,
+                                                raise_errors=True)
+                    self.add_many(rows)
+                    if rows:
+                        self._watermark = (str(rows[-1]["created_at"]), str(rows[-1]["id"]))
+                    if len(rows) < SEARCH_LOAD_BATCH:
+                        break
+            except Exception as e:
+                # Not marked loaded, so searches fall back to the database until a load succeeds
+                print(f"Username index refresh failed: {e}")
+                return
+            self._loaded = True
+            self._refreshed_at = time.monotonic()
+    
+    def _rank(self, q: str) -> List[str]:
+        cached = self._results.get(q)
+        if cached is not None:
+            return cached
+        
+        if len(q) >= 3:
+            # Every trigram of q must appear in the username; intersect smallest postings first
+            postings = sorted((self._postings.get(t, set()) for t in _trigrams(q)), key=len)
+            candidates = set.intersection(*postings) if postings else set()
+            matches = [
+                (name, user_id) for user_id in candidates
+                for name in (self._users[user_id]["username"].lower(),)
+                if q in name
+            ]
+        else:
+            # Too short for trigrams: prefix matches only
+            start = bisect.bisect_left(self._names, (q, ""))
+            matches = []
+            for name, user_id in self._names[start:start + SEARCH_MAX_CANDIDATES]:
+                if not name.startswith(q):
+                    break
+                matches.append((name, user_id))
+        
+        # Exact match, then prefix, then earliest substring; shorter names first
+        matches.sort(key=lambda m: (m[0] != q, not m[0].startswith(q), m[0].find(q), len(m[0]), m[0]))
+        ranked = [user_id for _, user_id in matches[:SEARCH_MAX_CANDIDATES]]
+        self._results.set(q, ranked)
+        return ranked
+    
+    async def search(self, q: str, limit: int = 10, offset: int = 0,
+                     exclude_id: Optional[str] = None) -> Tuple[List[dict], Optional[int]]:
+        """Ranked matches for q; returns (users, next offset or None)"""
+        await self.refresh()
+        if not self._loaded:
+            return await self._search_database(q.lower(), limit, offset, exclude_id)
+        ranked = [user_id for user_id in self._rank(q.lower()) if user_id != exclude_id]
+        page = ranked[offset:offset + limit]
+        next_offset = offset + limit if offset + limit < len(ranked) else None
+        return [self._users[user_id] for user_id in page], next_offset
+
+    async def _search_database(self, q: str, limit: int, offset: int,
+                               exclude_id: Optional[str]) -> Tuple[List[dict], Optional[int]]:
+        """Unranked substring match straight from the users table, used while the index is unavailable"""
+        matches = [
+            user for user in await adb.fetchall("users", {})
+            if q in user['username'].lower() and str(user['id']) != exclude_id
+        ]
+        page = matches[offset:offset + limit]
+        next_offset = offset + limit if offset + limit < len(matches) else None
+        return [
+            {"id": str(user['id']), "username": user['username'], "created_at": user.get('created_at')}
+            for user in page
+        ], next_offset
+
+# Global index
+username_index = UsernameIndex()
@@ -3,7 +3,13 @@ from fastapi.middleware.cors import CORSMiddleware
 import sys
 import os
 import json
-from typing import Dict, List
+import asyncio
+import itertools
+import math
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Hashable, List, Optional, Set, Tuple
 
 # Add parent directory to path
 sys.path.append(os.path.join(os.path.dirname(__file__), '../../securechat-app-backend'))
@@ -24,59 +30,289 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outbound events buffered per socket before it is treated as a slow consumer
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+
+# Clients ping every 30s; a socket silent for WS_IDLE_TIMEOUT is reaped.
+# Half-open sockets are caught earlier by uvicorn's protocol pings (ws_ping_interval).
+IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "90"))
+REAP_TICK = float(os.getenv("WS_REAP_TICK", "1"))
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20"))
+
+# Clients send exactly this text; match it without parsing JSON
+PING_FRAME = json.dumps({"type": "ping"}, separators=(",", ":"))
+PONG_FRAME = json.dumps({"type": "pong"})
+
+# Recent events kept per user so a reconnecting client can resume
+OUTBOX_SIZE = int(os.getenv("WS_OUTBOX_SIZE", "256"))
+OUTBOX_TTL = float(os.getenv("WS_OUTBOX_TTL", "3600"))
+OUTBOX_USERS = int(os.getenv("WS_OUTBOX_USERS", "10000"))
+
+# Seeded from the clock so sequence numbers keep increasing across restarts
+_sequence = itertools.count(time.time_ns() // 1000)
+# Names this process in event cursors, so a cursor from another one is never matched
+NODE_ID = uuid.uuid4().hex
+
+class Outbox:
+    """Bounded log of one user's recent events, keyed by sequence number"""
+    
+    def __init__(self, size: int = OUTBOX_SIZE):
+        self.events: Deque[Tuple[int, str]] = deque(maxlen=size)
+        # Every event with seq <= floor is either absent or already forgotten
+        self.floor = next(_sequence)
+    
+    def append(self, seq: int, payload: str):
+        if len(self.events) == self.events.maxlen:
+            self.floor = self.events[0][0]
+        self.events.append((seq, payload))
+    
+    def since(self, cursor: int) -> Optional[List[str]]:
+        """Payloads after cursor, or None if some of them were already dropped"""
+        if cursor < self.floor:
+            return None
+        return [payload for seq, payload in self.events if seq > cursor]
+
+class TTLCache:
+    """Bounded LRU mapping whose entries expire ttl seconds after their last set()
+    
+    Expired entries are dropped lazily on access and when the cache is full.
+    """
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+    
+    def get(self, key: Hashable, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if entry[0] <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return entry[1]
+    
+    def set(self, key: Hashable, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def __len__(self) -> int:
+        return len(self._data)
+
+class TimerWheel:
+    """Hashed timing wheel of deadlines
+    
+    A key lives in the slot for its deadline's tick. advance() only visits the
+    slots that ticked past, so its cost is the number of keys falling due, not
+    the number scheduled. Deadlines further out than one revolution are kept
+    and revisited each revolution until they are due.
+    """
+    
+    def __init__(self, tick: float, span: float, now: float):
+        self.tick = tick
+        self.slots: List[Set[Hashable]] = [set() for _ in range(math.ceil(span / tick) + 1)]
+        # key -> (deadline, slot index)
+        self.entries: Dict[Hashable, Tuple[float, int]] = {}
+        self.current = self._tick_of(now)
+    
+    def _tick_of(self, when: float) -> int:
+        return int(when // self.tick)
+    
+    def schedule(self, key: Hashable, deadline: float):
+        self.cancel(key)
+        # First tick at or after the deadline, never a slot already swept
+        index = max(math.ceil(deadline / self.tick), self.current + 1) % len(self.slots)
+        self.entries[key] = (deadline, index)
+        self.slots[index].add(key)
+    
+    def cancel(self, key: Hashable):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.slots[entry[1]].discard(key)
+    
+    def advance(self, now: float) -> List[Hashable]:
+        """Pop every key whose deadline is at or before now"""
+        due = []
+        target = self._tick_of(now)
+        # After a long stall one revolution covers every slot
+        steps = min(target - self.current, len(self.slots))
+        for step in range(1, steps + 1):
+            slot = self.slots[(self.current + step) % len(self.slots)]
+            for key in [k for k in slot if self.entries[k][0] <= now]:
+                slot.discard(key)
+                del self.entries[key]
+                due.append(key)
+        self.current = max(self.current, target)
+        return due
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+
+class Connection:
+    """One WebSocket with a bounded outbound queue drained by its own writer task"""
+    
+    def __init__(self, websocket: WebSocket, user_id: str, manager: "ConnectionManager"):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.manager = manager
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.writer = asyncio.create_task(self._drain())
+        self.last_seen = time.monotonic()
+    
+    def touch(self):
+        """Record inbound activity; the reaper checks it lazily when the timer fires"""
+        self.last_seen = time.monotonic()
+    
+    def enqueue(self, payload: str) -> bool:
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            return False
+    
+    async def _drain(self):
+        try:
+            while True:
+                payload = await self.queue.get()
+                await self.websocket.send_text(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Failed to send to user {self.user_id}: {e}")
+            self.manager.disconnect(self.websocket, self.user_id)
+    
+    async def close(self, code: int = 1000):
+        self.writer.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+        self.active_connections: Dict[str, List[Connection]] = {}
+        self.evicted_slow_consumers = 0
+        # Least recently used outboxes are dropped first, idle ones after OUTBOX_TTL
+        self.outboxes = TTLCache(maxsize=OUTBOX_USERS, ttl=OUTBOX_TTL)
+        # Idle deadlines of every connection
+        self.idle_timers = TimerWheel(REAP_TICK, IDLE_TIMEOUT, time.monotonic())
+        self.reaped_idle_connections = 0
+
+    async def reap_idle(self):
+        while True:
+            await asyncio.sleep(REAP_TICK)
+            now = time.monotonic()
+            for connection in self.idle_timers.advance(now):
+                deadline = connection.last_seen + IDLE_TIMEOUT
+                if deadline > now:
+                    # Heard from since it was scheduled: push the timer out
+                    self.idle_timers.schedule(connection, deadline)
+                    continue
+                print(f"Reaping idle WebSocket for user {connection.user_id}")
+                self.reaped_idle_connections += 1
+                self.disconnect(connection.websocket, connection.user_id)
+                # 1001: going away
+                asyncio.create_task(connection.close(code=1001))
+
+    def idle_connections(self) -> int:
+        """Connections that missed at least one client ping interval"""
+        now = time.monotonic()
+        return sum(1 for conns in self.active_connections.values() for c in conns
+                   if now - c.last_seen > IDLE_TIMEOUT / 3)
 
-    async def connect(self, websocket: WebSocket, user_id: str):
+    async def connect(self, websocket: WebSocket, user_id: str, resume_from: Optional[str] = None) -> Connection:
+        """Accept and track a WebSocket
+        
+        With resume_from (the "cursor" of the last event the client saw),
+        events the user missed since are queued first. If the cursor came
+        from another process, or the events are no longer all kept, the
+        client is told to do a full sync instead.
+        """
         await websocket.accept()
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = []
-        self.active_connections[user_id].append(websocket)
+        connection = Connection(websocket, user_id, self)
+        self.idle_timers.schedule(connection, connection.last_seen + IDLE_TIMEOUT)
+        self.active_connections.setdefault(user_id, []).append(connection)
         print(f"User {user_id} connected via WebSocket")
+        if resume_from is not None:
+            node_id, _, seq = resume_from.rpartition(":")
+            outbox = self.outboxes.get(user_id) if node_id == NODE_ID and seq.isdigit() else None
+            missed = outbox.since(int(seq)) if outbox else None
+            if missed is None or len(missed) >= SEND_QUEUE_SIZE:
+                connection.enqueue(json.dumps({"type": "sync_required"}))
+            else:
+                for payload in missed:
+                    connection.enqueue(payload)
+        return connection
 
     def disconnect(self, websocket: WebSocket, user_id: str):
-        if user_id in self.active_connections:
-            self.active_connections[user_id].remove(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
-        print(f"User {user_id} disconnected from WebSocket")
+        connections = self.active_connections.get(user_id, [])
+        for connection in [c for c in connections if c.websocket is websocket]:
+            connections.remove(connection)
+            connection.writer.cancel()
+            self.idle_timers.cancel(connection)
+            print(f"User {user_id} disconnected from WebSocket")
+        if user_id in self.active_connections and not connections:
+            del self.active_connections[user_id]
+
+    def _evict(self, connection: Connection):
+        print(f"Evicting slow WebSocket consumer for user {connection.user_id}")
+        self.evicted_slow_consumers += 1
+        self.disconnect(connection.websocket, connection.user_id)
+        # 1013: try again later
+        asyncio.create_task(connection.close(code=1013))
 
     async def send_to_user(self, user_id: str, message: dict):
-        if user_id in self.active_connections:
-            for connection in self.active_connections[user_id]:
-                try:
-                    await connection.send_text(json.dumps(message))
-                    print(f"Message sent to user {user_id}: {message}")
-                except Exception as e:
-                    print(f"Failed to send to user {user_id}: {e}")
-                    try:
-                        self.active_connections[user_id].remove(connection)
-                    except ValueError:
-                        pass
+        """Serialize once and queue on every connection of the user; never waits on a client
+        
+        Every event for a user with sockets or an outbox here gets a "cursor"
+        and is kept in the outbox, so it can be replayed even if the user is
+        offline right now. Users who never connected get no outbox: no
+        cursor of theirs could need it.
+        """
+        outbox = self.outboxes.get(user_id)
+        if outbox is None:
+            if user_id not in self.active_connections:
+                return
+            outbox = Outbox()
+        seq = next(_sequence)
+        # Same "<node id>:<seq>" cursor the backend issues
+        message = {**message, "cursor": f"{NODE_ID}:{seq}"}
+        payload = json.dumps(message)
+        outbox.append(seq, payload)
+        self.outboxes.set(user_id, outbox)
+        
+        for connection in list(self.active_connections.get(user_id, [])):
+            if not connection.enqueue(payload):
+                self._evict(connection)
 
     async def broadcast_new_message(self, recipient_id: str, message_data: dict):
         await self.send_to_user(recipient_id, {
             "type": "new_message",
             "data": message_data
         })
-        print(f"Broadcasting message to user {recipient_id}")
 
 manager = ConnectionManager()
 
+@app.on_event("startup")
+async def start_idle_reaper():
+    asyncio.create_task(manager.reap_idle())
+
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str, token: str = None):
+async def websocket_endpoint(websocket: WebSocket, user_id: str, token: str = None, resume_from: Optional[str] = None):
     """WebSocket endpoint for real-time messaging"""
-    await manager.connect(websocket, user_id)
+    connection = await manager.connect(websocket, user_id, resume_from)
     
     try:
         while True:
             data = await websocket.receive_text()
-            message = json.loads(data)
+            connection.touch()
             
             # Handle ping/pong
-            if message.get("type") == "ping":
-                await websocket.send_text(json.dumps({"type": "pong"}))
+            if data == PING_FRAME or json.loads(data).get("type") == "ping":
+                connection.enqueue(PONG_FRAME)
                 
     except WebSocketDisconnect:
         manager.disconnect(websocket, user_id)
@@ -84,6 +320,70 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, token: str = No
         print(f"WebSocket error for user {user_id}: {e}")
         manager.disconnect(websocket, user_id)
 
+# Last batch applied per message-service event channel, to drop resent batches.
+# Kept EVENT_CHANNEL_TTL seconds after a channel disconnects so a reconnect can resend.
+EVENT_CHANNEL_TTL = float(os.getenv("EVENT_CHANNEL_TTL", "600"))
+event_channel_seqs: Dict[str, int] = {}
+event_channel_closed_at: Dict[str, float] = {}
+event_channel_sockets: Dict[str, int] = {}
+
+def prune_event_channels():
+    cutoff = time.monotonic() - EVENT_CHANNEL_TTL
+    for channel_id in [c for c, closed_at in event_channel_closed_at.items() if closed_at < cutoff]:
+        del event_channel_closed_at[channel_id]
+        event_channel_seqs.pop(channel_id, None)
+
+async def dispatch_event(kind: str, recipient_id: str, data: dict):
+    if kind == "message":
+        await manager.broadcast_new_message(recipient_id, data)
+    elif kind == "unread_count":
+        await manager.send_to_user(recipient_id, {
+            "type": "unread_count",
+            "data": data
+        })
+    elif kind == "notification":
+        await manager.send_to_user(recipient_id, {
+            "type": "notification",
+            "data": data
+        })
+
+@app.websocket("/events")
+async def event_channel(websocket: WebSocket):
+    """Long-lived batched event stream from message-service; every batch is acked
+    
+    An event that fails to dispatch is logged and dropped, so one bad event
+    cannot hold back the batches behind it.
+    """
+    await websocket.accept()
+    channel_id = None
+    try:
+        channel_id = json.loads(await websocket.receive_text())["channel"]
+        event_channel_sockets[channel_id] = event_channel_sockets.get(channel_id, 0) + 1
+        event_channel_closed_at.pop(channel_id, None)
+        prune_event_channels()
+        while True:
+            batch = json.loads(await websocket.receive_text())
+            seq = batch["seq"]
+            if seq > event_channel_seqs.get(channel_id, 0):
+                for event in batch["events"]:
+                    try:
+                        await dispatch_event(event["kind"], event["recipient_id"], event["data"])
+                    except Exception as e:
+                        print(f"Dropping event from channel {channel_id}: {e}")
+                event_channel_seqs[channel_id] = seq
+            await websocket.send_text(json.dumps({"ack": seq}))
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"Event channel error: {e}")
+    finally:
+        if channel_id is not None:
+            event_channel_sockets[channel_id] -= 1
+            # A reconnect may already be open on a new socket
+            if not event_channel_sockets[channel_id]:
+                del event_channel_sockets[channel_id]
+                event_channel_closed_at[channel_id] = time.monotonic()
+
 @app.post("/broadcast")
 async def broadcast_message(broadcast_data: dict):
     """Broadcast message to specific user (called by message service)"""
@@ -91,7 +391,7 @@ async def broadcast_message(broadcast_data: dict):
         recipient_id = broadcast_data["recipient_id"]
         message_data = broadcast_data["message_data"]
         
-        await manager.broadcast_new_message(recipient_id, message_data)
+        await dispatch_event("message", recipient_id, message_data)
         
         return {"message": "Broadcast sent successfully"}
         
@@ -105,10 +405,7 @@ async def send_notification(notification_data: dict):
         recipient_id = notification_data["recipient_id"]
         notification = notification_data["notification_data"]
         
-        await manager.send_to_user(recipient_id, {
-            "type": "notification",
-            "data": notification
-        })
+        await dispatch_event("notification", recipient_id, notification)
         
         return {"message": "Notification sent successfully"}
         
@@ -120,9 +417,13 @@ async def get_active_connections():
     """Get active WebSocket connections (for debugging)"""
     return {
         "active_users": list(manager.active_connections.keys()),
-        "total_connections": sum(len(conns) for conns in manager.active_connections.values())
+        "total_connections": sum(len(conns) for conns in manager.active_connections.values()),
+        "evicted_slow_consumers": manager.evicted_slow_consumers,
+        "idle_connections": manager.idle_connections(),
+        "reaped_idle_connections": manager.reaped_idle_connections
     }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8003)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8003,
+                ws_ping_interval=WS_PING_INTERVAL, ws_ping_timeout=WS_PING_INTERVAL)
\ No newline at end of file
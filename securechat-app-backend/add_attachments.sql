@@ -0,0 +1,5 @@
+-- Let messages reference attachments held in the attachment store
+-- Required before any message is sent with attachment_ids; plain messages work without it.
+-- Attachment bytes live outside the database; only their content-addressed ids are stored here.
+ALTER TABLE messages
+ADD COLUMN IF NOT EXISTS attachment_ids TEXT[];
@@ -0,0 +1,44 @@
+-- Record a batch of sent messages from one sender in a single call
+-- Requires add_read_watermarks.sql
+-- p_items: [{"recipient_id": "...", "message_id": "...", "created_at": "...", "count": n}], one per
+-- recipient, naming that recipient's latest message and how many messages the batch sent them.
+-- Like record_message_summary, only existing summaries (accepted contacts) are updated, and the
+-- latest message never moves backwards.
+-- Returns the new unread count of each recipient that is a contact.
+CREATE OR REPLACE FUNCTION record_message_summaries(p_sender_id UUID, p_items JSONB)
+RETURNS TABLE (recipient_id UUID, unread_count INTEGER) AS $$
+#variable_conflict use_column
+DECLARE
+    r JSONB;
+    v_recipient UUID;
+    v_message UUID;
+    v_created_at TIMESTAMP WITH TIME ZONE;
+BEGIN
+    FOR r IN SELECT * FROM jsonb_array_elements(p_items) LOOP
+        v_recipient := (r->>'recipient_id')::UUID;
+        v_message := (r->>'message_id')::UUID;
+        v_created_at := COALESCE((r->>'created_at')::TIMESTAMP WITH TIME ZONE, NOW());
+
+        UPDATE conversation_summaries s
+        SET last_message_id = CASE
+                WHEN s.last_message_at IS NULL OR v_created_at > s.last_message_at THEN v_message
+                ELSE s.last_message_id
+            END,
+            last_message_at = GREATEST(s.last_message_at, v_created_at),
+            last_activity_at = GREATEST(s.last_activity_at, v_created_at)
+        WHERE s.user_id = p_sender_id AND s.contact_id = v_recipient;
+
+        RETURN QUERY
+        UPDATE conversation_summaries s
+        SET last_message_id = CASE
+                WHEN s.last_message_at IS NULL OR v_created_at > s.last_message_at THEN v_message
+                ELSE s.last_message_id
+            END,
+            last_message_at = GREATEST(s.last_message_at, v_created_at),
+            last_activity_at = GREATEST(s.last_activity_at, v_created_at),
+            unread_count = s.unread_count + COALESCE((r->>'count')::INTEGER, 1)
+        WHERE s.user_id = v_recipient AND s.contact_id = p_sender_id
+        RETURNING s.user_id, s.unread_count;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,5 @@
+-- Composite indexes for keyset-paginated message history
+-- Pages are ordered by (created_at, id) and filtered by participant or conversation
+CREATE INDEX IF NOT EXISTS idx_messages_sender_page ON messages(sender_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_recipient_page ON messages(recipient_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_conversation_page ON messages(conversation_id, created_at DESC, id DESC);
@@ -0,0 +1,81 @@
+-- Per-user read watermarks and unread counters on conversation summaries
+-- Requires create_conversation_summaries.sql
+ALTER TABLE conversation_summaries
+ADD COLUMN IF NOT EXISTS unread_count INTEGER NOT NULL DEFAULT 0,
+ADD COLUMN IF NOT EXISTS last_read_at TIMESTAMP WITH TIME ZONE;
+
+-- Record a sent message: bump both summaries and the recipient's unread counter atomically.
+-- Only existing summaries (accepted contacts) are updated; a message never adds a contact.
+-- Messages may commit out of created_at order, so the latest message never moves backwards.
+-- Returns the recipient's new unread count, or NULL when the pair are not contacts.
+CREATE OR REPLACE FUNCTION record_message_summary(
+    p_sender_id UUID, p_recipient_id UUID, p_message_id UUID, p_created_at TIMESTAMP WITH TIME ZONE
+) RETURNS INTEGER AS $$
+DECLARE
+    v_unread INTEGER;
+BEGIN
+    UPDATE conversation_summaries
+    SET last_message_id = CASE
+            WHEN last_message_at IS NULL OR p_created_at > last_message_at THEN p_message_id
+            ELSE last_message_id
+        END,
+        last_message_at = GREATEST(last_message_at, p_created_at),
+        last_activity_at = GREATEST(last_activity_at, p_created_at)
+    WHERE user_id = p_sender_id AND contact_id = p_recipient_id;
+
+    UPDATE conversation_summaries
+    SET last_message_id = CASE
+            WHEN last_message_at IS NULL OR p_created_at > last_message_at THEN p_message_id
+            ELSE last_message_id
+        END,
+        last_message_at = GREATEST(last_message_at, p_created_at),
+        last_activity_at = GREATEST(last_activity_at, p_created_at),
+        unread_count = unread_count + 1
+    WHERE user_id = p_recipient_id AND contact_id = p_sender_id
+    RETURNING unread_count INTO v_unread;
+
+    RETURN v_unread;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Advance read watermarks for a batch of conversations.
+-- p_reads: [{"contact_id": "...", "read_at": "..."}]; a missing read_at means "read everything".
+-- Watermarks never move backwards. Only messages after the watermark are counted, and only
+-- when the watermark is older than the latest message.
+CREATE OR REPLACE FUNCTION mark_conversations_read(p_user_id UUID, p_reads JSONB)
+RETURNS TABLE (contact_id UUID, unread_count INTEGER) AS $$
+#variable_conflict use_column
+DECLARE
+    r JSONB;
+    v_contact UUID;
+    v_read_at TIMESTAMP WITH TIME ZONE;
+    v_watermark TIMESTAMP WITH TIME ZONE;
+BEGIN
+    FOR r IN SELECT * FROM jsonb_array_elements(p_reads) LOOP
+        v_contact := (r->>'contact_id')::UUID;
+        v_read_at := COALESCE((r->>'read_at')::TIMESTAMP WITH TIME ZONE, 'infinity');
+
+        SELECT GREATEST(s.last_read_at, LEAST(v_read_at, COALESCE(s.last_message_at, NOW())))
+        INTO v_watermark
+        FROM conversation_summaries s
+        WHERE s.user_id = p_user_id AND s.contact_id = v_contact;
+
+        IF NOT FOUND THEN
+            CONTINUE;
+        END IF;
+
+        RETURN QUERY
+        UPDATE conversation_summaries s
+        SET last_read_at = v_watermark,
+            unread_count = CASE
+                WHEN s.last_message_at IS NULL OR v_watermark >= s.last_message_at THEN 0
+                ELSE (
+                    SELECT COUNT(*)::INTEGER FROM messages m
+                    WHERE m.sender_id = v_contact AND m.recipient_id = p_user_id AND m.created_at > v_watermark
+                )
+            END
+        WHERE s.user_id = p_user_id AND s.contact_id = v_contact
+        RETURNING s.contact_id, s.unread_count;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
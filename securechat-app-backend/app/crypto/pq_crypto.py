@@ -7,7 +7,10 @@ import os
 import json
 import base64
 import hashlib
-from typing import Tuple, Dict, Optional
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, Dict, Optional, List, Sequence
 
 try:
     import oqs
@@ -15,6 +18,38 @@ try:
 except ImportError:
     LIBOQS_AVAILABLE = False
 
+# Batch verification fans out to this many processes; batches smaller than
+# MLDSA_PARALLEL_MIN are verified in the calling thread
+MLDSA_VERIFY_WORKERS = int(os.getenv("MLDSA_VERIFY_WORKERS", str(os.cpu_count() or 1)))
+MLDSA_PARALLEL_MIN = int(os.getenv("MLDSA_PARALLEL_MIN", "64"))
+
+_local = threading.local()
+
+def _signature_handle(alg: str):
+    """This thread's verifier for alg; verification takes the public key per call, so one handle serves every key"""
+    handles = getattr(_local, "signatures", None)
+    if handles is None:
+        handles = _local.signatures = {}
+    if alg not in handles:
+        handles[alg] = oqs.Signature(alg)
+    return handles[alg]
+
+def _verify_many(alg: str, items: Sequence[Tuple[bytes, str, str]]) -> List[bool]:
+    """Verify (message, signature_b64, public_key_b64) items with liboqs; also runs inside pool workers"""
+    verifier = _signature_handle(alg)
+    # Batches usually repeat a few senders' keys, so decode each key once
+    public_keys: Dict[str, bytes] = {}
+    results = []
+    for message, signature_b64, public_key_b64 in items:
+        try:
+            public_key = public_keys.get(public_key_b64)
+            if public_key is None:
+                public_key = public_keys[public_key_b64] = base64.b64decode(public_key_b64)
+            results.append(bool(verifier.verify(message, base64.b64decode(signature_b64), public_key)))
+        except Exception:
+            results.append(False)
+    return results
+
 class PostQuantumCrypto:
     """Post-quantum cryptography using liboqs with Kyber-1024 and ML-DSA-87"""
     
@@ -22,6 +57,8 @@ class PostQuantumCrypto:
         # Use NIST Level 5 algorithms for maximum security
         self.kyber_alg = "Kyber1024"
         self.mldsa_alg = "ML-DSA-87"
+        self._verify_pool: Optional[ProcessPoolExecutor] = None
+        self._verify_pool_lock = threading.Lock()
         
     def generate_kyber_keypair(self) -> Tuple[str, str]:
         """Generate Kyber-1024 key pair for KEM"""
@@ -118,7 +155,7 @@ class PostQuantumCrypto:
         """ML-DSA signature verification"""
         if LIBOQS_AVAILABLE:
             try:
-                sig = oqs.Signature(self.mldsa_alg)
+                sig = _signature_handle(self.mldsa_alg)
                 public_key = base64.b64decode(public_key_b64)
                 signature = base64.b64decode(signature_b64)
                 
@@ -129,6 +166,49 @@ class PostQuantumCrypto:
         else:
             return self._simulate_mldsa_verify(message, signature_b64, public_key_b64)
     
+    def mldsa_verify_batch(self, items: Sequence[Tuple[bytes, str, str]]) -> List[bool]:
+        """ML-DSA verification of many (message, signature_b64, public_key_b64) items
+        
+        Returns one result per item, in order; malformed items verify as False.
+        Large batches are split across a process pool. This blocks, so async
+        callers should run it in a thread.
+        """
+        items = list(items)
+        if not LIBOQS_AVAILABLE:
+            return [self._simulate_mldsa_verify(*item) for item in items]
+        if MLDSA_VERIFY_WORKERS <= 1 or len(items) < MLDSA_PARALLEL_MIN:
+            return _verify_many(self.mldsa_alg, items)
+        
+        # A few chunks per worker so one slow chunk doesn't leave the others idle
+        size = max(MLDSA_PARALLEL_MIN // 4, -(-len(items) // (MLDSA_VERIFY_WORKERS * 4)))
+        chunks = [items[i:i + size] for i in range(0, len(items), size)]
+        try:
+            results: List[bool] = []
+            for chunk_results in self._pool().map(_verify_many, [self.mldsa_alg] * len(chunks), chunks):
+                results.extend(chunk_results)
+            return results
+        except Exception as e:
+            print(f"ML-DSA verification pool failed, verifying inline: {e}")
+            self.close()
+            return _verify_many(self.mldsa_alg, items)
+    
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._verify_pool_lock:
+            if self._verify_pool is None:
+                # spawn, not fork: the server process has an event loop and threads running
+                self._verify_pool = ProcessPoolExecutor(
+                    max_workers=MLDSA_VERIFY_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._verify_pool
+    
+    def close(self):
+        """Shut down the verification pool (started again on the next large batch)"""
+        with self._verify_pool_lock:
+            pool, self._verify_pool = self._verify_pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    
     # Simulation methods with correct key sizes from liboqs spec
     def _simulate_kyber_keypair(self) -> Tuple[str, str]:
         """Simulate Kyber-1024 with correct key sizes"""
@@ -1,4 +1,6 @@
 from supabase import create_client, Client
+from postgrest import AsyncPostgrestClient
+import httpx
 import os
 from dotenv import load_dotenv
 
@@ -41,6 +43,20 @@ class Database:
             print(f"Database fetchall error: {e}")
             return []
     
+    def fetch_in(self, table: str, column: str, values, chunk_size: int = 150):
+        """Fetch all rows whose column matches any of the given values"""
+        values = list(dict.fromkeys(v for v in values if v is not None))
+        rows = []
+        try:
+            # Chunk so the in.(...) filter stays well under URL length limits
+            for i in range(0, len(values), chunk_size):
+                result = self.client.table(table).select("*").in_(column, values[i:i + chunk_size]).execute()
+                rows.extend(result.data or [])
+            return rows
+        except Exception as e:
+            print(f"Database fetch_in error: {e}")
+            return rows
+    
     def insert(self, table: str, data: dict):
         """Insert data into table"""
         try:
@@ -61,6 +77,240 @@ class Database:
         except Exception as e:
             print(f"Database update error: {e}")
             raise
+    
+    def fetch_page(self, table: str, filters: dict = None, any_of: str = None,
+                   before: tuple = None, after: tuple = None, limit: int = 50):
+        """Fetch one page of rows ordered by (created_at, id) using a keyset cursor
+        
+        `any_of` is a PostgREST or-filter body, `before`/`after` are (created_at, id)
+        positions. Rows always come back oldest first.
+        """
+        try:
+            query = self.client.table(table).select("*")
+            if filters:
+                for key, value in filters.items():
+                    query = query.eq(key, value)
+            if any_of:
+                query = query.or_(any_of)
+            
+            cursor = after or before
+            if cursor:
+                op = "gt" if after else "lt"
+                created_at, row_id = cursor
+                query = query.or_(
+                    f'created_at.{op}."{created_at}",'
+                    f'and(created_at.eq."{created_at}",id.{op}.{row_id})'
+                )
+            
+            # Walk backwards from the newest row unless paging forwards
+            descending = after is None
+            query = query.order("created_at", desc=descending).order("id", desc=descending)
+            result = query.limit(limit).execute()
+            rows = result.data or []
+            if descending:
+                rows.reverse()
+            return rows
+        except Exception as e:
+            print(f"Database fetch_page error: {e}")
+            return []
+
+# Keep-alive connections shared by all async queries in this worker
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+
+class _PooledPostgrestClient(AsyncPostgrestClient):
+    """PostgREST client whose session keeps a bounded pool of keep-alive connections"""
+    
+    def create_session(self, base_url, headers, timeout, *args, **kwargs):
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=DB_POOL_SIZE,
+                max_keepalive_connections=DB_POOL_SIZE,
+                keepalive_expiry=60
+            )
+        )
+
+class AsyncDatabase:
+    """Non-blocking counterpart of Database for use inside async handlers
+    
+    Queries go straight to PostgREST over one shared httpx pool, so they never
+    block the event loop and independent queries can run concurrently with
+    asyncio.gather.
+    """
+    
+    def __init__(self):
+        self.supabase_url = os.getenv("SUPABASE_URL")
+        self.supabase_key = os.getenv("SUPABASE_KEY")
+        
+        if not self.supabase_url or not self.supabase_key:
+            raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY environment variables")
+        
+        self.client = _PooledPostgrestClient(
+            f"{self.supabase_url}/rest/v1",
+            headers={
+                "apikey": self.supabase_key,
+                "Authorization": f"Bearer {self.supabase_key}"
+            }
+        )
+    
+    async def fetchone(self, table: str, filters: dict = None):
+        """Fetch one row from table"""
+        try:
+            query = self.client.from_(table).select("*")
+            if filters:
+                for key, value in filters.items():
+                    query = query.eq(key, value)
+            result = await query.limit(1).execute()
+            return result.data[0] if result.data else None
+        except Exception as e:
+            print(f"Database fetchone error: {e}")
+            return None
+    
+    async def fetchall(self, table: str, filters: dict = None, order: str = None, desc: bool = False):
+        """Fetch all rows from table, optionally ordered by a column"""
+        try:
+            query = self.client.from_(table).select("*")
+            if filters:
+                for key, value in filters.items():
+                    query = query.eq(key, value)
+            if order:
+                query = query.order(order, desc=desc)
+            result = await query.execute()
+            return result.data
+        except Exception as e:
+            print(f"Database fetchall error: {e}")
+            return []
+    
+    async def fetch_in(self, table: str, column: str, values, chunk_size: int = 150,
+                       raise_errors: bool = False):
+        """Fetch all rows whose column matches any of the given values
+        
+        Errors are logged and give the rows fetched so far unless raise_errors,
+        for callers that must tell a failure from a missing row.
+        """
+        values = list(dict.fromkeys(v for v in values if v is not None))
+        rows = []
+        try:
+            for i in range(0, len(values), chunk_size):
+                result = await self.client.from_(table).select("*").in_(column, values[i:i + chunk_size]).execute()
+                rows.extend(result.data or [])
+            return rows
+        except Exception as e:
+            print(f"Database fetch_in error: {e}")
+            if raise_errors:
+                raise
+            return rows
+    
+    async def fetch_page(self, table: str, filters: dict = None, any_of: str = None,
+                         before: tuple = None, after: tuple = None, limit: int = 50,
+                         raise_errors: bool = False):
+        """Fetch one page of rows ordered by (created_at, id), oldest first
+        
+        Errors are logged and give [] unless raise_errors, for callers that
+        must tell a failure from the end of the data.
+        """
+        try:
+            query = self.client.from_(table).select("*")
+            if filters:
+                for key, value in filters.items():
+                    query = query.eq(key, value)
+            if any_of:
+                query = query.or_(any_of)
+            
+            cursor = after or before
+            if cursor:
+                op = "gt" if after else "lt"
+                created_at, row_id = cursor
+                query = query.or_(
+                    f'created_at.{op}."{created_at}",'
+                    f'and(created_at.eq."{created_at}",id.{op}.{row_id})'
+                )
+            
+            descending = after is None
+            query = query.order("created_at", desc=descending).order("id", desc=descending)
+            result = await query.limit(limit).execute()
+            rows = result.data or []
+            if descending:
+                rows.reverse()
+            return rows
+        except Exception as e:
+            print(f"Database fetch_page error: {e}")
+            if raise_errors:
+                raise
+            return []
+    
+    async def insert(self, table: str, data: dict):
+        """Insert data into table"""
+        try:
+            result = await self.client.from_(table).insert(data).execute()
+            return result.data[0] if result.data else None
+        except Exception as e:
+            print(f"Database insert error: {e}")
+            raise
+    
+    async def insert_many(self, table: str, rows: list) -> list:
+        """Insert several rows in one statement; all or none are stored
+        
+        Rows may name different columns; a column missing from a row is stored
+        as NULL there, since one statement needs the same keys on every row.
+        """
+        columns = dict.fromkeys(key for row in rows for key in row)
+        rows = [{key: row.get(key) for key in columns} for row in rows]
+        try:
+            result = await self.client.from_(table).insert(rows).execute()
+            return result.data or []
+        except Exception as e:
+            print(f"Database insert error: {e}")
+            raise
+    
+    async def upsert(self, table: str, data, on_conflict: str):
+        """Insert rows, updating the given columns where on_conflict keys already exist"""
+        try:
+            result = await self.client.from_(table).upsert(data, on_conflict=on_conflict).execute()
+            return result.data
+        except Exception as e:
+            print(f"Database upsert error: {e}")
+            raise
+    
+    async def rpc(self, function: str, params: dict):
+        """Call a Postgres function through PostgREST"""
+        try:
+            result = await self.client.rpc(function, params).execute()
+            return result.data
+        except Exception as e:
+            print(f"Database rpc error: {e}")
+            raise
+    
+    async def update(self, table: str, data: dict, filters: dict):
+        """Update data in table"""
+        try:
+            query = self.client.from_(table).update(data)
+            for key, value in filters.items():
+                query = query.eq(key, value)
+            result = await query.execute()
+            return result.data[0] if result.data else None
+        except Exception as e:
+            print(f"Database update error: {e}")
+            raise
+    
+    async def delete(self, table: str, filters: dict):
+        """Delete rows from table"""
+        try:
+            query = self.client.from_(table).delete()
+            for key, value in filters.items():
+                query = query.eq(key, value)
+            result = await query.execute()
+            return result.data
+        except Exception as e:
+            print(f"Database delete error: {e}")
+            raise
+    
+    async def close(self):
+        """Close pooled connections"""
+        await self.client.aclose()
 
-# Global database instance
-db = Database()
\ No newline at end of file
+# Global database instances
+db = Database()
+adb = AsyncDatabase()
\ No newline at end of file
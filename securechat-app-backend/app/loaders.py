@@ -0,0 +1,56 @@
+from app.database import adb
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+class IdentityLoader:
+    """Request-scoped batch loader with an identity map for lookups by key
+    
+    Handlers queue every id they need, then resolve them with one
+    in_-filtered query per (table, column). Ids already seen in this
+    request, including ones that matched no row, are not fetched again.
+    Database errors propagate instead of being recorded as missing rows.
+    """
+    
+    def __init__(self, database=None):
+        self.db = database or adb
+        self._rows: Dict[Tuple[str, str], Dict[str, Optional[dict]]] = {}
+        self._pending: Dict[Tuple[str, str], Set[str]] = {}
+    
+    def queue(self, table: str, ids: Iterable[str], column: str = "id"):
+        """Collect ids to be fetched on the next resolve"""
+        known = self._rows.setdefault((table, column), {})
+        pending = self._pending.setdefault((table, column), set())
+        pending.update(i for i in ids if i is not None and i not in known)
+    
+    async def resolve(self, table: str, column: str = "id"):
+        """Fetch all queued ids for a table in one round trip"""
+        pending = self._pending.pop((table, column), set())
+        if not pending:
+            return
+        known = self._rows.setdefault((table, column), {})
+        # A failed query must not be remembered as "no such row"
+        for row in await self.db.fetch_in(table, column, pending, raise_errors=True):
+            known[str(row[column])] = row
+        for missing in pending - known.keys():
+            known[missing] = None
+    
+    async def load_many(self, table: str, ids: Iterable[str], column: str = "id") -> Dict[str, Optional[dict]]:
+        """Queue, resolve and return a mapping of id -> row (None if not found)"""
+        ids = list(ids)
+        self.queue(table, ids, column)
+        await self.resolve(table, column)
+        known = self._rows[(table, column)]
+        return {i: known.get(i) for i in ids if i is not None}
+    
+    async def get(self, table: str, id_value: str, column: str = "id") -> Optional[dict]:
+        """Return a single row, fetching it only if not already loaded"""
+        return (await self.load_many(table, [id_value], column)).get(id_value)
+    
+    async def users(self, ids: Iterable[str]) -> Dict[str, Optional[dict]]:
+        return await self.load_many("users", ids)
+    
+    async def user_keys(self, user_ids: Iterable[str]) -> Dict[str, Optional[dict]]:
+        return await self.load_many("user_keys", user_ids, column="user_id")
+
+def get_loader() -> IdentityLoader:
+    """FastAPI dependency providing a fresh loader per request"""
+    return IdentityLoader()
@@ -8,6 +8,11 @@ from app.routes.contacts import router as contacts_router
 from app.routes.crypto_keys import router as crypto_router
 from app.routes.websocket import router as websocket_router
 from app.routes.key_exchange import router as key_exchange_router
+from app.routes.attachments import router as attachments_router
+from app.database import adb
+from app.websocket_manager import manager
+from app.crypto.pq_crypto import pq_crypto
+from app.services.keypair_pool import keypair_pool
 
 app = FastAPI(title="LockBox API")
 
@@ -28,6 +33,31 @@ app.include_router(contacts_router)
 app.include_router(crypto_router)
 app.include_router(websocket_router)
 app.include_router(key_exchange_router)
+app.include_router(attachments_router)
+
+@app.on_event("startup")
+async def start_pubsub():
+    await manager.start()
+
+@app.on_event("startup")
+async def start_keypair_pool():
+    keypair_pool.start()
+
+@app.on_event("shutdown")
+async def close_database_pool():
+    await adb.close()
+
+@app.on_event("shutdown")
+async def stop_pubsub():
+    await manager.stop()
+
+@app.on_event("shutdown")
+async def close_verify_pool():
+    pq_crypto.close()
+
+@app.on_event("shutdown")
+async def stop_keypair_pool():
+    await keypair_pool.stop()
 
 @app.get("/")
 def read_root():
@@ -1,26 +1,149 @@
 from fastapi import HTTPException, Request
-from collections import defaultdict
+from app.database import adb
+from typing import Dict, Optional
+import ipaddress
+import math
+import os
+import threading
 import time
-from typing import Dict
 
-class RateLimiter:
+# "memory" limits per worker; "postgres" shares limits through create_rate_limits.sql
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+# Only these peers (the nginx gateway) may set X-Forwarded-For
+TRUSTED_PROXIES = {
+    ip.strip() for ip in os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "127.0.0.1,::1").split(",") if ip.strip()
+}
+EVICT_INTERVAL = float(os.getenv("RATE_LIMIT_EVICT_INTERVAL", "60"))
+
+class RatePolicy:
+    """max_requests per window_seconds, keyed per user when known, else per client IP"""
+
+    def __init__(self, max_requests: int, window_seconds: float, per_user: bool = True):
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.per_user = per_user
+        # GCRA: one request is earned every `emission` seconds and up to
+        # max_requests may arrive back to back
+        self.emission = window_seconds / max_requests
+        self.tolerance = window_seconds - self.emission
+
+def _parse_policies(spec: str) -> Dict[str, RatePolicy]:
+    """RATE_LIMIT_POLICIES="users.search=20/60,auth.login=10/60" overrides route defaults"""
+    policies = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        scope, _, limit = item.partition("=")
+        max_requests, _, window = limit.partition("/")
+        policies[scope.strip()] = RatePolicy(int(max_requests), float(window or 60))
+    return policies
+
+POLICY_OVERRIDES = _parse_policies(os.getenv("RATE_LIMIT_POLICIES", ""))
+
+def client_ip(request: Request) -> str:
+    """Address of the real client: the last X-Forwarded-For hop not added by a trusted proxy"""
+    peer = request.client.host if request.client else "unknown"
+    if peer not in TRUSTED_PROXIES:
+        return peer
+
+    forwarded = request.headers.get("x-forwarded-for", "")
+    for hop in reversed([part.strip() for part in forwarded.split(",") if part.strip()]):
+        try:
+            ipaddress.ip_address(hop)
+        except ValueError:
+            break
+        if hop not in TRUSTED_PROXIES:
+            return hop
+    return peer
+
+class MemoryBackend:
+    """One float (the theoretical arrival time) per key"""
+
     def __init__(self):
-        self.requests: Dict[str, list] = defaultdict(list)
-    
-    def check_rate_limit(self, request: Request, max_requests: int = 10, window_seconds: int = 60):
-        client_ip = request.client.host
-        key = f"{client_ip}"
-        now = time.time()
-        window_start = now - window_seconds
-        
-        # Clean old requests
-        self.requests[key] = [req_time for req_time in self.requests[key] if req_time > window_start]
-        
-        # Check if under limit
-        if len(self.requests[key]) >= max_requests:
-            raise HTTPException(status_code=429, detail="Rate limit exceeded")
-        
-        # Add current request
-        self.requests[key].append(now)
-
-rate_limiter = RateLimiter()
\ No newline at end of file
+        self.tat: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    async def acquire(self, key: str, policy: RatePolicy) -> float:
+        """Take one request for key; returns 0 when allowed, else seconds to wait"""
+        now = time.monotonic()
+        with self._lock:
+            tat = max(self.tat.get(key, now), now)
+            if tat - now > policy.tolerance:
+                return tat - now - policy.tolerance
+            self.tat[key] = tat + policy.emission
+            return 0.0
+
+    async def evict(self) -> int:
+        """Forget keys whose allowance has fully refilled"""
+        now = time.monotonic()
+        with self._lock:
+            idle = [key for key, tat in self.tat.items() if tat <= now]
+            for key in idle:
+                del self.tat[key]
+            return len(idle)
+
+    def __len__(self) -> int:
+        return len(self.tat)
+
+class PostgresBackend:
+    """Shared state via the rate_limit_acquire function, so limits hold across workers"""
+
+    async def acquire(self, key: str, policy: RatePolicy) -> float:
+        wait = await adb.rpc("rate_limit_acquire", {
+            "p_key": key, "p_emission": policy.emission, "p_tolerance": policy.tolerance
+        })
+        return float(wait or 0)
+
+    async def evict(self) -> int:
+        return int(await adb.rpc("rate_limit_evict", {}) or 0)
+
+class RateLimiter:
+    def __init__(self, backend=None):
+        self.backend = backend or (PostgresBackend() if RATE_LIMIT_BACKEND == "postgres" else MemoryBackend())
+        # Used whenever the shared backend cannot be reached
+        self.fallback = MemoryBackend()
+        self.evicted = 0
+        self._last_eviction = time.monotonic()
+
+    async def check_rate_limit(self, request: Request, max_requests: int = 10, window_seconds: int = 60,
+                               scope: Optional[str] = None, user_id: Optional[str] = None):
+        """Raise 429 (with Retry-After) if this caller is over the scope's policy
+
+        scope names the route's bucket and defaults to the route path; its policy
+        can be overridden with RATE_LIMIT_POLICIES.
+        """
+        if scope is None:
+            route = request.scope.get("route")
+            scope = getattr(route, "path", request.url.path)
+        policy = POLICY_OVERRIDES.get(scope) or RatePolicy(max_requests, window_seconds)
+
+        if policy.per_user and user_id:
+            key = f"{scope}:user:{user_id}"
+        else:
+            key = f"{scope}:ip:{client_ip(request)}"
+
+        try:
+            wait = await self.backend.acquire(key, policy)
+        except Exception as e:
+            print(f"Rate limit backend error, limiting locally: {e}")
+            wait = await self.fallback.acquire(key, policy)
+
+        await self._maybe_evict()
+
+        if wait > 0:
+            raise HTTPException(
+                status_code=429,
+                detail="Rate limit exceeded",
+                headers={"Retry-After": str(max(1, math.ceil(wait)))}
+            )
+
+    async def _maybe_evict(self):
+        now = time.monotonic()
+        if now - self._last_eviction < EVICT_INTERVAL:
+            return
+        self._last_eviction = now
+        try:
+            self.evicted += await self.backend.evict()
+        except Exception as e:
+            print(f"Rate limit eviction failed: {e}")
+        self.evicted += await self.fallback.evict()
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,331 @@
+"""Pub/sub delivery of user-addressed WebSocket events across workers.
+
+Every worker (node) joins the users it holds open sockets or a live outbox
+for. Publishing an event for a user routes it only to the other nodes present
+for that user, which deliver it to their sockets and record it in their
+outbox, so a client can resume on the node it last heard from. The publishing
+node delivers locally itself. A node that may have missed events (its hub
+connection dropped) is told to reset, which makes it drop its outboxes.
+"""
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, Optional, Set
+import asyncio
+import fcntl
+import json
+import os
+import uuid
+
+# "memory" keeps delivery inside this process; "unix" shares it between workers
+PUBSUB_BACKEND = os.getenv("PUBSUB_BACKEND", "memory")
+PUBSUB_SOCKET = os.getenv("PUBSUB_SOCKET", "/tmp/lockbox-pubsub.sock")
+RECONNECT_DELAY = float(os.getenv("PUBSUB_RECONNECT_DELAY", "0.5"))
+# Frames the hub buffers for one node before it disconnects it as too slow
+HUB_QUEUE_SIZE = int(os.getenv("PUBSUB_HUB_QUEUE_SIZE", "10000"))
+
+Deliver = Callable[[str, dict], Awaitable[None]]
+Reset = Callable[[], None]
+
+class PresenceMap:
+    """Which nodes hold sockets or an outbox for each user"""
+
+    def __init__(self):
+        self.nodes_by_user: Dict[str, Set[str]] = {}
+
+    def join(self, user_id: str, node_id: str):
+        self.nodes_by_user.setdefault(user_id, set()).add(node_id)
+
+    def leave(self, user_id: str, node_id: str):
+        nodes = self.nodes_by_user.get(user_id)
+        if nodes is None:
+            return
+        nodes.discard(node_id)
+        if not nodes:
+            del self.nodes_by_user[user_id]
+
+    def drop_node(self, node_id: str):
+        for user_id in [u for u, nodes in self.nodes_by_user.items() if node_id in nodes]:
+            self.leave(user_id, node_id)
+
+    def nodes_for(self, user_id: str) -> Set[str]:
+        return self.nodes_by_user.get(user_id, set())
+
+class Broker(ABC):
+    """Interface the connection manager publishes through"""
+
+    def __init__(self, node_id: Optional[str] = None):
+        self.node_id = node_id or uuid.uuid4().hex
+        self.local_users: Set[str] = set()
+        self.deliver: Optional[Deliver] = None
+        self.reset: Optional[Reset] = None
+
+    async def start(self, deliver: Deliver, reset: Optional[Reset] = None):
+        self.deliver = deliver
+        self.reset = reset
+
+    async def stop(self):
+        pass
+
+    def join(self, user_id: str):
+        self.local_users.add(user_id)
+
+    def leave(self, user_id: str):
+        self.local_users.discard(user_id)
+
+    @abstractmethod
+    async def publish(self, user_id: str, message: dict):
+        """Send an event for user_id to the other nodes present for that user"""
+
+class MemoryHub:
+    """Routes events between brokers living in the same process"""
+
+    def __init__(self):
+        self.presence = PresenceMap()
+        self.nodes: Dict[str, "InProcessBroker"] = {}
+
+    async def route(self, origin: str, user_id: str, message: dict):
+        for node_id in list(self.presence.nodes_for(user_id)):
+            broker = self.nodes.get(node_id)
+            if node_id != origin and broker and broker.deliver:
+                await broker.deliver(user_id, message)
+
+class InProcessBroker(Broker):
+    """Broker on a shared MemoryHub; with a single node publishing is a no-op"""
+
+    def __init__(self, hub: Optional[MemoryHub] = None, node_id: Optional[str] = None):
+        super().__init__(node_id)
+        self.hub = hub or MemoryHub()
+
+    async def start(self, deliver: Deliver, reset: Optional[Reset] = None):
+        await super().start(deliver, reset)
+        self.hub.nodes[self.node_id] = self
+
+    async def stop(self):
+        self.hub.nodes.pop(self.node_id, None)
+        self.hub.presence.drop_node(self.node_id)
+
+    def join(self, user_id: str):
+        super().join(user_id)
+        self.hub.presence.join(user_id, self.node_id)
+
+    def leave(self, user_id: str):
+        super().leave(user_id)
+        self.hub.presence.leave(user_id, self.node_id)
+
+    async def publish(self, user_id: str, message: dict):
+        await self.hub.route(self.node_id, user_id, message)
+
+class UnixSocketHub:
+    """Hub server shared by all workers on a host, hosted by whichever binds first
+
+    Frames are newline-delimited JSON:
+    {"op": "hello", "node": ...}
+    {"op": "join" | "leave", "user": ...}
+    {"op": "publish", "user": ..., "message": ...} -> {"op": "deliver", ...} to the other nodes joined to the user
+    {"op": "reset"} -> {"op": "reset"} to every other node
+
+    Each node has its own send queue and task, so a slow node only delays
+    itself. A node whose queue overflows is disconnected; it reconnects and
+    resets like after any other drop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.presence = PresenceMap()
+        self.writers: Dict[str, asyncio.StreamWriter] = {}
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.senders: Dict[str, asyncio.Task] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self._serve, path=self.path)
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        for sender in self.senders.values():
+            sender.cancel()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+        self.presence = PresenceMap()
+        self.queues.clear()
+        self.senders.clear()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        node_id = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                frame = json.loads(line)
+                op = frame.get("op")
+                if op == "hello":
+                    node_id = frame["node"]
+                    self._drop(node_id)
+                    self.writers[node_id] = writer
+                    self.queues[node_id] = asyncio.Queue(maxsize=HUB_QUEUE_SIZE)
+                    self.senders[node_id] = asyncio.create_task(self._send_to(node_id, writer, self.queues[node_id]))
+                elif node_id is None:
+                    continue
+                elif op == "join":
+                    self.presence.join(frame["user"], node_id)
+                elif op == "leave":
+                    self.presence.leave(frame["user"], node_id)
+                elif op == "publish":
+                    frame = {"op": "deliver", "user": frame["user"], "message": frame["message"]}
+                    self._route(node_id, frame, self.presence.nodes_for(frame["user"]))
+                elif op == "reset":
+                    self._route(node_id, {"op": "reset"}, self.queues)
+        except (ConnectionError, ValueError) as e:
+            print(f"Pub/sub node {node_id} dropped: {e}")
+        finally:
+            if node_id is not None and self.writers.get(node_id) is writer:
+                self._drop(node_id)
+            writer.close()
+
+    def _drop(self, node_id: str):
+        writer = self.writers.pop(node_id, None)
+        self.presence.drop_node(node_id)
+        self.queues.pop(node_id, None)
+        sender = self.senders.pop(node_id, None)
+        if sender:
+            sender.cancel()
+        if writer:
+            writer.close()
+
+    def _route(self, origin: str, frame: dict, node_ids):
+        out = (json.dumps(frame) + "\n").encode()
+        for node_id in list(node_ids):
+            queue = self.queues.get(node_id)
+            if node_id == origin or queue is None:
+                continue
+            try:
+                queue.put_nowait(out)
+            except asyncio.QueueFull:
+                print(f"Pub/sub node {node_id} is too slow, disconnecting it")
+                self._drop(node_id)
+
+    async def _send_to(self, node_id: str, writer: asyncio.StreamWriter, queue: asyncio.Queue):
+        try:
+            while True:
+                writer.write(await queue.get())
+                await writer.drain()
+        except ConnectionError as e:
+            print(f"Pub/sub node {node_id} dropped: {e}")
+            writer.close()
+
+class UnixSocketBroker(Broker):
+    """Broker talking to the per-host UnixSocketHub
+
+    The first worker to bind the socket hosts the hub. If that worker exits the
+    others reconnect, one of them takes over the socket and every node re-sends
+    its joins. Events may have been lost meanwhile, so a reconnecting node
+    resets itself, and also the others if it failed to publish something.
+    """
+
+    def __init__(self, path: str = PUBSUB_SOCKET, node_id: Optional[str] = None):
+        super().__init__(node_id)
+        self.path = path
+        self.hub: Optional[UnixSocketHub] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        self.stopping = False
+        # Set when an event could not be handed to the hub
+        self.dropped_publish = False
+
+    async def start(self, deliver: Deliver, reset: Optional[Reset] = None):
+        await super().start(deliver, reset)
+        reader = await self._connect()
+        self.reader_task = asyncio.create_task(self._run(reader))
+
+    async def stop(self):
+        self.stopping = True
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+        if self.hub:
+            await self.hub.stop()
+
+    async def _connect(self) -> asyncio.StreamReader:
+        # Serialize the election so two workers never both replace the socket
+        with open(self.path + ".lock", "w") as lock:
+            # flock blocks until the holder is done, so wait for it off the loop
+            await asyncio.to_thread(fcntl.flock, lock, fcntl.LOCK_EX)
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # Nobody is serving the socket (or it is stale): host the hub here
+                try:
+                    os.unlink(self.path)
+                except FileNotFoundError:
+                    pass
+                self.hub = UnixSocketHub(self.path)
+                await self.hub.start()
+                reader, writer = await asyncio.open_unix_connection(self.path)
+        self.writer = writer
+        self._send({"op": "hello", "node": self.node_id})
+        for user_id in self.local_users:
+            self._send({"op": "join", "user": user_id})
+        if self.dropped_publish:
+            self._send({"op": "reset"})
+            self.dropped_publish = False
+        return reader
+
+    async def _run(self, reader: Optional[asyncio.StreamReader]):
+        while not self.stopping:
+            try:
+                if reader is None:
+                    reader = await self._connect()
+                    # Anything published while disconnected never reached us
+                    if self.reset:
+                        self.reset()
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError("hub closed the connection")
+                frame = json.loads(line)
+                if frame.get("op") == "deliver" and self.deliver:
+                    await self.deliver(frame["user"], frame["message"])
+                elif frame.get("op") == "reset" and self.reset:
+                    self.reset()
+            except asyncio.CancelledError:
+                raise
+            except (OSError, ValueError) as e:
+                print(f"Pub/sub connection lost, reconnecting: {e}")
+                self.writer = None
+                reader = None
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    def _send(self, frame: dict):
+        if self.writer is not None:
+            self.writer.write((json.dumps(frame) + "\n").encode())
+
+    def join(self, user_id: str):
+        super().join(user_id)
+        self._send({"op": "join", "user": user_id})
+
+    def leave(self, user_id: str):
+        super().leave(user_id)
+        self._send({"op": "leave", "user": user_id})
+
+    async def publish(self, user_id: str, message: dict):
+        if self.writer is None:
+            self.dropped_publish = True
+            return
+        self._send({"op": "publish", "user": user_id, "message": message})
+        try:
+            await self.writer.drain()
+        except ConnectionError as e:
+            self.dropped_publish = True
+            print(f"Failed to publish event for user {user_id}: {e}")
+
+def create_broker() -> Broker:
+    if PUBSUB_BACKEND == "unix":
+        return UnixSocketBroker(PUBSUB_SOCKET)
+    return InProcessBroker()
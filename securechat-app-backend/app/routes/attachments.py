@@ -0,0 +1,146 @@
+from fastapi import APIRouter, HTTPException, status, Depends, Header, Request, Response
+from fastapi.responses import StreamingResponse
+from app.utils.principals import get_current_user
+from app.services.attachments import (
+    DEFAULT_CHUNK_SIZE, MAX_CHUNK_SIZE, AttachmentError, attachment_store
+)
+from typing import Optional, Tuple
+
+router = APIRouter(prefix="/attachments", tags=["attachments"])
+
+def attachment_http_error(e: AttachmentError) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail=e.detail)
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """(start, end) inclusive for a single bytes range, None to send the whole body
+
+    Multi-range requests are answered with the whole body, which RFC 9110
+    allows. Raises 416 when the range lies outside the attachment.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise ValueError
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, min(end, size - 1)
+
+@router.post("/uploads")
+async def create_upload(upload_data: dict, current_user = Depends(get_current_user)):
+    """Start a resumable upload: {"size": bytes, "chunk_size": bytes (optional)}
+
+    The client encrypts the file, then PUTs it as chunk_count chunks of
+    chunk_size bytes (the last may be shorter), in any order and in parallel.
+    """
+    try:
+        return await attachment_store.create_upload(
+            current_user['id'],
+            int(upload_data.get("size") or 0),
+            int(upload_data.get("chunk_size") or DEFAULT_CHUNK_SIZE)
+        )
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="size and chunk_size must be integers")
+    except AttachmentError as e:
+        raise attachment_http_error(e)
+
+@router.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str, current_user = Depends(get_current_user)):
+    """Upload progress; a client resuming after a disconnect re-sends the chunks not in `received`"""
+    try:
+        return await attachment_store.upload_status(upload_id, current_user['id'])
+    except AttachmentError as e:
+        raise attachment_http_error(e)
+
+@router.put("/uploads/{upload_id}/chunks/{index}")
+async def put_chunk(upload_id: str, index: int, request: Request,
+                    x_chunk_sha256: Optional[str] = Header(None),
+                    current_user = Depends(get_current_user)):
+    """Store one encrypted chunk (raw request body); re-sending a chunk is harmless
+
+    X-Chunk-SHA256, when given, is checked against the received bytes.
+    """
+    try:
+        data = bytearray()
+        async for part in request.stream():
+            data.extend(part)
+            if len(data) > MAX_CHUNK_SIZE:
+                raise HTTPException(status_code=413, detail=f"Chunks are at most {MAX_CHUNK_SIZE} bytes")
+        digest = await attachment_store.put_chunk(upload_id, current_user['id'], index, bytes(data), x_chunk_sha256)
+        return {"index": index, "sha256": digest}
+    except HTTPException:
+        raise
+    except AttachmentError as e:
+        raise attachment_http_error(e)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to store chunk: {str(e)}"
+        )
+
+@router.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, current_user = Depends(get_current_user)):
+    """Seal an upload once every chunk is stored; returns the attachment_id to put in messages"""
+    try:
+        return await attachment_store.complete(upload_id, current_user['id'])
+    except AttachmentError as e:
+        raise attachment_http_error(e)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to complete upload: {str(e)}"
+        )
+
+@router.get("/{attachment_id}")
+async def download_attachment(attachment_id: str,
+                              range_header: Optional[str] = Header(None, alias="Range"),
+                              if_range: Optional[str] = Header(None),
+                              if_none_match: Optional[str] = Header(None),
+                              current_user = Depends(get_current_user)):
+    """Stream an encrypted attachment, honouring Range (single range) and If-Range
+
+    Readable by its uploaders and by recipients of messages that reference it.
+    """
+    try:
+        manifest = await attachment_store.manifest(attachment_id, current_user['id'])
+    except AttachmentError as e:
+        raise attachment_http_error(e)
+
+    # The id is a content hash, so the bytes behind it never change
+    etag = f'"{attachment_id}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=31536000, immutable"
+    }
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    size = manifest["size"]
+    byte_range = parse_range(range_header, size) if not if_range or if_range == etag else None
+    if byte_range is None:
+        start, end, status_code = 0, size - 1, 200
+    else:
+        (start, end), status_code = byte_range, 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    return StreamingResponse(
+        attachment_store.read_range(manifest, start, end),
+        status_code=status_code,
+        media_type="application/octet-stream",
+        headers=headers
+    )
@@ -1,34 +1,26 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Header
+from fastapi import APIRouter, HTTPException, status, Depends, Header, Request, Response
 from app.models.user import UserCreate, UserLogin, UserResponse
-from app.utils.auth import hash_password, verify_password, create_access_token
-from app.database import db
+from app.utils.auth import hash_password_async, verify_password_async, create_access_token
+from app.database import adb
+from app.utils.principals import get_current_user, invalidate_user
+from app.services.user_search import username_index
+from app.utils.pagination import require_uuid
+from app.services.key_directory import stored_key_directory, etag_matches, bundle_response
+from app.middleware.rate_limiter import rate_limiter
+from app.utils.wire import wire_response
+from typing import Optional
 import uuid
 
 router = APIRouter(prefix="/auth", tags=["authentication"])
 
-def get_current_user(authorization: str = Header(None)):
-    """Get current user from JWT token"""
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid token")
-    
-    token = authorization.split(" ")[1]
-    from app.utils.auth import verify_token as verify_jwt_token
-    username = verify_jwt_token(token)
-    if not username:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
-    user = db.fetchone("users", {"username": username})
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    
-    return user
+MAX_KEY_BATCH = 200
 
 @router.post("/register", response_model=dict)
 async def register(user: UserCreate):
     """Register a new user - NO private keys stored"""
     try:
         # Check if username already exists
-        existing_user = db.fetchone("users", {"username": user.username})
+        existing_user = await adb.fetchone("users", {"username": user.username})
         if existing_user:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -36,7 +28,7 @@ async def register(user: UserCreate):
             )
         
         # Hash password
-        hashed_password = hash_password(user.password)
+        hashed_password = await hash_password_async(user.password)
         
         # Create user
         user_id = str(uuid.uuid4())
@@ -46,7 +38,8 @@ async def register(user: UserCreate):
             "password_hash": hashed_password
         }
         
-        created_user = db.insert("users", user_data)
+        created_user = await adb.insert("users", user_data)
+        username_index.add(created_user or user_data)
         
         # Create access token
         access_token = create_access_token(data={"sub": user.username})
@@ -69,13 +62,15 @@ async def register(user: UserCreate):
         )
 
 @router.post("/login", response_model=dict)
-async def login(user: UserLogin):
+async def login(user: UserLogin, request: Request):
     """Login user"""
+    # Per client IP: slows down password guessing before bcrypt is reached
+    await rate_limiter.check_rate_limit(request, max_requests=10, window_seconds=60, scope="auth.login")
     try:
         # Get user from database
-        db_user = db.fetchone("users", {"username": user.username})
+        db_user = await adb.fetchone("users", {"username": user.username})
         
-        if not db_user or not verify_password(user.password, db_user['password_hash']):
+        if not db_user or not await verify_password_async(user.password, db_user['password_hash']):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect username or password"
@@ -102,8 +97,11 @@ async def login(user: UserLogin):
         )
 
 @router.post("/keys", response_model=dict)
-async def store_public_key(key_data: dict, current_user = None):
+async def store_public_key(key_data: dict, current_user = Depends(get_current_user)):
     """Store user's public key (generated client-side)"""
+    # Only the key owner may publish or replace their keys
+    if str(key_data.get("user_id")) != str(current_user['id']):
+        raise HTTPException(status_code=403, detail="Cannot store keys for another user")
     try:
         # Store only public keys
         keys_data = {
@@ -113,16 +111,18 @@ async def store_public_key(key_data: dict, current_user = None):
         }
         
         # Check if keys already exist
-        existing_keys = db.fetchone("user_keys", {"user_id": key_data["user_id"]})
+        existing_keys = await adb.fetchone("user_keys", {"user_id": key_data["user_id"]})
         if existing_keys:
-            # Update existing keys
-            # Note: In production, you'd use an UPDATE query
-            pass
+            await adb.update("user_keys", keys_data, {"user_id": key_data["user_id"]})
         else:
-            db.insert("user_keys", keys_data)
+            await adb.insert("user_keys", keys_data)
+        invalidate_user(user_id=key_data["user_id"])
+        stored_key_directory.invalidate(key_data["user_id"])
         
         return {"message": "Public keys stored successfully"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -140,19 +140,47 @@ async def verify_token(current_user = Depends(get_current_user)):
         }
     }
 
+@router.post("/keys/batch")
+async def get_public_keys_batch(request: dict, http_request: Request):
+    """Get many users' public keys in one query
+    
+    Body: {"user_ids": [...], "known_etags": {user_id: etag}}
+    """
+    user_ids = list(dict.fromkeys(request.get("user_ids") or []))
+    if len(user_ids) > MAX_KEY_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_KEY_BATCH} user_ids per call")
+    user_ids = [require_uuid(str(user_id), "user_id") for user_id in user_ids]
+    
+    try:
+        known_etags = request.get("known_etags") or {}
+        entries = await stored_key_directory.get_many(user_ids, known_etags)
+        return wire_response(http_request, bundle_response(entries, known_etags))
+        
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get keys: {str(e)}"
+        )
+
 @router.get("/keys/{user_id}")
-async def get_public_key(user_id: str):
-    """Get user's public key for encryption"""
+async def get_public_key(user_id: str, request: Request, response: Response, if_none_match: Optional[str] = Header(None)):
+    """Get user's public key for encryption (honours If-None-Match)"""
     try:
-        user_keys = db.fetchone("user_keys", {"user_id": user_id})
-        if not user_keys:
+        entry = await stored_key_directory.get(user_id, if_none_match)
+        if not entry:
             raise HTTPException(status_code=404, detail="User keys not found")
         
-        return {
+        headers = {"ETag": entry["etag"], "Cache-Control": "private, no-cache"}
+        if etag_matches(if_none_match, entry["etag"]):
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+        
+        return wire_response(request, {
             "user_id": user_id,
-            "kyber_public_key": user_keys["kyber_public_key"],
-            "mldsa_public_key": user_keys["mldsa_public_key"]
-        }
+            "kyber_public_key": entry["kyber_public_key"],
+            "mldsa_public_key": entry["mldsa_public_key"],
+            "etag": entry["etag"]
+        }, headers)
         
     except HTTPException:
         raise
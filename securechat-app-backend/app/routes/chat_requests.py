@@ -1,28 +1,15 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Header
-from app.utils.auth import verify_token
-from app.database import db
+from fastapi import APIRouter, HTTPException, status, Depends
+from app.database import adb
+from app.utils.principals import get_current_user, get_user_by_id
+from app.loaders import IdentityLoader, get_loader
+from app.services.conversations import record_contact
 from app.websocket_manager import manager
+import asyncio
 import uuid
 from datetime import datetime
 
 router = APIRouter(prefix="/chat-requests", tags=["chat_requests"])
 
-def get_current_user(authorization: str = Header(None)):
-    """Get current user from JWT token"""
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid token")
-    
-    token = authorization.split(" ")[1]
-    username = verify_token(token)
-    if not username:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
-    user = db.fetchone("users", {"username": username})
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    
-    return user
-
 @router.post("/send")
 async def send_chat_request(request_data: dict, current_user = Depends(get_current_user)):
     """Send a chat request to another user"""
@@ -30,13 +17,15 @@ async def send_chat_request(request_data: dict, current_user = Depends(get_curre
         recipient_id = request_data.get("recipient_id")
         message = request_data.get("message", "Hi! I'd like to start a secure conversation with you.")
         
-        # Verify recipient exists
-        recipient = db.fetchone("users", {"id": recipient_id})
+        # Verify recipient exists and check for an existing request concurrently
+        recipient, existing_requests = await asyncio.gather(
+            get_user_by_id(recipient_id),
+            adb.fetchall("chat_requests", {})
+        )
         if not recipient:
             raise HTTPException(status_code=404, detail="Recipient not found")
         
         # Check if request already exists
-        existing_requests = db.fetchall("chat_requests", {})
         for req in existing_requests:
             if (req.get('from_user_id') == current_user['id'] and 
                 req.get('to_user_id') == recipient_id and 
@@ -45,7 +34,7 @@ async def send_chat_request(request_data: dict, current_user = Depends(get_curre
         
         # Create chat request
         request_id = str(uuid.uuid4())
-        db.insert("chat_requests", {
+        await adb.insert("chat_requests", {
             "id": request_id,
             "from_user_id": current_user['id'],
             "to_user_id": recipient_id,
@@ -84,22 +73,28 @@ async def send_chat_request(request_data: dict, current_user = Depends(get_curre
         )
 
 @router.get("/incoming")
-async def get_incoming_requests(current_user = Depends(get_current_user)):
+async def get_incoming_requests(current_user = Depends(get_current_user), loader: IdentityLoader = Depends(get_loader)):
     """Get incoming chat requests for current user"""
     try:
         # Get all pending requests for this user
-        all_requests = db.fetchall("chat_requests", {})
+        all_requests = await adb.fetchall("chat_requests", {})
         incoming_requests = [
             req for req in all_requests 
             if (req.get('to_user_id') == current_user['id'] and 
                 req.get('status') == 'pending')
         ]
         
-        # Get sender information for each request
+        # Get sender information for all requests in one query per table
+        sender_ids = [request['from_user_id'] for request in incoming_requests]
+        senders, keys = await asyncio.gather(
+            loader.users(sender_ids),
+            loader.user_keys(sender_ids)
+        )
+        
         result = []
         for request in incoming_requests:
-            sender = db.fetchone("users", {"id": request['from_user_id']})
-            sender_keys = db.fetchone("user_keys", {"user_id": request['from_user_id']})
+            sender = senders.get(request['from_user_id'])
+            sender_keys = keys.get(request['from_user_id'])
             
             if sender:
                 result.append({
@@ -130,7 +125,7 @@ async def respond_to_chat_request(response_data: dict, current_user = Depends(ge
             raise HTTPException(status_code=400, detail="Invalid action")
         
         # Get the chat request
-        chat_request = db.fetchone("chat_requests", {"id": request_id})
+        chat_request = await adb.fetchone("chat_requests", {"id": request_id})
         if not chat_request:
             raise HTTPException(status_code=404, detail="Chat request not found")
         
@@ -140,17 +135,21 @@ async def respond_to_chat_request(response_data: dict, current_user = Depends(ge
         
         # Update request status in Supabase
         new_status = "accepted" if action == "accept" else "declined"
-        db.update("chat_requests", 
+        await adb.update("chat_requests", 
                  {"status": new_status, "updated_at": datetime.now().isoformat()}, 
                  {"id": request_id})
         
         if action == "accept":
             # Create conversation between users
             conversation_id = str(uuid.uuid4())
+            try:
+                await record_contact(current_user['id'], chat_request['from_user_id'])
+            except Exception as summary_error:
+                print(f"Conversation summary update failed: {summary_error}")
             
             # Notify the original sender via WebSocket
             try:
-                sender = db.fetchone("users", {"id": chat_request['from_user_id']})
+                sender = await get_user_by_id(chat_request['from_user_id'])
                 await manager.send_to_user(sender['username'], {
                     "type": "chat_accepted",
                     "data": {
@@ -185,19 +184,21 @@ async def respond_to_chat_request(response_data: dict, current_user = Depends(ge
         )
 
 @router.get("/sent")
-async def get_sent_requests(current_user = Depends(get_current_user)):
+async def get_sent_requests(current_user = Depends(get_current_user), loader: IdentityLoader = Depends(get_loader)):
     """Get chat requests sent by current user"""
     try:
-        all_requests = db.fetchall("chat_requests", {})
+        all_requests = await adb.fetchall("chat_requests", {})
         sent_requests = [
             req for req in all_requests 
             if req.get('from_user_id') == current_user['id']
         ]
         
-        # Get recipient information
+        # Get recipient information in one query
+        recipients = await loader.users(request['to_user_id'] for request in sent_requests)
+        
         result = []
         for request in sent_requests:
-            recipient = db.fetchone("users", {"id": request['to_user_id']})
+            recipient = recipients.get(request['to_user_id'])
             if recipient:
                 result.append({
                     "id": request['id'],
@@ -1,66 +1,33 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Header
-from app.utils.auth import verify_token
-from app.database import db
+from fastapi import APIRouter, HTTPException, status, Depends
+from app.database import adb
+from app.utils.principals import get_current_user
+from app.loaders import IdentityLoader, get_loader
+from app.services.conversations import list_conversations
 from typing import List
 
 router = APIRouter(prefix="/contacts", tags=["contacts"])
 
-def get_current_user(authorization: str = Header(None)):
-    """Get current user from JWT token"""
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid token")
-    
-    token = authorization.split(" ")[1]
-    username = verify_token(token)
-    if not username:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
-    user = db.fetchone("users", {"username": username})
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    
-    return user
-
 @router.post("/")
-async def get_contacts(current_user = Depends(get_current_user)):
-    """Get user's contacts from accepted chat requests"""
+async def get_contacts(current_user = Depends(get_current_user), loader: IdentityLoader = Depends(get_loader)):
+    """Get user's contacts, most recently active first"""
     try:
-        # Get all chat requests involving this user
-        all_requests = db.fetchall("chat_requests", {})
+        # One indexed read of the user's conversation summaries
+        summaries = await list_conversations(current_user['id'])
         
-        # Find accepted requests where user is involved
-        accepted_requests = [
-            req for req in all_requests 
-            if (req.get('status') == 'accepted' and 
-                (req.get('from_user_id') == current_user['id'] or req.get('to_user_id') == current_user['id']))
-        ]
+        # Get contact info for all contacts in one query
+        contact_users = await loader.users(summary['contact_id'] for summary in summaries)
         
         contacts = []
-        for request in accepted_requests:
-            # Determine the other user (contact)
-            contact_id = request['to_user_id'] if request['from_user_id'] == current_user['id'] else request['from_user_id']
-            
-            # Get contact info
-            contact_user = db.fetchone("users", {"id": contact_id})
+        for summary in summaries:
+            contact_user = contact_users.get(summary['contact_id'])
             if contact_user:
-                # Get last message between users
-                all_messages = db.fetchall("messages", {})
-                user_messages = [
-                    msg for msg in all_messages
-                    if ((msg.get('sender_id') == current_user['id'] and msg.get('recipient_id') == contact_id) or
-                        (msg.get('sender_id') == contact_id and msg.get('recipient_id') == current_user['id']))
-                ]
-                
-                # Sort by timestamp and get last message
-                user_messages.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-                last_message = user_messages[0] if user_messages else None
-                
+                # last_message is a placeholder: content is end-to-end encrypted, so there is no preview
                 contacts.append({
-                    "id": contact_id,
+                    "id": summary['contact_id'],
                     "username": contact_user['username'],
-                    "last_message": "Start chatting..." if not last_message else "New message",
-                    "timestamp": str(request.get('created_at', '')),
-                    "unread_count": 0,  # TODO: Implement unread count
+                    "last_message": "Start chatting..." if not summary.get('last_message_id') else "New message",
+                    "timestamp": str(summary.get('last_activity_at', '')),
+                    "unread_count": summary.get('unread_count', 0),
                     "is_online": True,  # TODO: Implement online status
                     "status": "active"
                 })
@@ -74,18 +41,16 @@ async def get_contacts(current_user = Depends(get_current_user)):
         )
 
 @router.post("/pending")
-async def get_pending_contacts(current_user = Depends(get_current_user)):
+async def get_pending_contacts(current_user = Depends(get_current_user), loader: IdentityLoader = Depends(get_loader)):
     """Get pending chat requests sent by user"""
     try:
-        all_requests = db.fetchall("chat_requests", {})
-        pending_requests = [
-            req for req in all_requests 
-            if (req.get('from_user_id') == current_user['id'] and req.get('status') == 'pending')
-        ]
+        pending_requests = await adb.fetchall("chat_requests", {"from_user_id": current_user['id'], "status": "pending"})
+        
+        contact_users = await loader.users(request['to_user_id'] for request in pending_requests)
         
         contacts = []
         for request in pending_requests:
-            contact_user = db.fetchone("users", {"id": request['to_user_id']})
+            contact_user = contact_users.get(request['to_user_id'])
             if contact_user:
                 contacts.append({
                     "id": request['to_user_id'],
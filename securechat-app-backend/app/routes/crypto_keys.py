@@ -1,27 +1,25 @@
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, status, Depends, Request
 from app.crypto.pq_crypto import pq_crypto
+from app.utils.principals import get_current_user
+from app.middleware.rate_limiter import rate_limiter
+from app.services.keypair_pool import keypair_pool
+import asyncio
 
 router = APIRouter(prefix="/crypto", tags=["cryptography"])
 
 @router.post("/generate-keys")
 async def generate_post_quantum_keys():
-    """Generate post-quantum key pairs using liboqs"""
+    """Generate post-quantum key pairs using liboqs
+    
+    Pairs come from the pre-generated pool; only an empty pool generates inline.
+    """
     try:
-        # Generate Kyber-1024 key pair
-        kyber_public, kyber_private = pq_crypto.generate_kyber_keypair()
-        
-        # Generate ML-DSA-87 key pair
-        mldsa_public, mldsa_private = pq_crypto.generate_mldsa_keypair()
+        # Kyber-1024 and ML-DSA-87 key pairs
+        bundle = await keypair_pool.take()
         
         return {
-            "kyber": {
-                "public_key": kyber_public,
-                "private_key": kyber_private
-            },
-            "mldsa": {
-                "public_key": mldsa_public,
-                "private_key": mldsa_private
-            },
+            "kyber": bundle["kyber"],
+            "mldsa": bundle["mldsa"],
             "algorithms": {
                 "kem": "Kyber-1024",
                 "signature": "ML-DSA-87",
@@ -34,6 +32,11 @@ async def generate_post_quantum_keys():
             detail=f"Key generation failed: {str(e)}"
         )
 
+@router.get("/pool-stats")
+async def get_keypair_pool_stats():
+    """Keypair pool depth, refill rate and how many requests it served on this worker"""
+    return keypair_pool.stats()
+
 @router.post("/test-kyber")
 async def test_kyber_kem(public_key: str):
     """Test Kyber KEM functionality"""
@@ -75,4 +78,35 @@ async def test_mldsa_signature(message: str, private_key: str, public_key: str):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"ML-DSA test failed: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+MAX_VERIFY_BATCH = 5000
+
+@router.post("/verify-batch")
+async def verify_mldsa_signatures(request: Request, batch_data: dict, current_user = Depends(get_current_user)):
+    """Verify many ML-DSA signatures: {"items": [{"message", "signature", "public_key"}]}
+    
+    Returns {"results": [bool, ...]} in request order. Batches fan out to every
+    core, so they are limited per user.
+    """
+    await rate_limiter.check_rate_limit(request, max_requests=10, window_seconds=60, scope="crypto.verify", user_id=current_user['id'])
+    items = batch_data.get("items") or []
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="items must be a list")
+    if len(items) > MAX_VERIFY_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_VERIFY_BATCH} signatures per batch")
+    
+    triples = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not all(isinstance(item.get(field), str) for field in ("message", "signature", "public_key")):
+            raise HTTPException(status_code=400, detail=f"Item {index} needs message, signature and public_key strings")
+        triples.append((item["message"].encode('utf-8'), item["signature"], item["public_key"]))
+    
+    try:
+        results = await asyncio.to_thread(pq_crypto.mldsa_verify_batch, triples)
+        return {"results": results, "valid": sum(results), "algorithm": "ML-DSA-87"}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"ML-DSA batch verification failed: {str(e)}"
+        )
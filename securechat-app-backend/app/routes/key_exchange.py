@@ -1,42 +1,61 @@
-from fastapi import APIRouter, HTTPException, Depends, Header, Request
-from app.utils.auth import verify_token
-from app.database import db
+from fastapi import APIRouter, HTTPException, Depends, Header, Request, Response
+from app.database import adb
+from app.utils.principals import get_current_user, invalidate_user
+from app.utils.pagination import require_uuid
+from app.services.key_directory import user_key_directory, etag_matches, bundle_response
+from app.utils.wire import wire_response
+from typing import Optional
 
 router = APIRouter(prefix="/keys", tags=["key-exchange"])
 
-def get_current_user(authorization: str = Header(None)):
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing token")
-    
-    token = authorization.split(" ")[1]
-    username = verify_token(token)
-    if not username:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
-    user = db.fetchone("users", {"username": username})
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    
-    return user
+MAX_KEY_BATCH = 200
 
 @router.get("/public/{user_id}")
-async def get_public_keys(user_id: str, current_user = Depends(get_current_user)):
-    """Get public keys for a specific user"""
+async def get_public_keys(user_id: str, request: Request, response: Response, if_none_match: Optional[str] = Header(None), current_user = Depends(get_current_user)):
+    """Get public keys for a specific user (honours If-None-Match)"""
     try:
-        user = db.fetchone("users", {"id": user_id})
-        if not user:
+        entry = await user_key_directory.get(user_id, if_none_match)
+        if not entry:
             raise HTTPException(status_code=404, detail="User not found")
         
-        return {
+        headers = {"ETag": entry["etag"], "Cache-Control": "private, no-cache"}
+        if etag_matches(if_none_match, entry["etag"]):
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+        
+        return wire_response(request, {
             "user_id": user_id,
-            "username": user["username"],
-            "kyber_public_key": user.get("kyber_public_key"),
-            "mldsa_public_key": user.get("mldsa_public_key")
-        }
+            "username": entry.get("username"),
+            "kyber_public_key": entry["kyber_public_key"],
+            "mldsa_public_key": entry["mldsa_public_key"],
+            "etag": entry["etag"]
+        }, headers)
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Get keys error: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to get keys: {str(e)}")
 
+@router.post("/public/batch")
+async def get_public_keys_batch(request: dict, http_request: Request, current_user = Depends(get_current_user)):
+    """Get public keys for many users in one query
+    
+    Body: {"user_ids": [...], "known_etags": {user_id: etag}}; users whose keys
+    still match a known etag come back as {"user_id", "etag", "unchanged": true}.
+    """
+    user_ids = list(dict.fromkeys(request.get("user_ids") or []))
+    if len(user_ids) > MAX_KEY_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_KEY_BATCH} user_ids per call")
+    user_ids = [require_uuid(str(user_id), "user_id") for user_id in user_ids]
+    
+    try:
+        known_etags = request.get("known_etags") or {}
+        entries = await user_key_directory.get_many(user_ids, known_etags)
+        return wire_response(http_request, bundle_response(entries, known_etags))
+    except Exception as e:
+        print(f"Get keys batch error: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to get keys: {str(e)}")
+
 @router.post("/update")
 async def update_public_keys(request: dict, current_user = Depends(get_current_user)):
     """Update user's public keys"""
@@ -52,7 +71,9 @@ async def update_public_keys(request: dict, current_user = Depends(get_current_u
             update_data["mldsa_public_key"] = request["mldsa_public_key"]
             
         if update_data:
-            db.update("users", update_data, {"id": current_user["id"]})
+            await adb.update("users", update_data, {"id": current_user["id"]})
+            invalidate_user(user_id=current_user["id"], username=current_user["username"])
+            user_key_directory.invalidate(current_user["id"])
             print(f"Keys updated successfully for user {current_user['id']}")
         
         return {"message": "Public keys updated successfully"}
@@ -1,34 +1,79 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Header
-from app.models.message import MessageCreate, MessageResponse
-from app.utils.auth import verify_token
-from app.database import db
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Request
+from app.utils.pagination import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, encode_cursor, page_bounds, require_uuid
+)
+from app.database import adb
+from app.utils.principals import get_current_user, get_user_by_id
+from app.loaders import IdentityLoader, get_loader
+from app.services.conversations import record_message, record_messages, mark_read
+from app.services.message_writer import message_writer, next_created_at
+from app.services.attachments import AttachmentError, attachment_store
 from app.websocket_manager import manager
+from app.utils.wire import wire_body, wire_response
+from app.utils.streaming import STREAM_MAX_ROWS, ndjson_response, walk_pages, wants_ndjson
+import asyncio
 import uuid
+from typing import Dict, List, Optional
 
 router = APIRouter(prefix="/messages", tags=["messages"])
 
-def get_current_user(authorization: str = Header(None)):
-    """Get current user from JWT token"""
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid token")
-    
-    token = authorization.split(" ")[1]
-    username = verify_token(token)
-    if not username:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
-    user = db.fetchone("users", {"username": username})
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
+MAX_ATTACHMENTS = 10
+GRANT_ATTEMPTS = 3
+
+async def attach(item: dict, row: dict, sender_id: str):
+    """Copy item's attachment_ids onto row once the sender is known to be able to read them
+
+    Rows without attachments don't get the column, so plain sends work
+    before add_attachments.sql is applied. Raises HTTPException if the list is
+    malformed or names an attachment the sender cannot read. The recipient is
+    only granted access by grant_attachments, after the row is stored.
+    """
+    attachment_ids = item.get("attachment_ids")
+    if not attachment_ids:
+        return
+    if not isinstance(attachment_ids, list) or not all(isinstance(a, str) for a in attachment_ids):
+        raise HTTPException(status_code=400, detail="attachment_ids must be a list of ids")
+    if len(attachment_ids) > MAX_ATTACHMENTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_ATTACHMENTS} attachments per message")
+    try:
+        await attachment_store.check_readable(attachment_ids, sender_id)
+    except AttachmentError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    row["attachment_ids"] = attachment_ids
+
+async def grant_attachments(row: dict) -> bool:
+    """Let a stored message's recipient download its attachments
     
-    return user
+    The grant is retried. If it still fails the message is deleted again, so
+    it is never delivered with attachments the recipient cannot open, and
+    False is returned.
+    """
+    if not row.get("attachment_ids"):
+        return True
+    for attempt in range(1, GRANT_ATTEMPTS + 1):
+        try:
+            await attachment_store.grant(row["attachment_ids"], row["sender_id"], row["recipient_id"])
+            return True
+        except Exception as grant_error:
+            print(f"Attachment grant failed for message {row['id']} (attempt {attempt}): {grant_error}")
+            if attempt < GRANT_ATTEMPTS:
+                await asyncio.sleep(0.1 * attempt)
+    try:
+        await adb.delete("messages", {"id": row["id"]})
+    except Exception as delete_error:
+        print(f"Failed to delete message {row['id']} after attachment grant failure: {delete_error}")
+    return False
 
 @router.post("/send", response_model=dict)
-async def send_encrypted_message(message_data: dict, current_user = Depends(get_current_user)):
-    """Store encrypted message blob (server can't read content)"""
+async def send_encrypted_message(request: Request, message_data: dict = Depends(wire_body), current_user = Depends(get_current_user)):
+    """Store encrypted message blob (server can't read content)
+    
+    The body may be JSON or msgpack/CBOR (raw-bytes blob, signature and key).
+    Files go through /attachments and are referenced here by attachment_ids.
+    """
     try:
         # Verify recipient exists
-        recipient = db.fetchone("users", {"id": message_data["recipient_id"]})
+        recipient = await get_user_by_id(message_data["recipient_id"])
         if not recipient:
             raise HTTPException(status_code=404, detail="Recipient not found")
         
@@ -37,7 +82,7 @@ async def send_encrypted_message(message_data: dict, current_user = Depends(get_
         
         # Store encrypted blob (server cannot decrypt this)
         message_id = str(uuid.uuid4())
-        result = db.insert("messages", {
+        row = {
             "id": message_id,
             "conversation_id": conversation_id,
             "sender_id": current_user['id'],
@@ -45,10 +90,25 @@ async def send_encrypted_message(message_data: dict, current_user = Depends(get_
             "encrypted_blob": message_data["encrypted_blob"],  # Client-encrypted
             "signature": message_data["signature"],  # Client-signed
             "sender_public_key": message_data["sender_public_key"]
-        })
+        }
+        await attach(message_data, row, current_user['id'])
+        # Group-committed with concurrent sends into one multi-row insert
+        result = await message_writer.insert(row)
+        if not await grant_attachments(row):
+            raise HTTPException(status_code=500, detail="Failed to share attachments with the recipient; message not sent")
         
         print(f"Message stored: {message_id} from {current_user['username']} to {message_data['recipient_id']}")
         
+        # Keep both participants' contacts lists ordered by recency and count it as unread
+        unread_count = None
+        try:
+            unread_count = await record_message(
+                current_user['id'], message_data["recipient_id"], message_id,
+                (result or {}).get('created_at')
+            )
+        except Exception as summary_error:
+            print(f"Conversation summary update failed: {summary_error}")
+        
         # Get recipient username for WebSocket (WebSocket uses usernames as connection IDs)
         recipient_username = recipient['username']
         print(f"🔍 Broadcasting to: {recipient_username} (ID: {message_data['recipient_id']})")
@@ -57,29 +117,36 @@ async def send_encrypted_message(message_data: dict, current_user = Depends(get_
         # Clean content for WebSocket broadcast (remove encrypted_ prefix)
         clean_content = message_data["encrypted_blob"].replace('encrypted_', '')
         
+        live_message = {
+            "id": message_id,
+            "sender_id": current_user['id'],
+            "content": clean_content,  # Clean content without prefix
+            "sender": current_user['username'],
+            "timestamp": "now",
+            "isOwn": False,
+            "isEncrypted": True,
+            "status": "delivered"
+        }
+        if row.get("attachment_ids"):
+            live_message["attachment_ids"] = row["attachment_ids"]
+        
         # Broadcast message to recipient via WebSocket using username
         await manager.broadcast_new_message(
             sender_id=current_user['username'],
             recipient_id=recipient_username,  # Use username, not ID
-            message_data={
-                "id": message_id,
-                "sender_id": current_user['id'],
-                "content": clean_content,  # Clean content without prefix
-                "sender": current_user['username'],
-                "timestamp": "now",
-                "isOwn": False,
-                "isEncrypted": True,
-                "status": "delivered"
-            }
+            message_data=live_message
         )
         
         print(f"WebSocket broadcast sent to user {message_data['recipient_id']}")
         
-        return {
+        if unread_count is not None:
+            await manager.broadcast_unread_count(recipient_username, current_user['id'], unread_count)
+        
+        return wire_response(request, {
             "message": "Encrypted message stored successfully",
             "message_id": message_id,
             "conversation_id": conversation_id
-        }
+        })
         
     except HTTPException:
         raise
@@ -89,112 +156,343 @@ async def send_encrypted_message(message_data: dict, current_user = Depends(get_
             detail=f"Failed to send message: {str(e)}"
         )
 
+MAX_SEND_BATCH = 100
+MESSAGE_FIELDS = ("recipient_id", "encrypted_blob", "signature", "sender_public_key")
+
+@router.post("/send-batch", response_model=dict)
+async def send_encrypted_messages(request: Request, batch_data: dict = Depends(wire_body),
+                                  current_user = Depends(get_current_user),
+                                  loader: IdentityLoader = Depends(get_loader)):
+    """Store many encrypted messages at once: {"messages": [{recipient_id, encrypted_blob, ...}]}
+    
+    Recipients are checked with one query and valid messages stored with one
+    insert. Results come back per item, in request order.
+    """
+    items = batch_data.get("messages") or []
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="messages must be a list")
+    if len(items) > MAX_SEND_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SEND_BATCH} messages per batch")
+    
+    try:
+        results: List[dict] = [{} for _ in items]
+        recipient_of: Dict[int, str] = {}
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[index] = {"status": "error", "detail": "Each message must be an object"}
+                continue
+            missing = [field for field in MESSAGE_FIELDS if not item.get(field) or not isinstance(item[field], str)]
+            if missing:
+                results[index] = {"status": "error", "detail": f"Missing {', '.join(missing)}"}
+                continue
+            try:
+                recipient_of[index] = str(uuid.UUID(item["recipient_id"]))
+                if item.get("conversation_id"):
+                    uuid.UUID(str(item["conversation_id"]))
+            except ValueError:
+                results[index] = {"status": "error", "detail": "Invalid recipient_id or conversation_id"}
+        
+        try:
+            recipients = await loader.users(set(recipient_of.values()))
+        except Exception as lookup_error:
+            # Not "Recipient not found": nothing was stored, so the whole batch can be resent
+            print(f"Recipient lookup failed: {lookup_error}")
+            raise HTTPException(
+                status_code=503,
+                detail="Could not check recipients, please retry",
+                headers={"Retry-After": "1"}
+            )
+        
+        rows = []
+        index_of: Dict[str, int] = {}
+        for index, item in enumerate(items):
+            if results[index]:
+                continue
+            if not recipients.get(recipient_of[index]):
+                results[index] = {"status": "error", "detail": "Recipient not found"}
+                continue
+            row = {
+                "id": str(uuid.uuid4()),
+                "conversation_id": str(item.get("conversation_id") or uuid.uuid4()),
+                "sender_id": current_user['id'],
+                "recipient_id": recipient_of[index],
+                "encrypted_blob": item["encrypted_blob"],  # Client-encrypted
+                "signature": item["signature"],  # Client-signed
+                "sender_public_key": item["sender_public_key"]
+            }
+            try:
+                await attach(item, row, current_user['id'])
+            except HTTPException as e:
+                results[index] = {"status": "error", "detail": e.detail}
+                continue
+            # One insert means one NOW() for every row, so stamp each in request order
+            row["created_at"] = next_created_at()
+            rows.append(row)
+            index_of[row["id"]] = index
+            results[index] = {"status": "stored", "message_id": row["id"], "conversation_id": row["conversation_id"]}
+        
+        if not rows:
+            return wire_response(request, {"results": results})
+        
+        stored = {row["id"]: row for row in await adb.insert_many("messages", rows)}
+        granted = []
+        # insert_many stores all rows or raises
+        for row in rows:
+            if await grant_attachments(row):
+                granted.append(row)
+            else:
+                results[index_of[row["id"]]] = {"status": "error", "detail": "Failed to share attachments with the recipient"}
+        rows = granted
+        if not rows:
+            return wire_response(request, {"results": results})
+        
+        # Group by recipient, keeping send order
+        by_recipient: Dict[str, List[dict]] = {}
+        for row in rows:
+            by_recipient.setdefault(row["recipient_id"], []).append(row)
+        
+        unread_counts = {}
+        try:
+            unread_counts = await record_messages(current_user['id'], [
+                {
+                    "recipient_id": recipient_id,
+                    "message_id": sent[-1]["id"],
+                    "created_at": stored.get(sent[-1]["id"], {}).get("created_at"),
+                    "count": len(sent)
+                }
+                for recipient_id, sent in by_recipient.items()
+            ])
+        except Exception as summary_error:
+            print(f"Conversation summary update failed: {summary_error}")
+        
+        for recipient_id, sent in by_recipient.items():
+            recipient_username = recipients[recipient_id]['username']
+            for row in sent:
+                live_message = {
+                    "id": row["id"],
+                    "sender_id": current_user['id'],
+                    "content": row["encrypted_blob"].replace('encrypted_', ''),
+                    "sender": current_user['username'],
+                    "timestamp": "now",
+                    "isOwn": False,
+                    "isEncrypted": True,
+                    "status": "delivered"
+                }
+                if row.get("attachment_ids"):
+                    live_message["attachment_ids"] = row["attachment_ids"]
+                await manager.broadcast_new_message(
+                    sender_id=current_user['username'],
+                    recipient_id=recipient_username,
+                    message_data=live_message
+                )
+            # One counter update per conversation, not per message
+            if recipient_id in unread_counts:
+                await manager.broadcast_unread_count(recipient_username, current_user['id'], unread_counts[recipient_id])
+        
+        return wire_response(request, {"results": results})
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to send messages: {str(e)}"
+        )
+
+@router.post("/read")
+async def mark_messages_read(read_data: dict, current_user = Depends(get_current_user)):
+    """Mark conversations read up to a message cursor (or entirely when no cursor is given)
+    
+    Body: {"reads": [{"contact_id": "...", "cursor": "..."}]}
+    """
+    try:
+        reads = read_data.get("reads") or []
+        if not isinstance(reads, list):
+            raise HTTPException(status_code=400, detail="reads must be a list")
+        if len(reads) > MAX_PAGE_SIZE:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_PAGE_SIZE} reads per call")
+        
+        watermarks = []
+        for item in reads:
+            if not isinstance(item, dict):
+                raise HTTPException(status_code=400, detail="Each read must be an object")
+            watermark = {"contact_id": require_uuid(item.get("contact_id") or "", "contact_id")}
+            if item.get("cursor"):
+                watermark["read_at"], _ = page_bounds(item["cursor"], None)[0]
+            watermarks.append(watermark)
+        
+        counts = await mark_read(current_user['id'], watermarks) if watermarks else []
+        
+        # Keep the user's other devices in sync
+        for count in counts:
+            await manager.broadcast_unread_count(current_user['username'], count['contact_id'], count['unread_count'])
+        
+        return {"unread": counts}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to mark messages read: {str(e)}"
+        )
+
+@router.get("/write-stats")
+async def get_write_stats():
+    """Group-commit batch sizes and flush latency of message inserts on this worker"""
+    return message_writer.stats()
+
+def message_row(msg: dict, senders: Optional[Dict[str, Optional[dict]]] = None) -> dict:
+    """Response shape of one stored message; includes sender_username when senders are given"""
+    row = {
+        "id": msg['id'],
+        "conversation_id": msg['conversation_id'],
+        "sender_id": msg['sender_id']
+    }
+    if senders is not None:
+        sender = senders.get(msg['sender_id'])
+        row["sender_username"] = sender['username'] if sender else 'Unknown'
+    row.update({
+        "recipient_id": msg['recipient_id'],
+        "encrypted_blob": msg['encrypted_blob'],  # Client must decrypt
+        "signature": msg['signature'],
+        "sender_public_key": msg['sender_public_key'],
+        "created_at": str(msg.get('created_at', '')),
+        "cursor": encode_cursor(msg)
+    })
+    if msg.get('attachment_ids'):
+        row["attachment_ids"] = msg['attachment_ids']
+    return row
+
+async def history_response(request: Request, fetch, shape, cursor_before, cursor_after, limit: int):
+    """A single JSON page, or with Accept: application/x-ndjson up to `limit` rows streamed page by page
+    
+    A stream is newest first, or oldest first when paging forward with `after`.
+    """
+    if wants_ndjson(request):
+        return ndjson_response(request, walk_pages(fetch, cursor_before, cursor_after, limit), shape)
+    if limit > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit above {MAX_PAGE_SIZE} requires an NDJSON stream")
+    return wire_response(request, await shape(await fetch(cursor_before, cursor_after, limit)))
+
 @router.get("/", response_model=list)
-async def get_encrypted_messages(current_user = Depends(get_current_user)):
-    """Get encrypted message blobs for current user"""
+async def get_encrypted_messages(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=STREAM_MAX_ROWS),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    current_user = Depends(get_current_user),
+    loader: IdentityLoader = Depends(get_loader)
+):
+    """Get a page of encrypted message blobs for current user"""
     try:
-        # Get all messages where user is sender or recipient
-        all_messages = db.fetchall("messages", {})
-        messages = [
-            msg for msg in all_messages 
-            if (msg.get('sender_id') == current_user['id'] or 
-                msg.get('recipient_id') == current_user['id'])
-        ]
-        
-        result = []
-        for msg in messages:
-            # Get sender username
-            sender = db.fetchone("users", {"id": msg['sender_id']})
-            sender_username = sender['username'] if sender else 'Unknown'
-            
-            result.append({
-                "id": msg['id'],
-                "conversation_id": msg['conversation_id'],
-                "sender_id": msg['sender_id'],
-                "sender_username": sender_username,
-                "recipient_id": msg['recipient_id'],
-                "encrypted_blob": msg['encrypted_blob'],  # Client must decrypt
-                "signature": msg['signature'],
-                "sender_public_key": msg['sender_public_key'],
-                "created_at": str(msg.get('created_at', ''))
-            })
-        
-        return result
+        cursor_before, cursor_after = page_bounds(before, after)
         
+        # Only messages where user is sender or recipient, filtered by the database
+        async def fetch(before, after, limit, raise_errors=False):
+            return await adb.fetch_page(
+                "messages",
+                any_of=f"sender_id.eq.{current_user['id']},recipient_id.eq.{current_user['id']}",
+                before=before,
+                after=after,
+                limit=limit,
+                raise_errors=raise_errors
+            )
+        
+        async def shape(messages):
+            # Resolve every sender on the page in one query
+            senders = await loader.users(msg['sender_id'] for msg in messages)
+            return [message_row(msg, senders) for msg in messages]
+        
+        return await history_response(request, fetch, shape, cursor_before, cursor_after, limit)
+        
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to get messages: {str(e)}"
         )
 
-@router.get("/conversation/{contact_id}")
-async def get_conversation_with_contact(contact_id: str, current_user = Depends(get_current_user)):
-    """Get all messages between current user and a specific contact"""
+@router.get("/conversation/by-id/{conversation_id}")
+async def get_conversation(
+    request: Request,
+    conversation_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=STREAM_MAX_ROWS),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    current_user = Depends(get_current_user)
+):
+    """Get a page of messages in a conversation"""
     try:
-        # Get all messages where current user and contact are involved
-        all_messages = db.fetchall("messages", {})
-        conversation_messages = [
-            msg for msg in all_messages 
-            if ((msg.get('sender_id') == current_user['id'] and msg.get('recipient_id') == contact_id) or
-                (msg.get('sender_id') == contact_id and msg.get('recipient_id') == current_user['id']))
-        ]
-        
-        # Sort by timestamp
-        conversation_messages.sort(key=lambda x: x.get('created_at', ''), reverse=False)
-        
-        result = []
-        for msg in conversation_messages:
-            # Get sender username
-            sender = db.fetchone("users", {"id": msg['sender_id']})
-            sender_username = sender['username'] if sender else 'Unknown'
-            
-            result.append({
-                "id": msg['id'],
-                "sender_id": msg['sender_id'],
-                "sender_username": sender_username,
-                "recipient_id": msg['recipient_id'],
-                "encrypted_blob": msg['encrypted_blob'],
-                "signature": msg['signature'],
-                "sender_public_key": msg['sender_public_key'],
-                "created_at": str(msg.get('created_at', ''))
-            })
-        
-        return result
+        conversation_id = require_uuid(conversation_id, "conversation_id")
+        cursor_before, cursor_after = page_bounds(before, after)
+        
+        # Messages in this conversation where user is sender or recipient
+        async def fetch(before, after, limit, raise_errors=False):
+            return await adb.fetch_page(
+                "messages",
+                filters={"conversation_id": conversation_id},
+                any_of=f"sender_id.eq.{current_user['id']},recipient_id.eq.{current_user['id']}",
+                before=before,
+                after=after,
+                limit=limit,
+                raise_errors=raise_errors
+            )
+        
+        async def shape(messages):
+            return [message_row(msg) for msg in messages]
         
+        return await history_response(request, fetch, shape, cursor_before, cursor_after, limit)
+        
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to get conversation: {str(e)}"
         )
 
-@router.get("/conversation/{conversation_id}")
-async def get_conversation(conversation_id: str, current_user = Depends(get_current_user)):
-    """Get all messages in a conversation"""
+@router.get("/conversation/{contact_id}")
+async def get_conversation_with_contact(
+    request: Request,
+    contact_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=STREAM_MAX_ROWS),
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    current_user = Depends(get_current_user),
+    loader: IdentityLoader = Depends(get_loader)
+):
+    """Get a page of messages between current user and a specific contact"""
     try:
-        # Get messages where user is sender or recipient
-        all_messages = db.fetchall("messages", {})
-        conversation_messages = [
-            msg for msg in all_messages 
-            if (msg.get('conversation_id') == conversation_id and 
-                (msg.get('sender_id') == current_user['id'] or 
-                 msg.get('recipient_id') == current_user['id']))
-        ]
-        
-        return [
-            {
-                "id": msg['id'],
-                "sender_id": msg['sender_id'],
-                "recipient_id": msg['recipient_id'],
-                "encrypted_blob": msg['encrypted_blob'],
-                "signature": msg['signature'],
-                "sender_public_key": msg['sender_public_key'],
-                "created_at": str(msg.get('created_at', ''))
-            }
-            for msg in conversation_messages
-        ]
+        contact_id = require_uuid(contact_id, "contact_id")
+        cursor_before, cursor_after = page_bounds(before, after)
+        
+        # Messages in either direction between current user and contact, oldest first
+        async def fetch(before, after, limit, raise_errors=False):
+            return await adb.fetch_page(
+                "messages",
+                any_of=(
+                    f"and(sender_id.eq.{current_user['id']},recipient_id.eq.{contact_id}),"
+                    f"and(sender_id.eq.{contact_id},recipient_id.eq.{current_user['id']})"
+                ),
+                before=before,
+                after=after,
+                limit=limit,
+                raise_errors=raise_errors
+            )
+        
+        async def shape(messages):
+            # Resolve every sender on the page in one query
+            senders = await loader.users(msg['sender_id'] for msg in messages)
+            return [message_row(msg, senders) for msg in messages]
         
+        return await history_response(request, fetch, shape, cursor_before, cursor_after, limit)
+        
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to get conversation: {str(e)}"
-        )
\ No newline at end of file
+        )
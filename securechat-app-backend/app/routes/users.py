@@ -1,56 +1,56 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Header, Request
-from app.utils.auth import verify_token
-from app.database import db
+from fastapi import APIRouter, HTTPException, status, Depends, Request
+from app.database import adb
+from app.utils.principals import get_current_user, get_user_by_id
+from app.loaders import IdentityLoader, get_loader
 from app.middleware.rate_limiter import rate_limiter
-from typing import List
+from app.services.user_search import username_index
+from typing import List, Optional
+import asyncio
 
 router = APIRouter(prefix="/users", tags=["users"])
 
-def get_current_user(authorization: str = Header(None)):
-    """Get current user from JWT token"""
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid token")
+SEARCH_PAGE_MAX = 50
+
+async def search_with_keys(q: str, limit: int, cursor: Optional[str], current_user: dict, loader: IdentityLoader):
+    """Ranked username search with public keys attached"""
+    if len(q) < 2:
+        return {"users": [], "next_cursor": None}
+    
+    try:
+        offset = int(cursor) if cursor else 0
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     
-    token = authorization.split(" ")[1]
-    username = verify_token(token)
-    if not username:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    # Indexed prefix/trigram match instead of scanning the users table
+    matching_users, next_offset = await username_index.search(
+        q, limit=min(max(limit, 1), SEARCH_PAGE_MAX), offset=max(offset, 0), exclude_id=current_user['id']
+    )
     
-    user = db.fetchone("users", {"username": username})
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
+    # Get public keys for matching users in one query
+    keys = await loader.user_keys(user['id'] for user in matching_users)
+    
+    result = []
+    for user in matching_users:
+        user_keys = keys.get(user['id'])
+        result.append({
+            "id": user['id'],
+            "username": user['username'],
+            "kyber_public_key": user_keys['kyber_public_key'] if user_keys else None,
+            "mldsa_public_key": user_keys['mldsa_public_key'] if user_keys else None,
+            "created_at": str(user.get('created_at', ''))
+        })
     
-    return user
+    return {"users": result, "next_cursor": str(next_offset) if next_offset is not None else None}
 
 @router.get("/search")
-async def search_users_get(request: Request, q: str = "", current_user = Depends(get_current_user)):
-    rate_limiter.check_rate_limit(request, max_requests=20, window_seconds=60)
+async def search_users_get(request: Request, q: str = "", limit: int = 10, cursor: Optional[str] = None, current_user = Depends(get_current_user), loader: IdentityLoader = Depends(get_loader)):
     """Search for users by username (GET)"""
+    await rate_limiter.check_rate_limit(request, max_requests=20, window_seconds=60, scope="users.search", user_id=current_user['id'])
     try:
-        if len(q) < 2:
-            return {"users": []}
-        
-        # Get all users and filter by username (case-insensitive)
-        all_users = db.fetchall("users", {})
-        matching_users = [
-            user for user in all_users 
-            if q.lower() in user['username'].lower() and user['id'] != current_user['id']
-        ]
-        
-        # Get public keys for matching users
-        result = []
-        for user in matching_users[:10]:  # Limit to 10 results
-            user_keys = db.fetchone("user_keys", {"user_id": user['id']})
-            result.append({
-                "id": user['id'],
-                "username": user['username'],
-                "kyber_public_key": user_keys['kyber_public_key'] if user_keys else None,
-                "mldsa_public_key": user_keys['mldsa_public_key'] if user_keys else None,
-                "created_at": str(user.get('created_at', ''))
-            })
-        
-        return {"users": result}
+        return await search_with_keys(q, limit, cursor, current_user, loader)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -58,35 +58,22 @@ async def search_users_get(request: Request, q: str = "", current_user = Depends
         )
 
 @router.post("/search")
-async def search_users(request: Request, request_data: dict, current_user = Depends(get_current_user)):
-    rate_limiter.check_rate_limit(request, max_requests=20, window_seconds=60)
+async def search_users(request: Request, request_data: dict, current_user = Depends(get_current_user), loader: IdentityLoader = Depends(get_loader)):
     """Search for users by username"""
+    await rate_limiter.check_rate_limit(request, max_requests=20, window_seconds=60, scope="users.search", user_id=current_user['id'])
     try:
-        q = request_data.get("q", "")
-        if len(q) < 2:
-            return {"users": []}
-        
-        # Get all users and filter by username (case-insensitive)
-        all_users = db.fetchall("users", {})
-        matching_users = [
-            user for user in all_users 
-            if q.lower() in user['username'].lower() and user['id'] != current_user['id']
-        ]
-        
-        # Get public keys for matching users
-        result = []
-        for user in matching_users[:10]:  # Limit to 10 results
-            user_keys = db.fetchone("user_keys", {"user_id": user['id']})
-            result.append({
-                "id": user['id'],
-                "username": user['username'],
-                "kyber_public_key": user_keys['kyber_public_key'] if user_keys else None,
-                "mldsa_public_key": user_keys['mldsa_public_key'] if user_keys else None,
-                "created_at": str(user.get('created_at', ''))
-            })
-        
-        return {"users": result}
+        limit = int(request_data.get("limit", 10))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid limit")
+    
+    try:
+        return await search_with_keys(
+            request_data.get("q", ""), limit,
+            request_data.get("cursor"), current_user, loader
+        )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -97,12 +84,13 @@ async def search_users(request: Request, request_data: dict, current_user = Depe
 async def get_user_profile(user_id: str, current_user = Depends(get_current_user)):
     """Get user profile and public keys"""
     try:
-        user = db.fetchone("users", {"id": user_id})
+        user, user_keys = await asyncio.gather(
+            get_user_by_id(user_id),
+            adb.fetchone("user_keys", {"user_id": user_id})
+        )
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
-        user_keys = db.fetchone("user_keys", {"user_id": user_id})
-        
         return {
             "id": user['id'],
             "username": user['username'],
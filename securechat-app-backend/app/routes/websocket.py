@@ -1,12 +1,20 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query
 from app.websocket_manager import manager
 from app.utils.auth import verify_token
+from app.utils.wire import decode, parse_format
+from typing import Optional
 import json
 
 router = APIRouter()
 
+# Clients send exactly this text; match it without parsing JSON
+PING_FRAME = json.dumps({"type": "ping"}, separators=(",", ":"))
+PONG_FRAME = json.dumps({"type": "pong"})
+
 @router.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str, token: str = None):
+async def websocket_endpoint(websocket: WebSocket, user_id: str, token: str = None, resume_from: Optional[str] = None,
+                             wire_format: Optional[str] = Query(None, alias="format")):
+    """?format=msgpack|cbor switches events to binary frames; control frames stay JSON text"""
     print(f"WebSocket connection attempt for user: {user_id}")
     
     # Accept connection first
@@ -18,24 +26,33 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, token: str = No
     print(f"WebSocket authenticated for user: {user_id}")
     
     # Add to connection manager
-    if user_id not in manager.active_connections:
-        manager.active_connections[user_id] = []
-    manager.active_connections[user_id].append(websocket)
+    connection = manager.register(websocket, user_id, resume_from, parse_format(wire_format))
     print(f"✅ User {user_id} added to WebSocket connections. Total connections: {len(manager.active_connections)}")
     
     try:
         while True:
             # Keep connection alive and handle any client messages
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            connection.touch()
             
             # Handle ping/pong for connection health
-            if message.get("type") == "ping":
-                await websocket.send_text(json.dumps({"type": "pong"}))
-                print(f"Pong sent to user {user_id}")
+            data = frame.get("text")
+            if data is not None:
+                is_ping = data == PING_FRAME or json.loads(data).get("type") == "ping"
+            else:
+                is_ping = decode(frame.get("bytes") or b"", connection.fmt).get("type") == "ping"
+            if is_ping:
+                connection.enqueue(PONG_FRAME)
                 
     except WebSocketDisconnect:
         manager.disconnect(websocket, user_id)
     except Exception as e:
         print(f"WebSocket error for user {user_id}: {e}")
-        manager.disconnect(websocket, user_id)
\ No newline at end of file
+        manager.disconnect(websocket, user_id)
+
+@router.get("/ws/stats")
+async def websocket_stats():
+    """Open, idle, reaped and evicted WebSocket connections on this worker"""
+    return manager.liveness_stats()
@@ -0,0 +1,276 @@
+"""
+Content-addressed store for client-encrypted attachments (local filesystem backend)
+
+Layout under ATTACHMENT_ROOT:
+    chunks/ab/<sha256>                 chunk bytes, shared by every attachment containing them
+    uploads/<upload_id>/meta.json      an upload in progress
+    uploads/<upload_id>/<index>        sha256 of each received chunk
+    attachments/ab/<attachment_id>     manifest: size, chunk_size, chunk hashes, readers
+
+An attachment id is the sha256 of its size and chunk hashes, so identical
+uploads share one manifest and identical chunks are stored once. Filesystem
+calls run on worker threads. Manifest updates hold an flock on the manifest's
+.lock file, which serializes them across threads and workers.
+
+Uploads idle for ATTACHMENT_UPLOAD_TTL are deleted, and so are chunks that
+no manifest or live upload references, swept at most once per
+ATTACHMENT_SWEEP_INTERVAL when uploads are created.
+"""
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+ATTACHMENT_ROOT = os.getenv("ATTACHMENT_ROOT", "./attachments")
+ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(100 * 1024 * 1024)))
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+READ_SIZE = 64 * 1024
+ATTACHMENT_UPLOAD_TTL = float(os.getenv("ATTACHMENT_UPLOAD_TTL", str(24 * 3600)))
+ATTACHMENT_SWEEP_INTERVAL = float(os.getenv("ATTACHMENT_SWEEP_INTERVAL", "3600"))
+
+class AttachmentError(Exception):
+    """Rejected upload or unknown attachment; carries the HTTP status to answer with"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+@contextmanager
+def _locked(path: str):
+    """Exclusive flock on path + ".lock" for a read-modify-write of path"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path, "rb") as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+class LocalBlobStore:
+    def __init__(self, root: str = ATTACHMENT_ROOT):
+        self.root = root
+        self._swept_at = 0.0
+
+    # Paths
+    def _chunk_path(self, digest: str) -> str:
+        return os.path.join(self.root, "chunks", digest[:2], digest)
+
+    def _upload_dir(self, upload_id: str) -> str:
+        return os.path.join(self.root, "uploads", str(uuid.UUID(upload_id)))
+
+    def _manifest_path(self, attachment_id: str) -> str:
+        if len(attachment_id) != 64 or any(c not in "0123456789abcdef" for c in attachment_id):
+            raise AttachmentError(404, "Attachment not found")
+        return os.path.join(self.root, "attachments", attachment_id[:2], attachment_id)
+
+    def _upload_meta(self, upload_id: str, owner_id: str) -> dict:
+        try:
+            meta = _read_json(os.path.join(self._upload_dir(upload_id), "meta.json"))
+        except ValueError:
+            meta = None
+        if not meta or meta["owner_id"] != owner_id:
+            raise AttachmentError(404, "Upload not found")
+        return meta
+
+    # Uploads
+    def _create_upload(self, owner_id: str, size: int, chunk_size: int) -> dict:
+        if not 0 < size <= ATTACHMENT_MAX_BYTES:
+            raise AttachmentError(400, f"size must be between 1 and {ATTACHMENT_MAX_BYTES} bytes")
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise AttachmentError(400, f"chunk_size must be between 1 and {MAX_CHUNK_SIZE} bytes")
+        if time.time() - self._swept_at > ATTACHMENT_SWEEP_INTERVAL:
+            self._swept_at = time.time()
+            self._sweep()
+        upload_id = str(uuid.uuid4())
+        meta = {
+            "upload_id": upload_id,
+            "owner_id": owner_id,
+            "size": size,
+            "chunk_size": chunk_size,
+            "chunk_count": -(-size // chunk_size)
+        }
+        _write_atomic(os.path.join(self._upload_dir(upload_id), "meta.json"), json.dumps(meta).encode())
+        return meta
+
+    def _received(self, upload_id: str, meta: dict) -> List[int]:
+        directory = self._upload_dir(upload_id)
+        return sorted(int(name) for name in os.listdir(directory) if name.isdigit() and int(name) < meta["chunk_count"])
+
+    def _upload_status(self, upload_id: str, owner_id: str) -> dict:
+        meta = self._upload_meta(upload_id, owner_id)
+        return {**meta, "received": self._received(upload_id, meta)}
+
+    def _put_chunk(self, upload_id: str, owner_id: str, index: int, data: bytes, sha256: Optional[str]) -> str:
+        meta = self._upload_meta(upload_id, owner_id)
+        if not 0 <= index < meta["chunk_count"]:
+            raise AttachmentError(400, "Chunk index out of range")
+        expected = min(meta["chunk_size"], meta["size"] - index * meta["chunk_size"])
+        if len(data) != expected:
+            raise AttachmentError(400, f"Chunk {index} must be {expected} bytes")
+        digest = hashlib.sha256(data).hexdigest()
+        if sha256 and sha256.lower() != digest:
+            raise AttachmentError(400, "Chunk checksum mismatch")
+
+        path = self._chunk_path(digest)
+        try:
+            # Already stored: refresh it so the sweep sees it as in use
+            os.utime(path)
+        except FileNotFoundError:
+            _write_atomic(path, data)
+        # Receipts are one file per chunk, so parallel chunk uploads never race
+        _write_atomic(os.path.join(self._upload_dir(upload_id), str(index)), digest.encode())
+        return digest
+
+    def _complete(self, upload_id: str, owner_id: str) -> dict:
+        meta = self._upload_meta(upload_id, owner_id)
+        directory = self._upload_dir(upload_id)
+        missing = [i for i in range(meta["chunk_count"]) if not os.path.exists(os.path.join(directory, str(i)))]
+        if missing:
+            raise AttachmentError(409, f"Missing chunks: {missing[:20]}")
+
+        chunks = []
+        for index in range(meta["chunk_count"]):
+            with open(os.path.join(directory, str(index)), "rb") as f:
+                chunks.append(f.read().decode())
+        attachment_id = hashlib.sha256(
+            f"{meta['size']}:{meta['chunk_size']}:{','.join(chunks)}".encode()
+        ).hexdigest()
+
+        path = self._manifest_path(attachment_id)
+        with _locked(path):
+            manifest = _read_json(path) or {
+                "attachment_id": attachment_id,
+                "size": meta["size"],
+                "chunk_size": meta["chunk_size"],
+                "chunks": chunks,
+                "readers": []
+            }
+            if owner_id not in manifest["readers"]:
+                manifest["readers"].append(owner_id)
+            _write_atomic(path, json.dumps(manifest).encode())
+        shutil.rmtree(directory, ignore_errors=True)
+        return {"attachment_id": attachment_id, "size": manifest["size"]}
+
+    # Attachments
+    def _manifest(self, attachment_id: str, reader_id: str) -> dict:
+        manifest = _read_json(self._manifest_path(attachment_id))
+        if not manifest or reader_id not in manifest["readers"]:
+            raise AttachmentError(404, "Attachment not found")
+        return manifest
+
+    def _check_readable(self, attachment_ids: List[str], reader_id: str):
+        for attachment_id in attachment_ids:
+            self._manifest(attachment_id, reader_id)
+
+    def _grant(self, attachment_ids: List[str], owner_id: str, reader_id: str):
+        for attachment_id in attachment_ids:
+            path = self._manifest_path(attachment_id)
+            with _locked(path):
+                manifest = self._manifest(attachment_id, owner_id)
+                if reader_id not in manifest["readers"]:
+                    manifest["readers"].append(reader_id)
+                    _write_atomic(path, json.dumps(manifest).encode())
+
+    # Expiry
+    def _sweep(self):
+        """Delete uploads idle past the TTL, then chunks nothing references that are as old"""
+        cutoff = time.time() - ATTACHMENT_UPLOAD_TTL
+        referenced = set()
+        uploads = os.path.join(self.root, "uploads")
+        for name in os.listdir(uploads) if os.path.isdir(uploads) else []:
+            directory = os.path.join(uploads, name)
+            try:
+                if os.path.getmtime(directory) < cutoff:
+                    shutil.rmtree(directory, ignore_errors=True)
+                    continue
+                for receipt in os.listdir(directory):
+                    if receipt.isdigit():
+                        with open(os.path.join(directory, receipt), "rb") as f:
+                            referenced.add(f.read().decode())
+            except OSError:
+                continue
+        manifests = os.path.join(self.root, "attachments")
+        for dirpath, _, names in os.walk(manifests):
+            for name in names:
+                if not name.endswith((".lock", ".tmp")) and len(name) == 64:
+                    try:
+                        referenced.update((_read_json(os.path.join(dirpath, name)) or {}).get("chunks", []))
+                    except ValueError:
+                        continue
+        for dirpath, _, names in os.walk(os.path.join(self.root, "chunks")):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                try:
+                    # mtime is re-checked here, so a chunk re-used since the scan survives
+                    if name not in referenced and os.path.getmtime(path) < cutoff:
+                        os.unlink(path)
+                except OSError:
+                    continue
+
+    def read_range(self, manifest: dict, start: int, end: int) -> Iterator[bytes]:
+        """Yield bytes start..end (inclusive) from the chunk files; runs in the response's thread pool"""
+        chunk_size = manifest["chunk_size"]
+        position = start
+        while position <= end:
+            index, offset = divmod(position, chunk_size)
+            with open(self._chunk_path(manifest["chunks"][index]), "rb") as f:
+                f.seek(offset)
+                remaining = min(chunk_size - offset, end - position + 1)
+                while remaining > 0:
+                    data = f.read(min(READ_SIZE, remaining))
+                    if not data:
+                        raise AttachmentError(500, "Attachment chunk is truncated")
+                    yield data
+                    remaining -= len(data)
+                    position += len(data)
+
+    # Async API
+    async def create_upload(self, owner_id: str, size: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+        return await asyncio.to_thread(self._create_upload, owner_id, size, chunk_size)
+
+    async def upload_status(self, upload_id: str, owner_id: str) -> dict:
+        return await asyncio.to_thread(self._upload_status, upload_id, owner_id)
+
+    async def put_chunk(self, upload_id: str, owner_id: str, index: int, data: bytes, sha256: Optional[str] = None) -> str:
+        return await asyncio.to_thread(self._put_chunk, upload_id, owner_id, index, data, sha256)
+
+    async def complete(self, upload_id: str, owner_id: str) -> dict:
+        return await asyncio.to_thread(self._complete, upload_id, owner_id)
+
+    async def manifest(self, attachment_id: str, reader_id: str) -> dict:
+        return await asyncio.to_thread(self._manifest, attachment_id, reader_id)
+
+    async def check_readable(self, attachment_ids: List[str], reader_id: str):
+        """Raise AttachmentError unless reader_id may read every attachment"""
+        await asyncio.to_thread(self._check_readable, attachment_ids, reader_id)
+
+    async def grant(self, attachment_ids: List[str], owner_id: str, reader_id: str):
+        """Let reader_id download attachments owner_id can read (done when a message references them)"""
+        await asyncio.to_thread(self._grant, attachment_ids, owner_id, reader_id)
+
+attachment_store = LocalBlobStore()
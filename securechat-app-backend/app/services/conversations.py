@@ -0,0 +1,51 @@
+from app.database import adb
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+async def record_message(sender_id: str, recipient_id: str, message_id: str, created_at: Optional[str] = None) -> Optional[int]:
+    """Move a conversation to the top of both participants' contacts lists
+    
+    Also bumps the recipient's unread counter; returns its new value. Only
+    accepted contacts have summaries, so this returns None for anyone else.
+    """
+    return await adb.rpc("record_message_summary", {
+        "p_sender_id": sender_id,
+        "p_recipient_id": recipient_id,
+        "p_message_id": message_id,
+        "p_created_at": created_at or _now()
+    })
+
+async def record_messages(sender_id: str, items: List[dict]) -> Dict[str, int]:
+    """record_message for a whole batch in one call
+    
+    items are {"recipient_id", "message_id", "created_at", "count"}, one per
+    recipient with its latest message. Returns recipient_id -> unread count
+    for the recipients that are contacts.
+    """
+    rows = await adb.rpc("record_message_summaries", {"p_sender_id": sender_id, "p_items": items}) or []
+    return {row["recipient_id"]: row["unread_count"] for row in rows}
+
+async def record_contact(user_id: str, contact_id: str):
+    """Add an accepted contact to both users' summaries"""
+    now = _now()
+    await adb.upsert("conversation_summaries", [
+        {"user_id": user_id, "contact_id": contact_id, "last_activity_at": now},
+        {"user_id": contact_id, "contact_id": user_id, "last_activity_at": now}
+    ], on_conflict="user_id,contact_id")
+
+async def list_conversations(user_id: str) -> List[dict]:
+    """Conversation summaries for a user, most recent first"""
+    return await adb.fetchall(
+        "conversation_summaries", {"user_id": user_id},
+        order="last_activity_at", desc=True
+    )
+
+async def mark_read(user_id: str, reads: List[dict]) -> List[dict]:
+    """Advance read watermarks; reads are {"contact_id", "read_at"} with read_at optional
+    
+    Returns [{"contact_id", "unread_count"}] for every conversation that exists.
+    """
+    return await adb.rpc("mark_conversations_read", {"p_user_id": user_id, "p_reads": reads}) or []
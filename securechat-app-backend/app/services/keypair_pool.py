@@ -0,0 +1,120 @@
+from app.crypto.pq_crypto import pq_crypto
+from collections import deque
+from typing import Deque, List, Optional
+import asyncio
+import os
+import time
+
+# Keypair bundles kept ready, and how many background workers keep it topped up
+KEYPAIR_POOL_SIZE = int(os.getenv("KEYPAIR_POOL_SIZE", "32"))
+KEYPAIR_POOL_WORKERS = int(os.getenv("KEYPAIR_POOL_WORKERS", "2"))
+# Refill rate is measured over this many recent generations
+RATE_WINDOW = 50
+
+def generate_bundle() -> dict:
+    """One Kyber-1024 pair and one ML-DSA-87 pair (blocking)"""
+    kyber_public, kyber_private = pq_crypto.generate_kyber_keypair()
+    mldsa_public, mldsa_private = pq_crypto.generate_mldsa_keypair()
+    return {
+        "kyber": {"public_key": kyber_public, "private_key": kyber_private},
+        "mldsa": {"public_key": mldsa_public, "private_key": mldsa_private}
+    }
+
+class KeypairPool:
+    """Pre-generated keypair bundles, refilled by background workers
+
+    Each bundle is handed out exactly once. Keygen runs on worker threads,
+    so neither refills nor the inline fallback block the event loop.
+    """
+
+    def __init__(self, size: int = KEYPAIR_POOL_SIZE, workers: int = KEYPAIR_POOL_WORKERS):
+        self.size = size
+        self.workers = workers
+        self._bundles: Deque[dict] = deque()
+        self._generating = 0
+        self._wanted: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._finished: Deque[float] = deque(maxlen=RATE_WINDOW)
+        # Stats
+        self.served_from_pool = 0
+        self.served_inline = 0
+        self.generated = 0
+        self.failures = 0
+        self.generate_seconds = 0.0
+
+    def start(self):
+        if self._tasks or self.size <= 0:
+            return
+        self._wanted = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._refill()) for _ in range(self.workers)]
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Unused private keys should not outlive the process's pool
+        self._bundles.clear()
+
+    async def take(self) -> dict:
+        """A ready bundle, or one generated now (off the loop) when the pool is empty"""
+        if self._bundles:
+            self.served_from_pool += 1
+            bundle = self._bundles.popleft()
+        else:
+            self.served_inline += 1
+            bundle = await self._generate()
+        if self._wanted is not None:
+            self._wanted.set()
+        return bundle
+
+    async def _generate(self) -> dict:
+        started = time.perf_counter()
+        bundle = await asyncio.to_thread(generate_bundle)
+        self.generated += 1
+        self.generate_seconds += time.perf_counter() - started
+        return bundle
+
+    async def _refill(self):
+        while True:
+            while len(self._bundles) + self._generating >= self.size:
+                self._wanted.clear()
+                await self._wanted.wait()
+            self._generating += 1
+            try:
+                bundle = await self._generate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                print(f"Keypair pool refill failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            finally:
+                self._generating -= 1
+            # Only refills count towards the rate; inline generations would hide an empty pool
+            self._finished.append(time.monotonic())
+            self._bundles.append(bundle)
+
+    def refill_rate(self) -> float:
+        """Bundles the background workers added per second over the recent window"""
+        if len(self._finished) < 2:
+            return 0.0
+        elapsed = self._finished[-1] - self._finished[0]
+        return round((len(self._finished) - 1) / elapsed, 2) if elapsed > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self._bundles),
+            "target": self.size,
+            "workers": len(self._tasks),
+            "generating": self._generating,
+            "refill_rate_per_second": self.refill_rate(),
+            "avg_generate_ms": round(self.generate_seconds / self.generated * 1000, 2) if self.generated else 0,
+            "served_from_pool": self.served_from_pool,
+            "served_inline": self.served_inline,
+            "generated": self.generated,
+            "failures": self.failures
+        }
+
+keypair_pool = KeypairPool()
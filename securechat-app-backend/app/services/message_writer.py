@@ -0,0 +1,130 @@
+from app.database import adb
+from datetime import datetime, timezone
+from typing import List, Optional, Set, Tuple
+import asyncio
+import os
+import time
+
+# A batch is written when it reaches MESSAGE_BATCH_SIZE rows or its first row
+# has waited MESSAGE_BATCH_DELAY_MS, whichever comes first
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "100"))
+MESSAGE_BATCH_DELAY_MS = float(os.getenv("MESSAGE_BATCH_DELAY_MS", "5"))
+
+_last_created_us = 0
+
+def next_created_at() -> str:
+    """created_at for a new message, strictly increasing within this process
+
+    Rows stored by one multi-row insert would otherwise all get the same
+    transaction NOW(), leaving their history order to the random id.
+    """
+    global _last_created_us
+    _last_created_us = max(time.time_ns() // 1000, _last_created_us + 1)
+    seconds, micros = divmod(_last_created_us, 1_000_000)
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(microsecond=micros).isoformat()
+
+def _is_duplicate_key(error: Exception) -> bool:
+    """True for a unique-violation error from PostgREST"""
+    return getattr(error, "code", None) == "23505" or "duplicate key" in str(error)
+
+class GroupCommitWriter:
+    """Coalesces concurrent single-row inserts into multi-row inserts
+
+    insert() returns only once the caller's own row is stored, and raises if
+    storing that row failed, just like adb.insert. If a batch is rejected the
+    rows are retried one by one, so one bad row cannot fail its neighbours; a
+    retried row that turns out to be stored already counts as stored.
+    """
+
+    def __init__(self, table: str, max_batch: int = MESSAGE_BATCH_SIZE,
+                 max_delay_ms: float = MESSAGE_BATCH_DELAY_MS, key: str = "id"):
+        self.table = table
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.key = key
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Running flushes; the loop only holds weak references to tasks
+        self._flushes: Set[asyncio.Task] = set()
+        # Stats for tuning the window
+        self.batches = 0
+        self.rows = 0
+        self.max_batch_seen = 0
+        self.fallbacks = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    async def insert(self, row: dict) -> dict:
+        # Stamped on arrival so rows sharing a batch keep their send order
+        if not row.get("created_at"):
+            row["created_at"] = next_created_at()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future))
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[Tuple[dict, asyncio.Future]]):
+        started = time.perf_counter()
+        try:
+            stored = await adb.insert_many(self.table, [row for row, _ in batch])
+            by_key = {row.get(self.key): row for row in stored}
+            for row, future in batch:
+                if not future.done():
+                    future.set_result(by_key.get(row.get(self.key)))
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+            else:
+                self.fallbacks += 1
+                await asyncio.gather(*(self._insert_one(row, future) for row, future in batch))
+        finally:
+            elapsed = time.perf_counter() - started
+            self.batches += 1
+            self.rows += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            self.flush_seconds += elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+    async def _insert_one(self, row: dict, future: asyncio.Future):
+        try:
+            result = await adb.insert(self.table, row)
+        except Exception as e:
+            # The failed batch may have committed after all (e.g. a timeout on the
+            # response); our ids are freshly generated, so a clash means it did
+            result = await adb.fetchone(self.table, {self.key: row.get(self.key)}) if _is_duplicate_key(e) else None
+            if result is None:
+                if not future.done():
+                    future.set_exception(e)
+                return
+        if not future.done():
+            future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "rows": self.rows,
+            "avg_batch_size": round(self.rows / self.batches, 2) if self.batches else 0,
+            "max_batch_size": self.max_batch_seen,
+            "fallbacks": self.fallbacks,
+            "avg_flush_ms": round(self.flush_seconds / self.batches * 1000, 2) if self.batches else 0,
+            "max_flush_ms": round(self.max_flush_seconds * 1000, 2),
+            "pending": len(self._pending),
+            "max_batch": self.max_batch,
+            "max_delay_ms": self.max_delay * 1000
+        }
+
+message_writer = GroupCommitWriter("messages")
@@ -1,9 +1,15 @@
+import asyncio
 import bcrypt
+import hashlib
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from typing import Optional
 from dotenv import load_dotenv
+from app.utils.cache import TTLCache
 
 # Load environment variables
 load_dotenv()
@@ -15,6 +21,11 @@ if not SECRET_KEY:
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 hours
 
+# Already-verified tokens, keyed by SHA-256 of the token. Each entry lives no
+# longer than the token's own exp, so an expired token is never served.
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
 def hash_password(password: str) -> str:
     """Hash password using bcrypt"""
     salt = bcrypt.gensalt()
@@ -24,6 +35,36 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify password against hash"""
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
+# bcrypt releases the GIL, so a small thread pool runs hashes in parallel off the event loop.
+# Jobs beyond the queue limit are rejected with 503 instead of waiting behind a login burst.
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", "32"))
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+_password_jobs = 0  # queued + running, only touched from the event loop
+
+async def _run_password_job(func, *args):
+    global _password_jobs
+    if _password_jobs >= PASSWORD_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=503,
+            detail="Server busy, please retry",
+            headers={"Retry-After": "1"}
+        )
+    _password_jobs += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_executor, func, *args)
+    finally:
+        _password_jobs -= 1
+
+async def hash_password_async(password: str) -> str:
+    """Hash password on the bcrypt worker pool"""
+    return await _run_password_job(hash_password, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """Verify password on the bcrypt worker pool"""
+    return await _run_password_job(verify_password, plain_password, hashed_password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create JWT access token"""
     to_encode = data.copy()
@@ -37,9 +78,22 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 
 def verify_token(token: str) -> Optional[str]:
     """Verify JWT token and return username"""
+    digest = hashlib.sha256(token.encode('utf-8')).digest()
+    username = token_cache.get(digest)
+    if username is not None:
+        return username
+    
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
-        return username
     except JWTError:
-        return None
\ No newline at end of file
+        return None
+    
+    if username:
+        exp = payload.get("exp")
+        token_cache.set(digest, username, ttl=exp - time.time() if exp is not None else None)
+    return username
+
+def token_cache_stats() -> dict:
+    """Hit/miss counters for the verified-token cache"""
+    return token_cache.stats()
\ No newline at end of file
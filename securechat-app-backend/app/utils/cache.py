@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+import threading
+import time
+
+class TTLCache:
+    """Bounded LRU mapping whose entries expire after a TTL
+    
+    Entries use the cache-wide TTL unless set() is given a shorter one.
+    Expired entries are dropped lazily on access and when the cache is full.
+    """
+    
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[1]
+    
+    def invalidate_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """Drop every entry matching predicate(key, value); returns how many were dropped"""
+        with self._lock:
+            doomed = [key for key, (_, value) in self._data.items() if predicate(key, value)]
+            for key in doomed:
+                del self._data[key]
+            return len(doomed)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses
+        }
@@ -0,0 +1,41 @@
+from fastapi import HTTPException
+from typing import Optional, Tuple
+import base64
+import re
+import uuid
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# created_at is interpolated into a PostgREST filter, so only allow timestamp characters
+_TIMESTAMP_RE = re.compile(r"^[0-9T:.+\- ]+$")
+
+def encode_cursor(row: dict) -> str:
+    """Encode a row's (created_at, id) position as an opaque cursor"""
+    raw = f"{row.get('created_at', '')}|{row['id']}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8')
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[str, str]]:
+    """Decode a cursor back into (created_at, id), raising ValueError if malformed"""
+    if not cursor:
+        return None
+    created_at, row_id = base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8').split("|", 1)
+    if not _TIMESTAMP_RE.match(created_at):
+        raise ValueError("Invalid cursor timestamp")
+    return created_at, str(uuid.UUID(row_id))
+
+def page_bounds(before: Optional[str], after: Optional[str]):
+    """Resolve before/after query parameters into keyset positions"""
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    try:
+        return decode_cursor(before), decode_cursor(after)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def require_uuid(value: str, name: str = "id") -> str:
+    """Validate an id before it is used inside a query filter"""
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}")
@@ -0,0 +1,56 @@
+from fastapi import Header, HTTPException
+from app.database import adb
+from app.utils.auth import verify_token
+from app.utils.cache import TTLCache
+from typing import Optional
+import os
+
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+
+# Resolved users rows, stored under both ("username", ...) and ("id", ...).
+# The cache is per worker, so other workers may serve a changed row until the TTL runs out.
+principal_cache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+
+def cache_principal(user: dict):
+    principal_cache.set(("username", user["username"]), user)
+    principal_cache.set(("id", str(user["id"])), user)
+
+def invalidate_user(user_id: Optional[str] = None, username: Optional[str] = None):
+    """Drop a cached principal; call whenever a user row or its keys change"""
+    principal_cache.invalidate_where(
+        lambda key, user: (user_id is not None and str(user["id"]) == str(user_id)) or
+                          (username is not None and user["username"] == username)
+    )
+
+async def get_user_by_username(username: str) -> Optional[dict]:
+    user = principal_cache.get(("username", username))
+    if user is None:
+        user = await adb.fetchone("users", {"username": username})
+        if user:
+            cache_principal(user)
+    return dict(user) if user else None
+
+async def get_user_by_id(user_id: str) -> Optional[dict]:
+    user = principal_cache.get(("id", str(user_id)))
+    if user is None:
+        user = await adb.fetchone("users", {"id": user_id})
+        if user:
+            cache_principal(user)
+    return dict(user) if user else None
+
+async def get_current_user(authorization: str = Header(None)):
+    """Get current user from JWT token"""
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Missing or invalid token")
+    
+    token = authorization.split(" ")[1]
+    username = verify_token(token)
+    if not username:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    user = await get_user_by_username(username)
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    
+    return user
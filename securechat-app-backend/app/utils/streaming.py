@@ -0,0 +1,107 @@
+"""
+Streaming NDJSON responses for history endpoints
+
+Rows are read a page at a time and written as newline-delimited JSON as soon
+as each page arrives, optionally gzip- or brotli-compressed, so a request
+holds one page in memory no matter how much history it returns.
+"""
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from app.utils.pagination import MAX_PAGE_SIZE
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+import json
+import os
+import zlib
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+NDJSON = "application/x-ndjson"
+# Upper bound on rows one streamed request may return
+STREAM_MAX_ROWS = int(os.getenv("STREAM_MAX_ROWS", "10000"))
+
+# fetch(before, after, limit, raise_errors=...) -> one keyset page, oldest first
+FetchPage = Callable[..., Awaitable[List[dict]]]
+ShapePage = Callable[[List[dict]], Awaitable[List[dict]]]
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON in request.headers.get("accept", "")
+
+async def walk_pages(fetch: FetchPage, before: Optional[Tuple[str, str]], after: Optional[Tuple[str, str]],
+                     total: int, page_size: int = MAX_PAGE_SIZE) -> AsyncIterator[List[dict]]:
+    """Yield keyset pages until total rows are read or the history runs out
+
+    Without after, pages walk back in time from before (or the newest row)
+    and every row comes out newest first; with after they walk forward and
+    rows come out oldest first. Either way the whole stream is in one order.
+    Database errors are raised rather than read as the end of the history.
+    """
+    remaining = total
+    while remaining > 0:
+        wanted = min(page_size, remaining)
+        rows = await fetch(before, after, wanted, raise_errors=True)
+        if not rows:
+            return
+        remaining -= len(rows)
+        if after is not None:
+            after = (str(rows[-1]['created_at']), rows[-1]['id'])
+            yield rows
+        else:
+            before = (str(rows[0]['created_at']), rows[0]['id'])
+            yield rows[::-1]
+        if len(rows) < wanted:
+            return
+
+class _Compressor:
+    """Content-Encoding picked from Accept-Encoding: br, then gzip, else none"""
+
+    def __init__(self, accept_encoding: str):
+        accepted = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")}
+        self.encoding = None
+        if BROTLI_AVAILABLE and "br" in accepted:
+            self.encoding = "br"
+            self._brotli = brotli.Compressor()
+        elif "gzip" in accepted:
+            self.encoding = "gzip"
+            self._zlib = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes) -> bytes:
+        """Compress and flush, so the client can decode this page right away"""
+        if self.encoding == "br":
+            return self._brotli.process(data) + self._brotli.flush()
+        if self.encoding == "gzip":
+            return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        return data
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._brotli.finish()
+        if self.encoding == "gzip":
+            return self._zlib.flush()
+        return b""
+
+def ndjson_response(request: Request, pages: AsyncIterator[List[dict]], shape: ShapePage) -> StreamingResponse:
+    """Stream shape(page) for every page, one JSON object per line
+
+    The status is already sent when a later page fails, so the failure is
+    reported as a final {"error": ...} line.
+    """
+    compressor = _Compressor(request.headers.get("accept-encoding", ""))
+
+    async def body():
+        try:
+            async for page in pages:
+                rows = await shape(page)
+                yield compressor.chunk("".join(json.dumps(row) + "\n" for row in rows).encode('utf-8'))
+        except Exception as e:
+            print(f"History stream failed: {e}")
+            yield compressor.chunk((json.dumps({"error": str(e)}) + "\n").encode('utf-8'))
+        yield compressor.finish()
+
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if compressor.encoding:
+        headers["Content-Encoding"] = compressor.encoding
+    return StreamingResponse(body(), media_type=NDJSON, headers=headers)
@@ -0,0 +1,51 @@
+from typing import Dict, Hashable, List, Set, Tuple
+import math
+
+class TimerWheel:
+    """Hashed timing wheel of deadlines
+
+    A key lives in the slot for its deadline's tick. advance() only visits the
+    slots that ticked past, so its cost is the number of keys falling due, not
+    the number scheduled. Deadlines further out than one revolution are kept
+    and revisited each revolution until they are due.
+    """
+
+    def __init__(self, tick: float, span: float, now: float):
+        self.tick = tick
+        self.slots: List[Set[Hashable]] = [set() for _ in range(math.ceil(span / tick) + 1)]
+        # key -> (deadline, slot index)
+        self.entries: Dict[Hashable, Tuple[float, int]] = {}
+        self.current = self._tick_of(now)
+
+    def _tick_of(self, when: float) -> int:
+        return int(when // self.tick)
+
+    def schedule(self, key: Hashable, deadline: float):
+        self.cancel(key)
+        # First tick at or after the deadline, never a slot already swept
+        index = max(math.ceil(deadline / self.tick), self.current + 1) % len(self.slots)
+        self.entries[key] = (deadline, index)
+        self.slots[index].add(key)
+
+    def cancel(self, key: Hashable):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.slots[entry[1]].discard(key)
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Pop every key whose deadline is at or before now"""
+        due = []
+        target = self._tick_of(now)
+        # After a long stall one revolution covers every slot
+        steps = min(target - self.current, len(self.slots))
+        for step in range(1, steps + 1):
+            slot = self.slots[(self.current + step) % len(self.slots)]
+            for key in [k for k in slot if self.entries[k][0] <= now]:
+                slot.discard(key)
+                del self.entries[key]
+                due.append(key)
+        self.current = max(self.current, target)
+        return due
+
+    def __len__(self) -> int:
+        return len(self.entries)
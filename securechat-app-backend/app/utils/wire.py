@@ -0,0 +1,139 @@
+"""
+Wire format negotiation: JSON (default) or msgpack/CBOR with raw-bytes key material
+
+Blobs, signatures and public keys are stored base64-encoded. In a binary
+format they travel as raw bytes and are converted at the edge, so storage and
+JSON clients are unaffected.
+"""
+from fastapi import HTTPException, Request, Response
+from typing import Any, Optional
+import base64
+import binascii
+import json
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+try:
+    import cbor2
+    CBOR_AVAILABLE = True
+except ImportError:
+    CBOR_AVAILABLE = False
+
+JSON = "json"
+MSGPACK = "msgpack"
+CBOR = "cbor"
+
+MEDIA_TYPES = {
+    MSGPACK: "application/msgpack",
+    CBOR: "application/cbor",
+    JSON: "application/json"
+}
+_FORMAT_BY_MEDIA_TYPE = {
+    "application/msgpack": MSGPACK,
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.msgpack": MSGPACK,
+    "application/cbor": CBOR,
+    "application/json": JSON
+}
+
+# Fields holding base64 in storage and raw bytes on a binary wire
+BINARY_FIELDS = frozenset({
+    "encrypted_blob", "signature", "sender_public_key", "kyber_public_key", "mldsa_public_key"
+})
+
+def available(fmt: str) -> bool:
+    return fmt == JSON or (fmt == MSGPACK and MSGPACK_AVAILABLE) or (fmt == CBOR and CBOR_AVAILABLE)
+
+def parse_format(value: Optional[str]) -> str:
+    """Format named by a ?format= parameter or a media type; JSON if unknown or not installed"""
+    if not value:
+        return JSON
+    value = value.split(";")[0].strip().lower()
+    fmt = _FORMAT_BY_MEDIA_TYPE.get(value, value)
+    return fmt if fmt in MEDIA_TYPES and available(fmt) else JSON
+
+def negotiate(request: Request) -> str:
+    """Response format from the Accept header, first acceptable binary type wins"""
+    for media_type in request.headers.get("accept", "").split(","):
+        fmt = parse_format(media_type)
+        if fmt != JSON:
+            return fmt
+    return JSON
+
+def _raw_bytes(text: str):
+    """Bytes of canonical base64 text; anything else stays text so it round-trips exactly"""
+    try:
+        raw = base64.b64decode(text, validate=True)
+    except (binascii.Error, ValueError):
+        return text
+    return raw if base64.b64encode(raw).decode('ascii') == text else text
+
+def to_wire(value: Any) -> Any:
+    """Replace base64 binary fields with raw bytes (left as-is if not canonical base64)"""
+    if isinstance(value, list):
+        return [to_wire(item) for item in value]
+    if isinstance(value, dict):
+        out = {}
+        for key, item in value.items():
+            if key in BINARY_FIELDS and isinstance(item, str):
+                item = _raw_bytes(item)
+            else:
+                item = to_wire(item)
+            out[key] = item
+        return out
+    return value
+
+def from_wire(value: Any) -> Any:
+    """Inverse of to_wire: raw bytes back to the base64 text that is stored"""
+    if isinstance(value, list):
+        return [from_wire(item) for item in value]
+    if isinstance(value, dict):
+        return {key: from_wire(item) for key, item in value.items()}
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('utf-8')
+    return value
+
+def encode(value: Any, fmt: str):
+    """Serialize for the wire: str for JSON, bytes for binary formats"""
+    if fmt == MSGPACK:
+        return msgpack.packb(to_wire(value), use_bin_type=True)
+    if fmt == CBOR:
+        return cbor2.dumps(to_wire(value))
+    return json.dumps(value)
+
+def decode(body: bytes, fmt: str) -> Any:
+    if fmt == MSGPACK:
+        return from_wire(msgpack.unpackb(body, raw=False))
+    if fmt == CBOR:
+        return from_wire(cbor2.loads(body))
+    return json.loads(body)
+
+async def wire_body(request: Request) -> dict:
+    """FastAPI dependency: request body in whichever format its Content-Type names"""
+    fmt = parse_format(request.headers.get("content-type"))
+    try:
+        body = decode(await request.body(), fmt)
+    except Exception:
+        raise HTTPException(status_code=400, detail=f"Malformed {fmt} body")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Request body must be an object")
+    return body
+
+def wire_response(request: Request, payload: Any, headers: Optional[dict] = None):
+    """payload as-is for JSON clients (FastAPI serializes it), else an encoded Response
+    
+    headers are only applied to the binary Response; JSON callers set them on
+    their injected Response as before.
+    """
+    fmt = negotiate(request)
+    if fmt == JSON:
+        return payload
+    return Response(
+        content=encode(payload, fmt),
+        media_type=MEDIA_TYPES[fmt],
+        headers={**(headers or {}), "Vary": "Accept"}
+    )
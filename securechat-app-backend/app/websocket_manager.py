@@ -1,51 +1,288 @@
 from fastapi import WebSocket
-from typing import Dict, List
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+import asyncio
+import itertools
 import json
+import os
+import time
+from app.pubsub import Broker, create_broker
+from app.utils.cache import TTLCache
+from app.utils.timer_wheel import TimerWheel
+from app.utils.wire import JSON, encode
+
+# Outbound events buffered per socket before it is treated as a slow consumer
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+
+# Clients ping every 30s; a socket silent for WS_IDLE_TIMEOUT is reaped.
+# Half-open sockets are caught earlier by uvicorn's protocol pings (--ws-ping-interval).
+IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "90"))
+REAP_TICK = float(os.getenv("WS_REAP_TICK", "1"))
+
+# Recent events kept per user so a reconnecting client can resume
+OUTBOX_SIZE = int(os.getenv("WS_OUTBOX_SIZE", "256"))
+OUTBOX_TTL = float(os.getenv("WS_OUTBOX_TTL", "3600"))
+OUTBOX_USERS = int(os.getenv("WS_OUTBOX_USERS", "10000"))
+# How often users whose outbox expired (and who have no sockets here) are left
+PRESENCE_SWEEP = float(os.getenv("WS_PRESENCE_SWEEP", "30"))
+
+# Seeded from the clock so sequence numbers keep increasing across restarts
+_sequence = itertools.count(time.time_ns() // 1000)
+
+class Outbox:
+    """Bounded log of one user's recent events, keyed by sequence number"""
+
+    def __init__(self, size: int = OUTBOX_SIZE):
+        self.events: Deque[Tuple[int, str]] = deque(maxlen=size)
+        # Every event with seq <= floor is either absent or already forgotten
+        self.floor = next(_sequence)
+
+    def append(self, seq: int, payload: str):
+        if len(self.events) == self.events.maxlen:
+            self.floor = self.events[0][0]
+        self.events.append((seq, payload))
+
+    def since(self, cursor: int) -> Optional[List[str]]:
+        """Payloads after cursor, or None if some of them were already dropped"""
+        if cursor < self.floor:
+            return None
+        return [payload for seq, payload in self.events if seq > cursor]
+
+class Connection:
+    """One WebSocket with a bounded outbound queue drained by its own writer task
+
+    Events go out in the connection's negotiated format: JSON text frames, or
+    binary msgpack/CBOR frames carrying raw-bytes blobs and keys.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: str, manager: "ConnectionManager", fmt: str = JSON):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.manager = manager
+        self.fmt = fmt
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.writer = asyncio.create_task(self._drain())
+        self.last_seen = time.monotonic()
+
+    def touch(self):
+        """Record inbound activity; the reaper checks it lazily when the timer fires"""
+        self.last_seen = time.monotonic()
+
+    def enqueue(self, payload) -> bool:
+        """Queue an already-serialized event; False if the queue is full"""
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def _drain(self):
+        try:
+            while True:
+                payload = await self.queue.get()
+                if isinstance(payload, bytes):
+                    await self.websocket.send_bytes(payload)
+                else:
+                    await self.websocket.send_text(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Failed to send message to user {self.user_id}: {e}")
+            self.manager.disconnect(self.websocket, self.user_id)
+
+    async def close(self, code: int = 1000):
+        self.writer.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
 
 class ConnectionManager:
     def __init__(self):
         # Store active connections by user_id
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+        self.active_connections: Dict[str, List[Connection]] = {}
+        self.evicted_slow_consumers = 0
+        self.outboxes = TTLCache(maxsize=OUTBOX_USERS, ttl=OUTBOX_TTL)
+        # Reaches users whose sockets live on other workers
+        self.broker: Broker = create_broker()
+        # Idle deadlines of every connection
+        self.idle_timers = TimerWheel(REAP_TICK, IDLE_TIMEOUT, time.monotonic())
+        self.reaped_idle_connections = 0
+        self._reaper: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self.broker.start(self.deliver_local, self.reset_outboxes)
+        self._reaper = asyncio.create_task(self._reap_idle())
+
+    async def stop(self):
+        if self._reaper:
+            self._reaper.cancel()
+        await self.broker.stop()
+
+    async def _reap_idle(self):
+        next_sweep = time.monotonic() + PRESENCE_SWEEP
+        while True:
+            await asyncio.sleep(REAP_TICK)
+            now = time.monotonic()
+            if now >= next_sweep:
+                next_sweep = now + PRESENCE_SWEEP
+                self._sweep_presence()
+            for connection in self.idle_timers.advance(now):
+                deadline = connection.last_seen + IDLE_TIMEOUT
+                if deadline > now:
+                    # Heard from since it was scheduled: push the timer out
+                    self.idle_timers.schedule(connection, deadline)
+                    continue
+                print(f"Reaping idle WebSocket for user {connection.user_id}")
+                self.reaped_idle_connections += 1
+                self.disconnect(connection.websocket, connection.user_id)
+                # 1001: going away
+                asyncio.create_task(connection.close(code=1001))
+
+    def liveness_stats(self) -> dict:
+        now = time.monotonic()
+        connections = [c for conns in self.active_connections.values() for c in conns]
+        return {
+            "connections": len(connections),
+            # Missed at least one client ping interval
+            "idle": sum(1 for c in connections if now - c.last_seen > IDLE_TIMEOUT / 3),
+            "reaped_idle": self.reaped_idle_connections,
+            "evicted_slow_consumers": self.evicted_slow_consumers
+        }
 
     async def connect(self, websocket: WebSocket, user_id: str):
         await websocket.accept()
-        if user_id not in self.active_connections:
-            self.active_connections[user_id] = []
-        self.active_connections[user_id].append(websocket)
+        self.register(websocket, user_id)
         print(f"User {user_id} connected via WebSocket")
 
+    def register(self, websocket: WebSocket, user_id: str, resume_from: Optional[str] = None, fmt: str = JSON) -> Connection:
+        """Track an already-accepted WebSocket
+
+        With resume_from (the "cursor" of the last event the client saw),
+        events the user missed since are queued first. If the cursor came
+        from another worker, or the events are no longer all kept, the client
+        is told to do a full sync instead.
+        """
+        connection = Connection(websocket, user_id, self, fmt)
+        self.idle_timers.schedule(connection, connection.last_seen + IDLE_TIMEOUT)
+        self.active_connections.setdefault(user_id, []).append(connection)
+        self._join(user_id)
+        if resume_from is not None:
+            node_id, _, seq = resume_from.rpartition(":")
+            outbox = self.outboxes.get(user_id) if node_id == self.broker.node_id and seq.isdigit() else None
+            missed = outbox.since(int(seq)) if outbox else None
+            if missed is None or len(missed) >= SEND_QUEUE_SIZE:
+                connection.enqueue(json.dumps({"type": "sync_required"}))
+            else:
+                for payload in missed:
+                    connection.enqueue(payload if fmt == JSON else encode(json.loads(payload), fmt))
+        return connection
+
     def disconnect(self, websocket: WebSocket, user_id: str):
-        if user_id in self.active_connections:
-            self.active_connections[user_id].remove(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
-        print(f"User {user_id} disconnected from WebSocket")
+        connections = self.active_connections.get(user_id, [])
+        for connection in [c for c in connections if c.websocket is websocket]:
+            connections.remove(connection)
+            connection.writer.cancel()
+            self.idle_timers.cancel(connection)
+            print(f"User {user_id} disconnected from WebSocket")
+        if user_id in self.active_connections and not connections:
+            del self.active_connections[user_id]
+            self._leave_if_idle(user_id)
+
+    def _evict(self, connection: Connection):
+        """Drop a connection whose outbound queue stayed full"""
+        print(f"Evicting slow WebSocket consumer for user {connection.user_id}")
+        self.evicted_slow_consumers += 1
+        self.disconnect(connection.websocket, connection.user_id)
+        # 1013: try again later
+        asyncio.create_task(connection.close(code=1013))
 
     async def send_to_user(self, user_id: str, message: dict):
-        """Send message to specific user"""
-        print(f"Attempting to send WebSocket message to user {user_id}")
-        print(f"Active connections: {list(self.active_connections.keys())}")
-        
-        if user_id in self.active_connections:
-            print(f"Found {len(self.active_connections[user_id])} connections for user {user_id}")
-            for connection in self.active_connections[user_id]:
-                try:
-                    await connection.send_text(json.dumps(message))
-                    print(f"Message sent successfully to user {user_id}")
-                except Exception as e:
-                    print(f"Failed to send message to user {user_id}: {e}")
-                    # Remove dead connections
-                    self.active_connections[user_id].remove(connection)
-        else:
-            print(f"No active connections found for user {user_id}")
+        """Send message to specific user on this worker and any other worker holding them
+
+        Every event for a user with sockets or an outbox here gets a "cursor"
+        and is kept in the outbox, so it can be replayed even if the user is
+        offline right now.
+        """
+        recorded = self._record(user_id, message, create=user_id in self.active_connections)
+        if recorded:
+            self._fan_out(user_id, *recorded)
+        await self.broker.publish(user_id, message)
+
+    async def deliver_local(self, user_id: str, message: dict):
+        """Take an event published by another worker
+
+        It is kept only if this worker has an outbox for the user or holds
+        their sockets; otherwise no cursor from this worker can need it.
+        """
+        recorded = self._record(user_id, message, create=user_id in self.active_connections)
+        if recorded:
+            self._fan_out(user_id, *recorded)
+
+    def _record(self, user_id: str, message: dict, create: bool = True) -> Optional[Tuple[dict, str]]:
+        """Stamp an event with this worker's next cursor and append it to the user's outbox"""
+        outbox = self.outboxes.get(user_id)
+        if outbox is None:
+            if not create:
+                return None
+            outbox = Outbox()
+        seq = next(_sequence)
+        # Sequence numbers are per worker, so the cursor names the worker too
+        message = {**message, "cursor": f"{self.broker.node_id}:{seq}"}
+        payload = json.dumps(message)
+        outbox.append(seq, payload)
+        self.outboxes.set(user_id, outbox)
+        self._join(user_id)
+        return message, payload
+
+    def reset_outboxes(self):
+        """Forget every outbox after events may have been missed; resumes then get sync_required"""
+        self.outboxes.clear()
+        self._sweep_presence()
+
+    def _join(self, user_id: str):
+        """Have other workers route the user's events here"""
+        if user_id not in self.broker.local_users:
+            self.broker.join(user_id)
+
+    def _leave_if_idle(self, user_id: str):
+        """Stop receiving the user's events once no socket or outbox here needs them"""
+        if user_id in self.broker.local_users and user_id not in self.active_connections and self.outboxes.get(user_id) is None:
+            self.broker.leave(user_id)
+
+    def _sweep_presence(self):
+        """Leave users whose outbox expired, was evicted or was reset since their last disconnect"""
+        for user_id in list(self.broker.local_users):
+            self._leave_if_idle(user_id)
+
+    def _fan_out(self, user_id: str, message: dict, payload: str):
+        """Queue an event on every connection; never waits for a client to read it
+
+        The event is serialized at most once per wire format.
+        """
+        payloads = {JSON: payload}
+        for connection in list(self.active_connections.get(user_id, [])):
+            if connection.fmt not in payloads:
+                payloads[connection.fmt] = encode(message, connection.fmt)
+            if not connection.enqueue(payloads[connection.fmt]):
+                self._evict(connection)
 
     async def broadcast_new_message(self, sender_id: str, recipient_id: str, message_data: dict):
         """Broadcast new message to recipient"""
-        print(f"📢 Broadcasting message from {sender_id} to {recipient_id}")
         await self.send_to_user(recipient_id, {
             "type": "new_message",
             "data": message_data
         })
 
+    async def broadcast_unread_count(self, user_id: str, contact_id: str, unread_count: int):
+        """Tell a user's devices the unread count of one conversation changed"""
+        await self.send_to_user(user_id, {
+            "type": "unread_count",
+            "data": {
+                "contact_id": contact_id,
+                "unread_count": unread_count
+            }
+        })
+
 # Global connection manager
-manager = ConnectionManager()
\ No newline at end of file
+manager = ConnectionManager()
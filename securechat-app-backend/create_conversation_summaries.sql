@@ -0,0 +1,37 @@
+-- Per-user conversation summaries backing the contacts list
+-- One row per (user, contact) pair, created when a chat request is accepted and kept current on message send
+CREATE TABLE IF NOT EXISTS conversation_summaries (
+    user_id UUID REFERENCES users(id) ON DELETE CASCADE,
+    contact_id UUID REFERENCES users(id) ON DELETE CASCADE,
+    last_message_id UUID,
+    last_message_at TIMESTAMP WITH TIME ZONE,
+    last_activity_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (user_id, contact_id)
+);
+
+-- Contacts list is a single read ordered by recency
+CREATE INDEX IF NOT EXISTS idx_conversation_summaries_recent ON conversation_summaries(user_id, last_activity_at DESC);
+
+-- Backfill from accepted chat requests
+INSERT INTO conversation_summaries (user_id, contact_id, last_activity_at)
+SELECT from_user_id, to_user_id, COALESCE(updated_at, created_at) FROM chat_requests WHERE status = 'accepted'
+UNION ALL
+SELECT to_user_id, from_user_id, COALESCE(updated_at, created_at) FROM chat_requests WHERE status = 'accepted'
+ON CONFLICT (user_id, contact_id) DO NOTHING;
+
+-- Backfill the latest message of each conversation
+WITH latest AS (
+    SELECT DISTINCT ON (user_id, contact_id) user_id, contact_id, id, created_at
+    FROM (
+        SELECT sender_id AS user_id, recipient_id AS contact_id, id, created_at FROM messages
+        UNION ALL
+        SELECT recipient_id AS user_id, sender_id AS contact_id, id, created_at FROM messages
+    ) directed
+    ORDER BY user_id, contact_id, created_at DESC, id DESC
+)
+UPDATE conversation_summaries s
+SET last_message_id = latest.id,
+    last_message_at = latest.created_at,
+    last_activity_at = GREATEST(s.last_activity_at, latest.created_at)
+FROM latest
+WHERE s.user_id = latest.user_id AND s.contact_id = latest.contact_id;
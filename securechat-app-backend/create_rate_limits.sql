@@ -0,0 +1,41 @@
+-- Shared GCRA rate limit state, used when RATE_LIMIT_BACKEND=postgres
+-- One row per key: the theoretical arrival time of its next request
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    tat TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_rate_limits_tat ON rate_limits(tat);
+
+-- Take one request for p_key. Returns 0 when allowed, otherwise the seconds to wait.
+CREATE OR REPLACE FUNCTION rate_limit_acquire(
+    p_key TEXT, p_emission DOUBLE PRECISION, p_tolerance DOUBLE PRECISION
+) RETURNS DOUBLE PRECISION AS $$
+DECLARE
+    v_now TIMESTAMP WITH TIME ZONE := clock_timestamp();
+    v_tat TIMESTAMP WITH TIME ZONE;
+BEGIN
+    INSERT INTO rate_limits (key, tat) VALUES (p_key, v_now)
+    ON CONFLICT (key) DO NOTHING;
+
+    SELECT GREATEST(tat, v_now) INTO v_tat FROM rate_limits WHERE key = p_key FOR UPDATE;
+
+    IF EXTRACT(EPOCH FROM (v_tat - v_now)) > p_tolerance THEN
+        RETURN EXTRACT(EPOCH FROM (v_tat - v_now)) - p_tolerance;
+    END IF;
+
+    UPDATE rate_limits SET tat = v_tat + make_interval(secs => p_emission) WHERE key = p_key;
+    RETURN 0;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Drop keys whose allowance has fully refilled; they behave exactly like absent keys
+CREATE OR REPLACE FUNCTION rate_limit_evict() RETURNS INTEGER AS $$
+DECLARE
+    v_deleted INTEGER;
+BEGIN
+    DELETE FROM rate_limits WHERE tat < clock_timestamp();
+    GET DIAGNOSTICS v_deleted = ROW_COUNT;
+    RETURN v_deleted;
+END;
+$$ LANGUAGE plpgsql;